@@ -8,6 +8,7 @@ Commits span from October 15, 2025 to December 31, 2025 with random dates.
 import os
 import random
 import subprocess
+import sys
 from datetime import datetime, timedelta
 import re
 import json
@@ -888,6 +889,10 @@ def main():
     print("Tip: Use 'git log --oneline --since=2025-10-15' to view your commit history")
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        # Site build tooling: python main.py build|...
+        from sitebuild.cli import run
+        sys.exit(run(sys.argv[1:]))
     main()
 
 
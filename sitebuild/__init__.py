@@ -0,0 +1,12 @@
+"""Build tooling for the Poseitrader website."""
+
+from .pipeline import (
+    DEFAULT_OPTIONS, build, emit_file, make_options, register_output_stage,
+    register_post_stage, register_pre_stage, register_stage, walk_site,
+)
+
+# Stage modules register themselves on import.
+from . import (  # noqa: E402,F401
+    chunks, compress, critical, dedup, exchanges, fingerprint, fonts, hints, images, links, minify,
+    routes, rustdoc, search, sitemap, vercel,
+)
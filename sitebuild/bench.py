@@ -0,0 +1,186 @@
+"""Benchmarks for the transform stages and the full build.
+
+Each corpus is a fixed selection of source files of one kind.  Its files are
+read into memory once and then run through the stages registered for their
+type, exactly as a build would, so the figures measure the stages and not
+the disk.  For every corpus the best of several rounds gives the throughput
+(MB/s and files/s); a separate pass under tracemalloc gives the peak memory
+the stages allocate for a single file.
+
+Results are compared with a baseline saved by an earlier run (``python
+main.py bench --save``), and a corpus whose throughput drops, or whose peak
+memory grows, by more than the threshold is reported as a regression.
+"""
+
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from .pipeline import (
+    DEFAULT_OUTPUT_DIR, build, file_context, file_type, is_excluded, run_pre_stages, run_stages,
+    source_hasher, stages_for, walk_site,
+)
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+BASELINE_NAME = 'bench-baseline.json'
+FORMAT_VERSION = 1
+
+# name -> the files it holds: types, include/exclude patterns (as in the
+# 'exclude' option) and the number of files kept, in path order.
+CORPORA = {
+    'landing': {'types': ('.html', '.htm'), 'include': ['*'], 'exclude': ['/docs/*', '/_next/*']},
+    'rustdoc': {'types': ('.html',), 'include': ['/docs/core-latest/nautilus_model/*'],
+                'limit': 300},
+    'next-css': {'types': ('.css',), 'include': ['/_next/*']},
+    'json': {'types': ('.json',), 'include': ['*']},
+}
+
+# Rounds shorter than this are repeated so timer resolution does not matter.
+MIN_ROUND_SECONDS = 0.2
+
+
+def select(relpaths, corpus, options):
+    """Return the paths that belong to a corpus."""
+    found = []
+    for relpath in relpaths:
+        name = os.path.basename(relpath)
+        if (file_type(relpath, options) in corpus['types']
+                and is_excluded(relpath, name, corpus['include'])
+                and not is_excluded(relpath, name, corpus.get('exclude', ()))):
+            found.append(relpath)
+    return found[:corpus.get('limit')]
+
+
+def _run_corpus(files, options, shared):
+    for relpath, data in files:
+        ctx = file_context(relpath, options, shared)
+        run_stages(stages_for(ctx['type']), data, ctx)
+
+
+def _peak_memory(files, options, shared):
+    """Return the most memory the stages allocated for one file, in bytes."""
+    peak = 0
+    tracemalloc.start()
+    try:
+        for relpath, data in files:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            ctx = file_context(relpath, options, shared)
+            run_stages(stages_for(ctx['type']), data, ctx)
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def bench_corpus(files, options, shared, rounds):
+    """Return the measurements for a list of (relpath, data)."""
+    size = sum(len(data) for _, data in files)
+    started = time.perf_counter()
+    _run_corpus(files, options, shared)
+    elapsed = time.perf_counter() - started
+    loops = max(1, int(MIN_ROUND_SECONDS / elapsed)) if elapsed else 1
+    best = elapsed
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for _ in range(loops):
+            _run_corpus(files, options, shared)
+        best = min(best, (time.perf_counter() - started) / loops)
+    best = max(best, 1e-9)
+    return {
+        'files': len(files),
+        'bytes': size,
+        'seconds': best,
+        'mb_s': size / best / (1024 * 1024),
+        'files_s': len(files) / best,
+        'peak_mb': _peak_memory(files, options, shared) / (1024 * 1024),
+    }
+
+
+def bench_build(src_root, options):
+    """Time a full build of src_root into a temporary directory."""
+    out_dir = tempfile.mkdtemp(prefix='sitebuild-bench-')
+    try:
+        summary = build(src_root, out_dir, options, force=True)
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    result = {
+        'files': summary['files'],
+        'bytes': summary['bytes_in'],
+        'seconds': summary['seconds'],
+        'mb_s': summary['bytes_in'] / summary['seconds'] / (1024 * 1024),
+        'files_s': summary['files'] / summary['seconds'],
+    }
+    if resource is not None:
+        # ru_maxrss is in KiB on Linux; workers count as children.
+        usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        result['peak_mb'] = usage / 1024
+    return result
+
+
+def run_benchmarks(src_root, options, names=None, rounds=3, full_build=False):
+    """Run the selected corpora (all by default) and return name -> result."""
+    relpaths = list(walk_site(src_root, options,
+                              skip_dirs=[os.path.join(src_root, DEFAULT_OUTPUT_DIR)]))
+    shared = run_pre_stages(src_root, options, relpaths, source_hasher(src_root, {}))
+    results = {}
+    for name in names or CORPORA:
+        paths = select(relpaths, CORPORA[name], options)
+        if not paths:
+            print(f"    Warning: Corpus '{name}' matches no files")
+            continue
+        files = []
+        for relpath in paths:
+            with open(os.path.join(src_root, relpath), 'rb') as f:
+                files.append((relpath, f.read()))
+        results[name] = bench_corpus(files, options, shared, rounds)
+    if full_build:
+        results['build'] = bench_build(src_root, options)
+    return results
+
+
+def load_baseline(path):
+    """Return the results saved at path, or None if there are none."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)['results']
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError) as e:
+        print(f"    Warning: Ignoring unreadable baseline {path}: {e}")
+        return None
+
+
+def save_baseline(path, results):
+    data = {'version': FORMAT_VERSION, 'python': platform.python_version(),
+            'machine': platform.machine(), 'results': results}
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def compare(results, baseline, threshold):
+    """Return name -> (throughput change, peak memory change, regressed).
+
+    Changes are fractions of the baseline value; throughput is in MB/s.
+    """
+    changes = {}
+    for name, result in results.items():
+        base = (baseline or {}).get(name)
+        if not base:
+            continue
+        speed = result['mb_s'] / base['mb_s'] - 1 if base.get('mb_s') else 0.0
+        memory = 0.0
+        if base.get('peak_mb') and 'peak_mb' in result:
+            memory = result['peak_mb'] / base['peak_mb'] - 1
+        changes[name] = (speed, memory, speed < -threshold or memory > threshold)
+    return changes
@@ -0,0 +1,183 @@
+"""Persistent build manifest used for incremental builds.
+
+The manifest lives in the output directory and maps every built file to the
+stat signature and content hash of its source and the hash of its output.  A
+file whose size and mtime are unchanged is skipped without being read; one
+whose stat changed but whose content hash did not is skipped without running
+its stages.  A change to the build options or the registered stages
+invalidates every entry.
+
+Facts that transform stages record about a file (see pipeline.register_stage)
+are kept in a second file next to the manifest, so post stages can use them
+for files an incremental build skipped.  Pre stages can keep state of their
+own there as well (save_state).
+
+A process that builds repeatedly (watch mode) does not parse either file
+again: what it saved last is kept in memory and handed back while the file
+on disk is still the one it wrote.
+"""
+
+import hashlib
+import json
+import os
+
+MANIFEST_NAME = '.build-manifest.json'
+FACTS_NAME = '.build-facts.json'
+
+# Bump when a change to the pipeline itself alters the output of a stage.
+PIPELINE_VERSION = 1
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_bytes(data):
+    """Return the hex content hash of a bytes-like object."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(path):
+    """Return the hex content hash of a file, read in bounded chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def config_digest(options, stages, output_stages=()):
+    """Return a digest of everything besides the source that affects the output."""
+    payload = {
+        'version': PIPELINE_VERSION,
+        'options': options,
+        'stages': {file_type: [name for name, _ in entries]
+                   for file_type, entries in sorted(stages.items())},
+        'output_stages': [name for name, _ in output_stages],
+    }
+    return hash_bytes(json.dumps(payload, sort_keys=True, default=str).encode('utf-8'))
+
+
+# path -> (stat signature, value) of the files this process saved last.
+_saved = {}
+
+
+def _signature(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+def _recall(path):
+    """Return the value saved to path by this process if the file is unchanged.
+
+    The caller owns the value: it is forgotten until saved again.
+    """
+    signature, value = _saved.pop(path, (None, None))
+    try:
+        if value is not None and _signature(path) == signature:
+            return value
+    except OSError:
+        pass
+    return None
+
+
+def _save_json(path, value):
+    tmp = path + '.part'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        # dumps() encodes in C in one go; dump() streams through the Python encoder.
+        f.write(json.dumps(value, separators=(',', ':'), sort_keys=True))
+    os.replace(tmp, path)
+    _saved[path] = (_signature(path), value)
+
+
+def manifest_path(out_dir):
+    return os.path.join(out_dir, MANIFEST_NAME)
+
+
+def load_manifest(out_dir, recall=True):
+    """Load the manifest from out_dir, or return an empty one.
+
+    Readers other than the build pass recall=False so they read the file and
+    leave the build's in-memory copy alone.
+    """
+    path = manifest_path(out_dir)
+    manifest = _recall(path) if recall else None
+    if manifest is not None:
+        return manifest
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {'config': None, 'files': {}}
+    except (OSError, ValueError) as e:
+        print(f"    Warning: Ignoring unreadable build manifest {path}: {e}")
+        return {'config': None, 'files': {}}
+    manifest.setdefault('config', None)
+    manifest.setdefault('files', {})
+    return manifest
+
+
+def save_manifest(out_dir, manifest):
+    """Write the manifest to out_dir atomically."""
+    _save_json(manifest_path(out_dir), manifest)
+
+
+def load_facts(out_dir):
+    """Load the per-file facts recorded by transform stages, or return {}."""
+    path = os.path.join(out_dir, FACTS_NAME)
+    facts = _recall(path)
+    if facts is not None:
+        return facts
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"    Warning: Ignoring unreadable build facts {path}: {e}")
+        return {}
+
+
+def save_facts(out_dir, facts):
+    """Write the per-file facts to out_dir atomically."""
+    _save_json(os.path.join(out_dir, FACTS_NAME), facts)
+
+
+def state_path(out_dir, name):
+    return os.path.join(out_dir, f'.build-{name}.json')
+
+
+def load_state(out_dir, name):
+    """Load the state a stage saved under name in out_dir, or return None."""
+    path = state_path(out_dir, name)
+    state = _recall(path)
+    if state is not None:
+        return state
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"    Warning: Ignoring unreadable build state {path}: {e}")
+        return None
+
+
+def save_state(out_dir, name, state):
+    """Write a stage's state (anything JSON can hold) to out_dir atomically."""
+    _save_json(state_path(out_dir, name), state)
+
+
+def is_fresh(entry, st, out_dir, relpath):
+    """Return True if a manifest entry still matches the source stat and output.
+
+    An entry with an 'alias' has had its output replaced by another file with
+    identical content and counts as present while that file exists.
+    """
+    if (entry is None
+            or entry.get('size') != st.st_size
+            or entry.get('mtime_ns') != st.st_mtime_ns):
+        return False
+    target = entry.get('alias') or relpath
+    return os.path.exists(os.path.join(out_dir, target))
@@ -0,0 +1,192 @@
+"""JavaScript chunk analysis for the Next.js export.
+
+_next/static/chunks holds the hashed bundles of the site: the framework and
+shared chunks, and a page-*.js and layout-*.js per route under app/.  Pages
+name the chunks they load twice, in <script src> and in the flight data
+("static/chunks/app/about/page-....js"), and chunks can name each other the
+same way; the webpack runtime can also load chunks by the hash in their file
+name.  From those references:
+
+* a pre stage collects the chunk references of every page, script and data
+  file, remembering them per source file between builds, and finds the
+  chunks nothing reaches: references from files outside the chunk
+  directory are the roots, and references from live chunks count too;
+* with the 'prune' option the dead chunks are left out of the build (and
+  their old output removed), and a post stage counts them;
+* chunk_report() adds, for the chunks command, the chunks that are copies
+  of each other and the JavaScript each route loads.
+
+Only whole references count, so a chunk loaded through a URL built at run
+time would be taken for dead; the export's runtime builds none.
+"""
+
+import gzip
+import os
+import posixpath
+import re
+
+from .cache import load_state, save_state
+from .pipeline import file_type, register_post_stage, register_pre_stage, walk_site
+from .search import page_url
+
+CHUNK_DIR = 'static/chunks'
+
+_CHUNK_REF = re.compile(rb'static/chunks/([\w.~@%+\[\]()/-]+?\.js)\b')
+# Chunk file names end in a 16 digit content hash ('7787-43cf5f1dc449bf55.js').
+_CHUNK_HASH = re.compile(r'-([0-9a-f]{16})\.js$')
+_QUOTED_HASH = re.compile(rb'["\']([0-9a-f]{16})["\']')
+
+PAGE_TYPES = ('.html', '.htm')
+
+
+def chunk_dir(conf):
+    return conf['root'].strip('/') + '/' + CHUNK_DIR
+
+
+def references(data, in_chunk):
+    """Return the chunk references in a file's data, sorted.
+
+    References are paths under the chunk directory ('app/page-....js'), or
+    for the scripts in it, also '#<hash>' for quoted file name hashes.
+    """
+    found = set()
+    if b'static/chunks/' in data:
+        found.update(match.decode('utf-8', 'replace') for match in _CHUNK_REF.findall(data))
+    if in_chunk:
+        found.update('#' + match.decode('ascii') for match in _QUOTED_HASH.findall(data))
+    return sorted(found)
+
+
+def site_references(ctx, conf):
+    """Return {relpath: [chunk reference]} for the files of the scanned types.
+
+    What was found in each file is kept in the output directory with the
+    file's hash, so only new and changed files are read again.
+    """
+    state = (load_state(ctx['out_dir'], 'chunks') if ctx['out_dir'] else None) or {}
+    prefix = chunk_dir(conf) + '/'
+    scanned = {}
+    for relpath in ctx['paths']:
+        if file_type(relpath, ctx['options']) not in conf['scan']:
+            continue
+        digest = ctx['source_hash'](relpath)
+        if digest is None:
+            continue
+        entry = state.get(relpath)
+        if entry is None or entry[0] != digest:
+            with open(os.path.join(ctx['src_root'], relpath), 'rb') as f:
+                entry = [digest, references(f.read(), relpath.startswith(prefix))]
+        scanned[relpath] = entry
+    if ctx['out_dir']:
+        save_state(ctx['out_dir'], 'chunks', scanned)
+    return {relpath: entry[1] for relpath, entry in scanned.items()}
+
+
+def chunk_graph(paths, refs, conf):
+    """Return {relpath: set of chunk relpaths it references} for the given files."""
+    prefix = chunk_dir(conf) + '/'
+    chunks = {relpath for relpath in paths
+              if relpath.startswith(prefix) and relpath.endswith('.js')}
+    by_hash = {}
+    for relpath in chunks:
+        match = _CHUNK_HASH.search(relpath)
+        if match:
+            by_hash.setdefault(match.group(1), []).append(relpath)
+    graph = {}
+    for relpath, found in refs.items():
+        targets = set()
+        for ref in found:
+            if ref.startswith('#'):
+                targets.update(target for target in by_hash.get(ref[1:], ()) if target != relpath)
+            elif prefix + ref in chunks:
+                targets.add(prefix + ref)
+        graph[relpath] = targets
+    return chunks, graph
+
+
+def closure(roots, graph):
+    """Return the chunks reachable from the roots' references."""
+    seen = set()
+    stack = [target for root in roots for target in graph.get(root, ())]
+    while stack:
+        relpath = stack.pop()
+        if relpath not in seen:
+            seen.add(relpath)
+            stack.extend(graph.get(relpath, ()))
+    return seen
+
+
+def dead_chunks(chunks, graph):
+    """Return the chunks no file outside the chunk directory leads to, sorted."""
+    live = closure([relpath for relpath in graph if relpath not in chunks], graph)
+    return sorted(chunks - live)
+
+
+@register_pre_stage('chunks', order=0)
+def find_dead_chunks(ctx):
+    """Return the dead chunks, and leave them out of the build if they are pruned."""
+    conf = ctx['options']['chunks']
+    if not conf:
+        return {}
+    chunks, graph = chunk_graph(ctx['paths'], site_references(ctx, conf), conf)
+    dead = dead_chunks(chunks, graph)
+    if conf['prune']:
+        ctx['skip'].update(dead)
+    return {'dead': dead}
+
+
+@register_post_stage('chunks', order=10)
+def count_pruned(ctx):
+    conf = ctx['options']['chunks']
+    dead = ctx['shared'].get('chunks', {}).get('dead')
+    if not conf or not conf['prune'] or not dead:
+        return
+    ctx['summary']['chunks_pruned'] = len(dead)
+    ctx['summary']['chunks_pruned_bytes'] = sum(
+        os.path.getsize(os.path.join(ctx['src_root'], relpath)) for relpath in dead)
+
+
+def _sizes(src_root, relpaths):
+    sizes = {}
+    for relpath in relpaths:
+        with open(os.path.join(src_root, relpath), 'rb') as f:
+            data = f.read()
+        sizes[relpath] = (len(data), len(gzip.compress(data, 6)), data)
+    return sizes
+
+
+def chunk_report(src_root, options, source_hash, skip_dirs=()):
+    """Analyse the chunks of the source tree without building it.
+
+    Returns {'chunks': number of chunks, 'dead': [relpath], 'sizes':
+    {relpath: (bytes, gzip bytes)}, 'copies': [[relpath]] (identical chunks),
+    'namesakes': [[relpath]] (chunks with one file name and different
+    content), 'routes': [(url, chunks, bytes, gzip bytes)]} for the pages that
+    load chunks, heaviest first.
+    """
+    conf = options['chunks']
+    ctx = {'src_root': src_root, 'options': options, 'source_hash': source_hash,
+           'paths': list(walk_site(src_root, options, skip_dirs)), 'out_dir': None}
+    chunks, graph = chunk_graph(ctx['paths'], site_references(ctx, conf), conf)
+    sizes = _sizes(src_root, sorted(chunks))
+    by_content = {}
+    by_name = {}
+    for relpath, (_, _, data) in sizes.items():
+        by_content.setdefault(data, []).append(relpath)
+        by_name.setdefault(posixpath.basename(relpath), set()).add(data)
+    copies = [group for group in by_content.values() if len(group) > 1]
+    namesakes = [sorted(relpath for relpath in sizes if posixpath.basename(relpath) == name)
+                 for name, contents in sorted(by_name.items()) if len(contents) > 1]
+    routes = []
+    for relpath in graph:
+        if file_type(relpath, options) in PAGE_TYPES:
+            loaded = closure([relpath], graph)
+            if not loaded:
+                continue
+            routes.append((page_url(relpath), len(loaded),
+                           sum(sizes[chunk][0] for chunk in loaded),
+                           sum(sizes[chunk][1] for chunk in loaded)))
+    routes.sort(key=lambda route: (-route[2], route[0]))
+    return {'chunks': len(chunks), 'dead': dead_chunks(chunks, graph),
+            'sizes': {relpath: size[:2] for relpath, size in sizes.items()},
+            'copies': copies, 'namesakes': namesakes, 'routes': routes}
@@ -0,0 +1,298 @@
+"""Command line interface for the site build tooling (``python main.py <command>``)."""
+
+import argparse
+import os
+import time
+
+from .bench import BASELINE_NAME, CORPORA, compare, load_baseline, run_benchmarks, save_baseline
+from .chunks import chunk_report
+from .compress import available_encodings
+from .fonts import subset_types
+from .images import available_formats
+from .links import check_site, report
+from .mirror import CONNECTIONS, RATE, import_site
+from .pack import SHARD_SIZE, pack_site
+from .pipeline import DEFAULT_OUTPUT_DIR, build, make_options, source_hasher
+from .serve import run_server
+from .watch import watch
+
+
+def _format_bytes(size):
+    return f"{size / (1024 * 1024):.1f} MB"
+
+
+def cmd_build(args):
+    options = make_options(jobs=args.jobs, minify=False if args.no_minify else None)
+    if args.dedup:
+        options['dedup']['mode'] = None if args.dedup == 'off' else args.dedup
+    if args.metrics:
+        options['metrics'] = {'path': args.metrics, 'slowest': args.slowest}
+    if args.no_compress:
+        options['compress'] = None
+    else:
+        missing = set(options['compress']['encodings']) - set(available_encodings(options['compress']['encodings']))
+        if missing:
+            print(f"Warning: No encoder for {', '.join(sorted(missing))} sidecars "
+                  f"(install the 'brotli' package); skipping them")
+    if options['images'] and not available_formats(options['images']['formats']):
+        print("Warning: No encoder for image variants (install the 'Pillow' package); "
+              "skipping them")
+    if options['fonts']:
+        missing = set(options['fonts']['types']) - set(subset_types(options['fonts']['types']))
+        if missing:
+            print(f"Warning: Cannot subset {', '.join(sorted(missing))} fonts (install the "
+                  f"'fonttools' and 'brotli' packages); leaving them whole")
+    summary = build(args.src, args.out, options, force=args.force)
+    print("=" * 70)
+    print(f"Built {summary['files']} files into {args.out} in {summary['seconds']:.2f}s")
+    print(f"  transformed: {summary['built']}  copied: {summary['copied']}  cached: {summary['cached']}"
+          f"  removed: {summary['removed']}  errors: {summary['error']}")
+    print(f"  {_format_bytes(summary['bytes_in'])} in -> {_format_bytes(summary['bytes_out'])} out")
+    if summary.get('dedup_files'):
+        print(f"  deduplicated: {summary['dedup_files']} files ({_format_bytes(summary['dedup_bytes'])})")
+    if summary.get('images_misnamed') or summary.get('images_duplicated'):
+        print(f"  images: {summary['images_misnamed']} misnamed, "
+              f"{summary['images_duplicated']} duplicates")
+    if summary.get('fingerprinted'):
+        print(f"  fingerprinted: {summary['fingerprinted']} assets")
+    if summary.get('chunks_pruned'):
+        print(f"  chunks: {summary['chunks_pruned']} dead chunks pruned "
+              f"({summary['chunks_pruned_bytes']} bytes)")
+    if summary.get('fonts_subset'):
+        print(f"  fonts: {summary['fonts_subset']} subsets, "
+              f"{_format_bytes(summary['fonts_saved'])} smaller")
+    if summary.get('critical_pages'):
+        print(f"  critical CSS: {_format_bytes(summary['critical_bytes'])} inlined "
+              f"in {summary['critical_pages']} pages")
+    if summary.get('hint_pages'):
+        print(f"  hints: {summary['hint_preloads']} preloads, {summary['hint_prefetches']} "
+              f"prefetches in {summary['hint_pages']} pages")
+    if summary.get('rustdoc_items'):
+        print(f"  rustdoc search: {summary['rustdoc_items']} items indexed")
+    if summary.get('sitemap_urls'):
+        print(f"  sitemap: {summary['sitemap_urls']} URLs in {summary['sitemap_shards']} shards")
+    if summary.get('feed_entries'):
+        print(f"  feed: {summary['feed_entries']} entries")
+    if summary.get('exchange_shards'):
+        print(f"  exchanges: {summary['exchange_shards']} catalog shards")
+    if summary.get('dead_links') or summary.get('orphans'):
+        print(f"  links: {summary['dead_links']} dead, {summary['orphans']} orphan pages")
+    if summary.get('routes'):
+        print(f"  routes: {summary['routes']} generated rewrites")
+    if args.metrics:
+        print(f"  metrics: {args.metrics}")
+    print("=" * 70)
+    return 1 if summary['error'] else 0
+
+
+def cmd_check_links(args):
+    options = make_options(jobs=args.jobs)
+    if args.entry:
+        options['links']['entries'] = args.entry
+    options['links']['report'] = args.limit
+    started = time.perf_counter()
+    dead, orphans, pages = check_site(args.src, options,
+                                      skip_dirs=[os.path.join(args.src, DEFAULT_OUTPUT_DIR)])
+    report(dead, orphans, args.limit)
+    print(f"Checked {pages} pages in {time.perf_counter() - started:.2f}s: "
+          f"{sum(len(found) for found in dead.values())} dead links to {len(dead)} paths, "
+          f"{len(orphans)} orphan pages")
+    return 1 if dead else 0
+
+
+def cmd_chunks(args):
+    options = make_options()
+    started = time.perf_counter()
+    found = chunk_report(args.src, options, source_hasher(args.src, {}),
+                         skip_dirs=[os.path.join(args.src, DEFAULT_OUTPUT_DIR)])
+    sizes = found['sizes']
+    for relpath in found['dead']:
+        print(f"    Warning: Dead chunk {relpath} ({sizes[relpath][0]} bytes)")
+    for group in found['copies']:
+        print(f"    Warning: Identical chunks {', '.join(group)}")
+    for group in found['namesakes']:
+        print(f"    Warning: Chunks named alike with different content {', '.join(group)}")
+    routes = found['routes']
+    if routes:
+        print(f"  {'route':<40} {'chunks':>6} {'bytes':>10} {'gzip':>10}")
+        for url, count, size, packed in routes[:args.limit]:
+            print(f"  {url:<40} {count:>6} {size:>10} {packed:>10}")
+        if len(routes) > args.limit:
+            print(f"  ... and {len(routes) - args.limit} more routes")
+    dead_bytes = sum(sizes[relpath][0] for relpath in found['dead'])
+    print(f"Analysed {found['chunks']} chunks ({_format_bytes(sum(size[0] for size in sizes.values()))}) "
+          f"for {len(routes)} routes in {time.perf_counter() - started:.2f}s: "
+          f"{len(found['dead'])} dead ({dead_bytes} bytes), "
+          f"{len(found['copies']) + len(found['namesakes'])} duplicated")
+    return 0
+
+
+def cmd_bench(args):
+    options = make_options(jobs=args.jobs)
+    results = run_benchmarks(args.src, options, args.corpus, args.rounds, args.build)
+    baseline_path = args.baseline or os.path.join(args.src, BASELINE_NAME)
+    baseline = load_baseline(baseline_path)
+    changes = compare(results, baseline, args.threshold)
+    print("=" * 70)
+    print(f"{'corpus':<10} {'files':>6} {'MB':>8} {'MB/s':>8} {'files/s':>9} {'peak MB':>8}  vs baseline")
+    for name, result in results.items():
+        peak = f"{result['peak_mb']:8.1f}" if 'peak_mb' in result else f"{'-':>8}"
+        change = ''
+        if name in changes:
+            speed, memory, regressed = changes[name]
+            change = f"{speed:+.0%} speed, {memory:+.0%} memory" + ('  REGRESSION' if regressed else '')
+        print(f"{name:<10} {result['files']:>6} {result['bytes'] / (1024 * 1024):>8.2f} "
+              f"{result['mb_s']:>8.1f} {result['files_s']:>9.1f} {peak}  {change}")
+    print("=" * 70)
+    if args.save:
+        save_baseline(baseline_path, results)
+        print(f"Saved baseline to {baseline_path}")
+    return 1 if any(regressed for _, _, regressed in changes.values()) else 0
+
+
+def cmd_import(args):
+    options = make_options()
+    try:
+        summary = import_site(args.origin, args.dest, options, args.entry or ['index.html'],
+                              args.connections, args.rate, args.prune)
+    except KeyboardInterrupt:
+        print("Interrupted; importing again resumes where this import stopped")
+        return 130
+    for relpath in summary['gone'][:args.limit]:
+        print(f"    Warning: {relpath} is gone from the origin")
+    print("=" * 70)
+    print(f"Imported {args.origin} into {args.dest} in {summary['seconds']:.2f}s "
+          f"({summary['requests']} requests)")
+    print(f"  added: {summary['added']}  changed: {summary['changed']}"
+          f"  unchanged: {summary['unchanged']}  missing: {summary['missing']}"
+          f"  gone: {len(summary['gone'])}"
+          f"  pruned: {summary['pruned']}  errors: {summary['errors']}")
+    print(f"  {_format_bytes(summary['bytes'])} written")
+    print("=" * 70)
+    return 1 if summary['errors'] else 0
+
+
+def cmd_pack(args):
+    started = time.perf_counter()
+    delta = pack_site(args.out, args.dest, args.base, args.jobs,
+                      shard_size=args.shard_size * 1024 * 1024, src_root=args.src,
+                      exclude=make_options()['exclude'])
+    archives = sum(shard['archive_bytes'] for shard in delta['shards'])
+    print("=" * 70)
+    print(f"Packed {len(delta['added']) + len(delta['changed'])} of {delta['files']} files "
+          f"into {args.dest} in {time.perf_counter() - started:.2f}s")
+    print(f"  added: {len(delta['added'])}  changed: {len(delta['changed'])}"
+          f"  removed: {len(delta['removed'])}  unchanged: {delta['unchanged']}")
+    print(f"  {_format_bytes(delta['bytes'])} in {len(delta['shards'])} shards "
+          f"({_format_bytes(archives)} compressed, {delta['reused_shards']} already packed)")
+    print("=" * 70)
+    return 0
+
+
+def cmd_serve(args):
+    run_server(args.out, make_options(), args.host, args.port, log=not args.quiet)
+    return 0
+
+
+def cmd_watch(args):
+    options = make_options(jobs=args.jobs)
+    watch(args.src, args.out, options, serve=(args.host, args.port) if args.serve else None)
+    return 0
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog='main.py', description='Poseitrader website build tooling')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('build', help='build the site into an output directory')
+    p.add_argument('--src', default='.', help='site source root (default: %(default)s)')
+    p.add_argument('--out', default=DEFAULT_OUTPUT_DIR, help='output directory (default: %(default)s)')
+    p.add_argument('-j', '--jobs', type=int, help='worker processes (default: one per CPU)')
+    p.add_argument('--force', action='store_true', help='ignore the build manifest and rebuild everything')
+    p.add_argument('--no-minify', action='store_true', help='copy HTML, CSS and JSON unminified')
+    p.add_argument('--no-compress', action='store_true', help='do not write .br/.gz sidecars')
+    p.add_argument('--dedup', choices=('hardlink', 'rewrite', 'off'),
+                   help='how to store files shared by the docs version trees (default: hardlink)')
+    p.add_argument('--metrics', metavar='PATH',
+                   help='write per-file and per-stage timings to PATH as JSON lines')
+    p.add_argument('--slowest', type=int, default=10,
+                   help='slowest files listed in the metrics (default: %(default)s)')
+    p.set_defaults(func=cmd_build)
+
+    p = commands.add_parser('check-links', help='report dead links and orphan pages in the source tree')
+    p.add_argument('--src', default='.', help='site source root (default: %(default)s)')
+    p.add_argument('-j', '--jobs', type=int, help='worker processes (default: one per CPU)')
+    p.add_argument('--entry', action='append',
+                   help='page the site is entered from; repeatable (default: index.html)')
+    p.add_argument('--limit', type=int, default=50, help='findings listed per kind (default: %(default)s)')
+    p.set_defaults(func=cmd_check_links)
+
+    p = commands.add_parser('chunks', help='report dead and duplicated Next.js chunks and per-route JS')
+    p.add_argument('--src', default='.', help='site source root (default: %(default)s)')
+    p.add_argument('--limit', type=int, default=50, help='routes listed (default: %(default)s)')
+    p.set_defaults(func=cmd_chunks)
+
+    p = commands.add_parser('bench', help='benchmark the transform stages on fixed corpora')
+    p.add_argument('--src', default='.', help='site source root (default: %(default)s)')
+    p.add_argument('--corpus', action='append', choices=sorted(CORPORA),
+                   help='corpus to run; repeatable (default: all)')
+    p.add_argument('--rounds', type=int, default=3, help='timed rounds per corpus (default: %(default)s)')
+    p.add_argument('--build', action='store_true', help='also time a full build')
+    p.add_argument('-j', '--jobs', type=int, help='worker processes for --build (default: one per CPU)')
+    p.add_argument('--baseline', help=f'baseline file (default: <src>/{BASELINE_NAME})')
+    p.add_argument('--save', action='store_true', help='save the results as the new baseline')
+    p.add_argument('--threshold', type=float, default=0.15,
+                   help='slowdown or memory growth reported as a regression (default: %(default)s)')
+    p.set_defaults(func=cmd_bench)
+
+    p = commands.add_parser('import', help='refresh the site tree from its origin')
+    p.add_argument('origin', help='directory or http(s) URL serving the site')
+    p.add_argument('--dest', default='.', help='site tree to refresh (default: %(default)s)')
+    p.add_argument('--entry', action='append',
+                   help='page the crawl starts from; repeatable (default: index.html)')
+    p.add_argument('-c', '--connections', type=int, default=CONNECTIONS,
+                   help='concurrent requests (default: %(default)s)')
+    p.add_argument('--rate', type=float, default=RATE,
+                   help='requests per second to an HTTP origin, 0 for no limit (default: %(default)s)')
+    p.add_argument('--prune', action='store_true',
+                   help='delete files an earlier import wrote that the origin no longer has')
+    p.add_argument('--limit', type=int, default=50, help='gone files listed (default: %(default)s)')
+    p.set_defaults(func=cmd_import)
+
+    p = commands.add_parser('pack', help='pack the files changed since the last deploy into shards')
+    p.add_argument('--src', default='.', help='site source root (default: %(default)s)')
+    p.add_argument('--out', default=DEFAULT_OUTPUT_DIR, help='build output directory (default: %(default)s)')
+    p.add_argument('--dest', default='deploy', help='directory for the shards and reports (default: %(default)s)')
+    p.add_argument('--base', help='manifest.json of the deployed site (default: pack everything)')
+    p.add_argument('-j', '--jobs', type=int, help='worker processes (default: one per CPU)')
+    p.add_argument('--shard-size', type=int, default=SHARD_SIZE // (1024 * 1024),
+                   help='uncompressed MB per shard (default: %(default)s)')
+    p.set_defaults(func=cmd_pack)
+
+    p = commands.add_parser('serve', help='serve the build output locally like production')
+    p.add_argument('--out', default=DEFAULT_OUTPUT_DIR, help='output directory (default: %(default)s)')
+    p.add_argument('--host', default='127.0.0.1', help='address to listen on (default: %(default)s)')
+    p.add_argument('--port', type=int, default=8000, help='port to listen on (default: %(default)s)')
+    p.add_argument('--quiet', action='store_true', help='do not log requests')
+    p.set_defaults(func=cmd_serve)
+
+    p = commands.add_parser('watch', help='rebuild incrementally whenever a source file changes')
+    p.add_argument('--src', default='.', help='site source root (default: %(default)s)')
+    p.add_argument('--out', default=DEFAULT_OUTPUT_DIR, help='output directory (default: %(default)s)')
+    p.add_argument('-j', '--jobs', type=int, help='worker processes (default: one per CPU)')
+    p.add_argument('--serve', action='store_true', help='also run the preview server, reloading pages live')
+    p.add_argument('--host', default='127.0.0.1', help='preview server address (default: %(default)s)')
+    p.add_argument('--port', type=int, default=8000, help='preview server port (default: %(default)s)')
+    p.set_defaults(func=cmd_watch)
+
+    return parser
+
+
+def run(argv):
+    """Parse argv and run the selected command; returns the exit status."""
+    args = make_parser().parse_args(argv)
+    try:
+        return args.func(args)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 2
@@ -0,0 +1,114 @@
+"""Precompressed .br/.gz sidecars for static assets.
+
+Runs as an output stage, so sidecars are produced on the worker pool next to
+every freshly written file and are left alone for files the incremental
+build skips.  A sidecar is only kept when it is smaller than the file it
+encodes; the encodings written are recorded in the manifest entry so that
+later stages (dedup, the preview server) know which sidecars exist.
+
+Brotli needs the optional ``brotli`` package; without it only gzip sidecars
+are written.
+"""
+
+import gzip
+import os
+import shutil
+
+from .pipeline import register_output_stage, write_atomic
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+ENCODINGS = ('br', 'gz')
+
+CHUNK_SIZE = 256 * 1024
+
+
+def _gzip(data):
+    # mtime=0 keeps the output byte-identical between builds.
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def _brotli(data, file_type):
+    mode = brotli.MODE_FONT if file_type in ('.ttf', '.otf') else brotli.MODE_TEXT
+    return brotli.compress(data, quality=11, mode=mode)
+
+
+def available_encodings(requested):
+    """Return the requested encodings this interpreter can produce."""
+    return [encoding for encoding in requested
+            if encoding in ENCODINGS and (encoding != 'br' or brotli is not None)]
+
+
+def compress_bytes(data, encoding, file_type=''):
+    """Return data compressed with the given encoding ('br' or 'gz')."""
+    if encoding == 'gz':
+        return _gzip(data)
+    if encoding == 'br':
+        if brotli is None:
+            raise RuntimeError('brotli is not installed')
+        return _brotli(data, file_type)
+    raise ValueError(f"unknown encoding {encoding!r}")
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def compress_file(path, sidecar, encoding, file_type=''):
+    """Stream path into sidecar compressed with encoding; return its size."""
+    tmp = sidecar + '.part'
+    with open(path, 'rb') as fin, open(tmp, 'wb') as fout:
+        if encoding == 'gz':
+            with gzip.GzipFile(filename='', mode='wb', fileobj=fout,
+                               compresslevel=9, mtime=0) as gz:
+                shutil.copyfileobj(fin, gz, CHUNK_SIZE)
+        elif encoding == 'br':
+            if brotli is None:
+                raise RuntimeError('brotli is not installed')
+            mode = brotli.MODE_FONT if file_type in ('.ttf', '.otf') else brotli.MODE_TEXT
+            compressor = brotli.Compressor(mode=mode, quality=11)
+            for chunk in iter(lambda: fin.read(CHUNK_SIZE), b''):
+                fout.write(compressor.process(chunk))
+            fout.write(compressor.finish())
+        else:
+            raise ValueError(f"unknown encoding {encoding!r}")
+        size = fout.tell()
+    os.replace(tmp, sidecar)
+    return size
+
+
+@register_output_stage('compress')
+def write_sidecars(dest, data, ctx):
+    """Write dest.br / dest.gz when they are smaller than dest.
+
+    Output that is still in memory is compressed directly; anything else is
+    streamed from the output file in bounded chunks.
+    """
+    conf = ctx['options']['compress']
+    wanted = []
+    if conf and ctx['type'] in conf['types']:
+        wanted = available_encodings(conf['encodings'])
+    size = len(data) if data is not None else os.path.getsize(dest)
+
+    written = []
+    for encoding in ENCODINGS:
+        sidecar = dest + '.' + encoding
+        if encoding in wanted:
+            if data is not None:
+                compressed = compress_bytes(data, encoding, ctx['type'])
+                if len(compressed) < size:
+                    write_atomic(sidecar, compressed)
+                    written.append(encoding)
+                    continue
+            elif compress_file(dest, sidecar, encoding, ctx['type']) < size:
+                written.append(encoding)
+                continue
+        # Never leave a sidecar from an earlier build next to new content.
+        _remove(sidecar)
+    return {'encodings': written} if written else {}
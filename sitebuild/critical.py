@@ -0,0 +1,438 @@
+"""Critical CSS: inline the rules a page can use, load the stylesheet later.
+
+The Next.js bundles under _next/static/css block the first render of every
+page until they have downloaded.  For every page that uses one of the
+configured stylesheets, and whose subset fits in max_size bytes, this
+stage inlines the subset of its rules the page's markup can match in a
+<style> element, and loads the full stylesheet without blocking rendering:
+
+* a <link rel="stylesheet"> is replaced by the inlined rules, a preload that
+  turns into the stylesheet once loaded, and a <noscript> fallback;
+* a stylesheet that only the Next.js flight data refers to (React inserts
+  its <link> while hydrating) is inlined at the end of <head> and preloaded.
+
+Scripts build parts of the pages' DOM at run time, so the rest of the rules
+is deferred rather than pruned.  Matching is conservative: a selector is
+kept when every compound in it names only elements, classes, ids and
+attributes that occur in the page, regardless of how they are nested;
+pseudo-classes match anything.  @font-face and @keyframes rules are kept
+when the kept rules use their font or animation.
+
+A stylesheet is parsed once per worker.  The subset depends only on which
+of the stylesheet's selector tokens a page contains, so it is cached under
+(stylesheet hash, those tokens): pages built from the same template share
+one entry, which goes through the stylesheet transform stages once.  The
+stage runs after the other HTML stages so they do not process the inlined
+rules again.  Pages record the stylesheets they use as dependencies and are
+rebuilt when one changes.
+"""
+
+import os
+import posixpath
+import re
+from urllib.parse import quote
+
+from .fingerprint import CSS_URL, apply_edits, resolve
+from .htmlscan import Tag, attributes
+from .minify import BOM, minify_css_bytes
+from .pipeline import (
+    file_context, file_type, is_excluded, register_post_stage, register_pre_stage, register_stage,
+    run_stages, stages_for,
+)
+
+# At-rules whose block holds rules rather than declarations.
+GROUP_RULES = (b'@media', b'@supports', b'@layer', b'@container', b'@document', b'@scope')
+
+_CSS_PART = re.compile(rb'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|[{};]', re.DOTALL)
+_IDENT = rb'(?:[\w-]|[^\x00-\x7f]|\\[0-9a-fA-F]{1,6}\s?|\\.)+'
+# The parts of a compound selector that a page has to contain.
+_SIMPLE = re.compile(
+    rb'#(' + _IDENT + rb')|\.(' + _IDENT + rb')|\[\s*(' + _IDENT + rb')[^\]]*\]'
+    rb'|::?' + _IDENT + rb'|(' + _IDENT + rb'|\*)')
+_ESCAPE = re.compile(rb'\\([0-9a-fA-F]{1,6})\s?|\\(.)', re.DOTALL)
+_FONT_FAMILY = re.compile(rb'font-family:\s*(["\']?)([^;"\'}]+)\1')
+_KEYFRAMES_NAME = re.compile(rb'@(?:-\w+-)?keyframes\s+(["\']?)([^\s{"\']+)\1', re.IGNORECASE)
+
+_TAG_NAME = re.compile(rb'<([A-Za-z][A-Za-z0-9-]*)')
+_CLASS_VALUE = re.compile(rb'class\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'=<>`]+))')
+_ID_VALUE = re.compile(rb'id\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'=<>`]+))')
+_STYLE_END = re.compile(rb'</style', re.IGNORECASE)
+_HEAD_END = re.compile(rb'</head\s*>', re.IGNORECASE)
+_HEAD_SKIPPED = re.compile(rb'<(script|noscript|template)\b.*?</\1\s*>|<!--.*?-->',
+                           re.IGNORECASE | re.DOTALL)
+_LINK = re.compile(rb'<link(\s[^>]*)>', re.IGNORECASE)
+
+# Turns the preload into the stylesheet once it has loaded.
+_ONLOAD = b"this.onload=null;this.rel='stylesheet'"
+
+# Per worker: stylesheet hash -> parsed Stylesheet.
+_sheets = {}
+
+
+def _unescape(ident):
+    def replace(match):
+        if match.group(1):
+            return chr(int(match.group(1), 16)).encode('utf-8', 'replace')
+        return match.group(2)
+    return _ESCAPE.sub(replace, ident)
+
+
+def split_top(text, separators):
+    """Split selector text at the separator bytes outside (), [] and strings."""
+    parts = []
+    depth = 0
+    quote_char = None
+    start = 0
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if quote_char is not None:
+            if char == 92:  # backslash
+                i += 1
+            elif char == quote_char:
+                quote_char = None
+        elif char == 92:
+            i += 1
+        elif char in b'"\'':
+            quote_char = char
+        elif char in b'([':
+            depth += 1
+        elif char in b')]':
+            depth -= 1
+        elif depth == 0 and char in separators:
+            parts.append(text[start:i])
+            start = i + 1
+        i += 1
+    parts.append(text[start:])
+    return parts
+
+
+def _strip_functions(compound):
+    """Drop the arguments of functional pseudo-classes (':not(.a)' -> ':not')."""
+    out = []
+    depth = 0
+    for part in re.split(rb'([()])', compound):
+        if part == b'(':
+            depth += 1
+        elif part == b')':
+            depth -= 1
+        elif depth == 0:
+            out.append(part)
+    return b''.join(out)
+
+
+def compound_tokens(compound):
+    """Return the tokens a compound selector requires: b'div', b'.a', b'#b', b'[c'."""
+    tokens = set()
+    for match in _SIMPLE.finditer(_strip_functions(compound)):
+        ident, prefix = None, b''
+        if match.group(1):
+            ident, prefix = match.group(1), b'#'
+        elif match.group(2):
+            ident, prefix = match.group(2), b'.'
+        elif match.group(3):
+            ident, prefix = match.group(3).lower(), b'['
+        elif match.group(4) and match.group(4) != b'*':
+            ident = match.group(4).lower()
+        if ident is not None:
+            tokens.add(prefix + _unescape(ident))
+    return tokens
+
+
+def selector_requirements(selector_list):
+    """Return one frozenset of required tokens per selector in a selector list."""
+    found = []
+    for selector in split_top(selector_list, b','):
+        tokens = set()
+        for compound in split_top(selector.strip(), b' >+~'):
+            tokens |= compound_tokens(compound)
+        found.append(frozenset(tokens))
+    return found
+
+
+class Rule:
+    """A parsed rule: kind is 'style', 'group', 'font-face', 'keyframes' or 'other'.
+
+    text is the rule's source (minified); a group rule has its prelude in
+    text and its rules in children.
+    """
+
+    __slots__ = ('kind', 'text', 'requires', 'children', 'name')
+
+    def __init__(self, kind, text, requires=(), children=(), name=None):
+        self.kind = kind
+        self.text = text
+        self.requires = requires
+        self.children = children
+        self.name = name
+
+
+def _block_end(data, pos):
+    """Return the offset just past the '}' closing the block opened before pos."""
+    depth = 1
+    for match in _CSS_PART.finditer(data, pos):
+        if match.group(0) == b'{':
+            depth += 1
+        elif match.group(0) == b'}':
+            depth -= 1
+            if depth == 0:
+                return match.end()
+    return len(data)
+
+
+def _parse_rules(data, pos, end):
+    """Parse the rules from pos; return (rules, offset past the closing '}')."""
+    rules = []
+    start = pos
+    while True:
+        match = _CSS_PART.search(data, pos, end)
+        if match is None:
+            tail = data[start:end].strip()
+            if tail:
+                rules.append(Rule('other', tail))
+            return rules, end
+        token = match.group(0)
+        pos = match.end()
+        if token == b'}':
+            return rules, pos
+        if token == b';':
+            statement = data[start:pos].strip()
+            if statement not in (b';', b'') and not statement.startswith(b'@charset'):
+                rules.append(Rule('other', statement))
+            start = pos
+        elif token == b'{':
+            prelude = data[start:match.start()].strip()
+            lower = prelude.lower()
+            if lower.startswith(GROUP_RULES):
+                children, pos = _parse_rules(data, pos, end)
+                rules.append(Rule('group', prelude, children=children))
+            else:
+                pos = _block_end(data, pos)
+                text = data[start:pos].strip()
+                if lower.startswith(b'@font-face'):
+                    family = _FONT_FAMILY.search(text)
+                    rules.append(Rule('font-face', text,
+                                      name=family.group(2).strip() if family else None))
+                elif _KEYFRAMES_NAME.match(prelude):
+                    rules.append(Rule('keyframes', text,
+                                      name=_KEYFRAMES_NAME.match(prelude).group(2)))
+                elif lower.startswith(b'@'):
+                    rules.append(Rule('other', text))
+                else:
+                    rules.append(Rule('style', text, selector_requirements(prelude)))
+            start = pos
+
+
+class Stylesheet:
+    """A stylesheet parsed for subsetting."""
+
+    __slots__ = ('path', 'rules', 'tokens', 'size', 'subsets')
+
+    def __init__(self, path, data):
+        self.path = path
+        data = minify_css_bytes(data)
+        while data.startswith(BOM):
+            data = data[len(BOM):]
+        self.size = len(data)
+        self.rules, _ = _parse_rules(data, 0, len(data))
+        self.tokens = frozenset(self._tokens(self.rules))
+        self.subsets = {}
+
+    def _tokens(self, rules):
+        for rule in rules:
+            if rule.kind == 'group':
+                yield from self._tokens(rule.children)
+            for requires in rule.requires:
+                yield from requires
+
+    def _select(self, rules, tokens):
+        kept = []
+        for rule in rules:
+            if rule.kind == 'style':
+                if any(requires <= tokens for requires in rule.requires):
+                    kept.append(rule.text)
+            elif rule.kind == 'group':
+                children = self._select(rule.children, tokens)
+                if children:
+                    kept.append(rule.text + b'{' + b''.join(children) + b'}')
+            elif rule.kind == 'other':
+                kept.append(rule.text)
+        return kept
+
+    def _used(self, rules, kind, text):
+        for rule in rules:
+            if rule.kind == 'group':
+                yield from self._used(rule.children, kind, text)
+            elif rule.kind == kind and (rule.name is None or rule.name in text):
+                yield rule.text
+
+    def subset(self, tokens):
+        """Return the rules that can apply to a page containing tokens, as CSS."""
+        kept = b''.join(self._select(self.rules, tokens))
+        extra = list(self._used(self.rules, 'font-face', kept))
+        extra += self._used(self.rules, 'keyframes', kept)
+        return self._rebase(b''.join(extra) + kept)
+
+    def _rebase(self, css):
+        """Make the relative url()s root-absolute, so the rules work in any page."""
+        def replace(match):
+            try:
+                target = resolve(self.path, match.group(2).decode('utf-8'))
+            except UnicodeDecodeError:
+                return match.group(0)
+            if target is None or match.group(2).startswith(b'/'):
+                return match.group(0)
+            return b'url(' + ('/' + quote(target)).encode('utf-8') + b')'
+        return CSS_URL.sub(replace, css)
+
+
+def page_tokens(data, attribute_names=()):
+    """Return the element, class, id and attribute tokens that occur in a page.
+
+    Only the attributes in attribute_names (tokens like b'[data-theme') are
+    looked for.
+    """
+    tokens = {b'html', b'head', b'body'}
+    tokens.update(name.lower() for name in set(_TAG_NAME.findall(data)))
+    for pattern, prefix in ((_CLASS_VALUE, b'.'), (_ID_VALUE, b'#')):
+        names = b' '.join(b''.join(value) for value in set(pattern.findall(data))).split()
+        tokens.update(prefix + name for name in set(names))
+    for name in attribute_names:
+        if re.search(re.escape(name[1:]) + rb'[\s=/>]', data):
+            tokens.add(name)
+    return tokens
+
+
+def critical_css(sheet, tokens, ctx):
+    """Return (css, deps): the subset of sheet for a page's tokens.
+
+    The subset goes through the transform stages for stylesheets, like the
+    stylesheet itself (so its asset URLs are fingerprinted too), once per
+    distinct set of the stylesheet's tokens; deps are the files the stages
+    used.
+    """
+    key = tokens & sheet.tokens
+    found = sheet.subsets.get(key)
+    if found is None:
+        sheet_ctx = file_context(sheet.path, ctx['options'], ctx['shared'])
+        css = run_stages(stages_for('.css'), sheet.subset(key), sheet_ctx)
+        found = sheet.subsets[key] = (css, sheet_ctx['deps'])
+    return found
+
+
+def stylesheet(path, relpath, digest):
+    """Return the parsed stylesheet at path, from this worker's cache if possible."""
+    sheet = _sheets.get(digest)
+    if sheet is None:
+        with open(path, 'rb') as f:
+            sheet = _sheets[digest] = Stylesheet(relpath, f.read())
+    return sheet
+
+
+@register_pre_stage('critical')
+def find_stylesheets(ctx):
+    """Return {stylesheet relpath: [source path, source hash]}."""
+    conf = ctx['options']['critical']
+    if not conf:
+        return {}
+    sheets = {}
+    for relpath in ctx['paths']:
+        if (file_type(relpath, ctx['options']) == '.css'
+                and is_excluded(relpath, posixpath.basename(relpath), conf['stylesheets'])):
+            digest = ctx['source_hash'](relpath)
+            if digest is not None:
+                sheets[relpath] = [os.path.join(ctx['src_root'], relpath), digest]
+    return sheets
+
+
+def head_stylesheets(data):
+    """Return (offset of </head>, [(link Tag, attributes)]) for a page's stylesheets.
+
+    Only the head is searched, and links inside scripts, noscript elements
+    and comments are skipped.  The offset is None if there is no </head>.
+    """
+    match = _HEAD_END.search(data)
+    if match is None:
+        return None, []
+    head_end = match.start()
+    skipped = [found.span() for found in _HEAD_SKIPPED.finditer(data, 0, head_end)]
+    links = []
+    for match in _LINK.finditer(data, 0, head_end):
+        if any(start <= match.start() < end for start, end in skipped):
+            continue
+        tag = Tag(b'link', match.start(), match.end(), match.start(1), match.end(1))
+        attrs = attributes(data, tag)
+        if b'stylesheet' in attrs.get(b'rel', b'').lower().split():
+            links.append((tag, attrs))
+    return head_end, links
+
+
+@register_stage('critical', ('.html', '.htm'), order=95)
+def inline_critical(data, ctx):
+    conf = ctx['options']['critical']
+    sheets = ctx['shared'].get('critical')
+    if not conf or not sheets:
+        return data
+    # The page changed since the shared index was made; a full rescan would
+    # cost more than looking at the head.
+    head_end, links = head_stylesheets(data)
+    if head_end is None:
+        return data
+    # (link tag or None, stylesheet relpath, URL)
+    found = []
+    for tag, attrs in links:
+        try:
+            target = resolve(ctx['path'], attrs.get(b'href', b'').decode('utf-8'))
+        except UnicodeDecodeError:
+            continue
+        # Links with media, integrity, ... are left as they are.
+        if target in sheets and set(attrs) <= {b'rel', b'href'}:
+            found.append((tag, target, attrs[b'href']))
+    linked = {relpath for _, relpath, _ in found}
+    for relpath in sheets:
+        url = ('/' + quote(relpath)).encode('utf-8')
+        if relpath not in linked and data.find(url) != -1:
+            found.append((None, relpath, url))
+    if not found:
+        return data
+
+    used = []
+    for _, relpath, _ in found:
+        path, digest = sheets[relpath]
+        ctx['deps'][relpath] = digest
+        used.append(stylesheet(path, relpath, digest))
+    keep = set()
+    for selector in conf['keep']:
+        keep.update(compound_tokens(selector.encode('utf-8')))
+    names = {token for sheet in used for token in sheet.tokens if token.startswith(b'[')}
+    tokens = frozenset(page_tokens(data, names - keep) | keep)
+
+    edits = []
+    inlined = 0
+    for (tag, _, url), sheet in zip(found, used):
+        css, deps = critical_css(sheet, tokens, ctx)
+        if len(css) > conf['max_size'] or _STYLE_END.search(css):
+            continue
+        ctx['deps'].update(deps)
+        inlined += len(css)
+        if tag is not None:
+            edits.append((tag.start, tag.end, b'<style>' + css + b'</style>'
+                          + b'<link rel="preload" as="style" href="' + url + b'" onload="'
+                          + _ONLOAD + b'"><noscript>' + bytes(data[tag.start:tag.end])
+                          + b'</noscript>'))
+        else:
+            edits.append((head_end, head_end, b'<style>' + css + b'</style>'
+                          + b'<link rel="preload" as="style" href="' + url + b'">'))
+    if not edits:
+        return data
+    ctx['facts']['critical'] = inlined
+    return apply_edits(data, edits)
+
+
+@register_post_stage('critical', order=50)
+def count_inlined(ctx):
+    facts = ctx['facts'].get('critical', {})
+    pages = [size for path, size in facts.items() if path in ctx['files']]
+    if pages:
+        ctx['summary']['critical_pages'] = len(pages)
+        ctx['summary']['critical_bytes'] = sum(pages)
@@ -0,0 +1,156 @@
+"""Cross-version deduplication of the mirrored docs trees.
+
+docs/core-latest and docs/core-nightly share about a thousand byte-identical
+files (all of static.files/ among them).  Files under the configured roots are
+content-addressed by their output hash; the first occurrence, in root order,
+is kept as the canonical copy and every other occurrence is hardlinked to it.
+In 'rewrite' mode, copies at the same path in another root are instead
+removed and served through a vercel.json rewrite.  Rewrites for
+directories that only contain duplicates of the same directory in another
+root are collapsed into a single ``:path*`` rule.
+"""
+
+import os
+
+from .pipeline import register_post_stage, root_of
+
+# Vercel caps a deployment at 1024 routes; leave room for the other rules.
+MAX_REWRITES = 512
+
+
+def find_duplicates(files, roots):
+    """Return (duplicate, canonical) relpath pairs for files under roots."""
+    by_root = {root: [] for root in roots}
+    for relpath in files:
+        root = root_of(relpath, roots)
+        if root is not None:
+            by_root[root].append(relpath)
+
+    canonical = {}
+    pairs = []
+    for root in roots:
+        for relpath in sorted(by_root[root]):
+            digest = files[relpath]['out']
+            if digest in canonical:
+                pairs.append((relpath, canonical[digest]))
+            else:
+                canonical[digest] = relpath
+    return pairs
+
+
+def _link(target, path):
+    """Replace path with a hardlink to target; return False if already linked."""
+    try:
+        if os.path.samefile(target, path):
+            return False
+    except FileNotFoundError:
+        pass
+    tmp = path + '.part'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.link(target, tmp)
+    os.replace(tmp, path)
+    return True
+
+
+def _same_path(dup, target, roots):
+    """Return True if dup and target sit at the same path in different roots."""
+    dup_root = root_of(dup, roots)
+    target_root = root_of(target, roots)
+    return dup_root != target_root and dup[len(dup_root):] == target[len(target_root):]
+
+
+def rewrite_groups(files, pairs, roots):
+    """Group same-path duplicates into vercel.json rewrites.
+
+    Returns a list of (rule, duplicates) where duplicates are the relpaths the
+    rule serves from their canonical copy.
+    """
+    # directory -> canonical root all of its files mirror, or None if the
+    # directory holds anything that is not a same-path duplicate.
+    paired = {dup: root_of(target, roots) for dup, target in pairs}
+    mirrors = {}
+    for relpath in files:
+        root = root_of(relpath, roots)
+        if root is None:
+            continue
+        target_root = paired.get(relpath)
+        directory = os.path.dirname(relpath)
+        while True:
+            if directory not in mirrors:
+                mirrors[directory] = target_root
+            elif mirrors[directory] != target_root:
+                mirrors[directory] = None
+            if directory == root:
+                break
+            directory = os.path.dirname(directory)
+
+    groups = {}
+    for dup, target in pairs:
+        target_root = paired[dup]
+        root = root_of(dup, roots)
+        # Find the outermost directory that only mirrors target_root.
+        top = None
+        directory = os.path.dirname(dup)
+        while True:
+            if mirrors.get(directory) == target_root:
+                top = directory
+            if directory == root:
+                break
+            directory = os.path.dirname(directory)
+        if top is None:
+            source, destination = '/' + dup, '/' + target
+        else:
+            source = f'/{top}/:path*'
+            destination = f'/{target_root}{top[len(root):]}/:path*'
+        groups.setdefault((source, destination), []).append(dup)
+    return [({'source': source, 'destination': destination}, dups)
+            for (source, destination), dups in groups.items()]
+
+
+@register_post_stage('dedup', order=20)
+def dedup(ctx):
+    """Hardlink or rewrite duplicate files across the configured version roots."""
+    conf = ctx['options']['dedup']
+    mode = conf and conf.get('mode')
+    if not mode:
+        return
+    if mode not in ('hardlink', 'rewrite'):
+        raise ValueError(f"unknown dedup mode {mode!r}")
+    files = ctx['files']
+    out_dir = ctx['out_dir']
+    roots = [root.strip('/') for root in conf['roots']]
+
+    for entry in files.values():
+        entry.pop('alias', None)
+    pairs = find_duplicates(files, roots)
+
+    rewritten = set()
+    if mode == 'rewrite':
+        # Only same-path copies in another root are worth a rule, and the
+        # rules that cover the most files are kept when over the route limit.
+        same_path = [(dup, target) for dup, target in pairs if _same_path(dup, target, roots)]
+        groups = rewrite_groups(files, same_path, roots)
+        groups.sort(key=lambda group: len(group[1]), reverse=True)
+        groups = groups[:conf.get('max_rewrites', MAX_REWRITES)]
+        for rule, dups in sorted(groups, key=lambda group: group[0]['source']):
+            ctx['rewrites'].append(rule)
+            rewritten.update(dups)
+
+    saved = 0
+    for dup, target in pairs:
+        # Identical content has identical precompressed sidecars.
+        suffixes = [''] + ['.' + encoding for encoding in files[dup].get('encodings', ())]
+        for suffix in suffixes:
+            path = os.path.join(out_dir, dup + suffix)
+            if dup in rewritten:
+                if os.path.lexists(path):
+                    os.remove(path)
+            else:
+                _link(os.path.join(out_dir, target + suffix), path)
+        if dup in rewritten:
+            files[dup]['alias'] = target
+        saved += files[dup]['out_size']
+
+    ctx['summary']['dedup_files'] = len(pairs)
+    ctx['summary']['dedup_bytes'] = saved
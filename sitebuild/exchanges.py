@@ -0,0 +1,240 @@
+"""The v1/exchanges catalog: loader, query API and per-exchange shards.
+
+v1/exchanges is a hand-edited JSON array with one object per exchange:
+
+    {"id": "bitmex", "name": "BitMEX", "enabled": true, "supportsDatasets": true,
+     "availableSince": "2019-03-30T00:00:00.000Z", "availableChannels": [...],
+     "delisted": true, "availableTo": "2022-11-13T00:00:00.000Z"}
+
+The last two fields are optional.  The loader accepts the same residue as
+the JSON minifier (generator lines, whole-line ``//`` comments) and checks
+every record, so a bad edit fails the build with the offending exchange
+named instead of shipping a catalog clients cannot use.
+
+Besides the catalog itself, the build writes one shard per exchange
+(v1/exchange/<id>.json, the exchange's record) and one per channel
+(v1/channel/<channel>.json, the exchanges offering it without their channel
+lists), so a client only fetches what it asks about.  Some channel names
+contain '/' ('futures/trade'); their shards are in subdirectories.
+"""
+
+import bisect
+import json
+import os
+from datetime import datetime, timezone
+
+from .minify import parse_json_bytes
+from .pipeline import emit_file, keep_generated, register_post_stage
+
+
+class Exchange:
+    """One catalog record.  Dates are aware datetimes in UTC."""
+
+    __slots__ = ('id', 'name', 'enabled', 'supports_datasets', 'available_since',
+                 'available_to', 'delisted', 'channels')
+
+    def __init__(self, id, name, enabled, supports_datasets, available_since,
+                 channels, available_to=None, delisted=False):
+        self.id = id
+        self.name = name
+        self.enabled = enabled
+        self.supports_datasets = supports_datasets
+        self.available_since = available_since
+        self.available_to = available_to
+        self.delisted = delisted
+        self.channels = channels
+
+    def __repr__(self):
+        return f'<Exchange {self.id}>'
+
+    def is_available(self, when):
+        """Return True if data is available for the given datetime."""
+        return self.available_since <= when and (self.available_to is None
+                                                 or when < self.available_to)
+
+    def as_dict(self, channels=True):
+        """Return the record in the catalog's JSON form."""
+        record = {
+            'id': self.id,
+            'name': self.name,
+            'enabled': self.enabled,
+            'supportsDatasets': self.supports_datasets,
+            'availableSince': format_date(self.available_since),
+        }
+        if channels:
+            record['availableChannels'] = list(self.channels)
+        if self.delisted:
+            record['delisted'] = True
+        if self.available_to is not None:
+            record['availableTo'] = format_date(self.available_to)
+        return record
+
+
+def parse_date(value):
+    """Parse an ISO 8601 timestamp; naive ones are taken to be UTC."""
+    if isinstance(value, datetime):
+        when = value
+    else:
+        when = datetime.fromisoformat(value)
+    if when.tzinfo is None:
+        return when.replace(tzinfo=timezone.utc)
+    return when.astimezone(timezone.utc)
+
+
+def format_date(when):
+    """Format a datetime the way the catalog writes them (millisecond precision, 'Z')."""
+    return when.strftime('%Y-%m-%dT%H:%M:%S.') + f'{when.microsecond // 1000:03d}Z'
+
+
+def _field(record, key, kind, where, default=None):
+    if key not in record:
+        if default is not None:
+            return default
+        raise ValueError(f"{where}: missing '{key}'")
+    value = record[key]
+    if not isinstance(value, kind):
+        raise ValueError(f"{where}: '{key}' must be {kind.__name__}, not {type(value).__name__}")
+    return value
+
+
+def _date_field(record, key, where):
+    value = _field(record, key, str, where)
+    try:
+        return parse_date(value)
+    except ValueError:
+        raise ValueError(f"{where}: '{key}' is not an ISO 8601 date: {value!r}") from None
+
+
+def _check_name(value, what, where):
+    """Reject names that cannot be used as (part of) a shard path."""
+    if not value or any(part in ('', '.', '..') for part in value.split('/')):
+        raise ValueError(f"{where}: invalid {what} {value!r}")
+
+
+def make_exchange(record, where='exchange'):
+    """Validate one catalog object and return its Exchange."""
+    if not isinstance(record, dict):
+        raise ValueError(f"{where}: expected an object, not {type(record).__name__}")
+    exchange_id = _field(record, 'id', str, where)
+    if '/' in exchange_id:
+        raise ValueError(f"{where}: invalid id {exchange_id!r}")
+    _check_name(exchange_id, 'id', where)
+    where = f"exchange '{exchange_id}'"
+    channels = _field(record, 'availableChannels', list, where)
+    for channel in channels:
+        if not isinstance(channel, str):
+            raise ValueError(f"{where}: channel names must be strings, not {channel!r}")
+        _check_name(channel, 'channel', where)
+    available_to = None
+    if 'availableTo' in record:
+        available_to = _date_field(record, 'availableTo', where)
+    exchange = Exchange(
+        id=exchange_id,
+        name=_field(record, 'name', str, where),
+        enabled=_field(record, 'enabled', bool, where),
+        supports_datasets=_field(record, 'supportsDatasets', bool, where),
+        available_since=_date_field(record, 'availableSince', where),
+        # Duplicates are a harmless editing slip; the first one wins.
+        channels=tuple(dict.fromkeys(channels)),
+        available_to=available_to,
+        delisted=_field(record, 'delisted', bool, where, default=False),
+    )
+    if available_to is not None and available_to < exchange.available_since:
+        raise ValueError(f"{where}: 'availableTo' is before 'availableSince'")
+    return exchange
+
+
+class Catalog:
+    """The exchanges in catalog order, with lookup indexes built once."""
+
+    __slots__ = ('exchanges', 'by_id', 'by_channel', '_since', '_by_since')
+
+    def __init__(self, exchanges):
+        self.exchanges = tuple(exchanges)
+        self.by_id = {}
+        by_channel = {}
+        for exchange in self.exchanges:
+            if exchange.id in self.by_id:
+                raise ValueError(f"exchange '{exchange.id}' is listed twice")
+            self.by_id[exchange.id] = exchange
+            for channel in exchange.channels:
+                by_channel.setdefault(channel, []).append(exchange)
+        self.by_channel = {channel: tuple(found) for channel, found in by_channel.items()}
+        # Sorted by start date, for bisecting.
+        self._by_since = sorted(self.exchanges, key=lambda exchange: exchange.available_since)
+        self._since = [exchange.available_since for exchange in self._by_since]
+
+    def __len__(self):
+        return len(self.exchanges)
+
+    def __iter__(self):
+        return iter(self.exchanges)
+
+    def get(self, exchange_id):
+        """Return the exchange with the given id, or None."""
+        return self.by_id.get(exchange_id)
+
+    def channels(self):
+        """Return all channel names, sorted."""
+        return sorted(self.by_channel)
+
+    def with_channel(self, channel):
+        """Return the exchanges offering a channel, in catalog order."""
+        return self.by_channel.get(channel, ())
+
+    def added_since(self, when):
+        """Return the exchanges whose data starts at or after when, oldest first."""
+        return self._by_since[bisect.bisect_left(self._since, parse_date(when)):]
+
+    def available_at(self, when):
+        """Return the exchanges with data for the given date, oldest first."""
+        when = parse_date(when)
+        started = self._by_since[:bisect.bisect_right(self._since, when)]
+        return [exchange for exchange in started if exchange.is_available(when)]
+
+
+def parse_catalog(data):
+    """Parse and validate the catalog bytes; raises ValueError."""
+    try:
+        records = parse_json_bytes(data)
+    except ValueError as e:
+        raise ValueError(f"not valid JSON: {e}") from None
+    if not isinstance(records, list):
+        raise ValueError(f"expected an array of exchanges, not {type(records).__name__}")
+    return Catalog(make_exchange(record, f'exchange #{number}')
+                   for number, record in enumerate(records, 1))
+
+
+def load_catalog(path):
+    """Load and validate the catalog file at path; raises ValueError."""
+    with open(path, 'rb') as f:
+        return parse_catalog(f.read())
+
+
+def _dump(value):
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+@register_post_stage('exchanges', order=40)
+def write_shards(ctx):
+    """Write the per-exchange and per-channel shards of the catalog."""
+    conf = ctx['options']['exchanges']
+    if not conf or conf['catalog'] not in ctx['files']:
+        return
+    base = conf['shards']
+    if conf['catalog'] not in ctx['changed']:
+        shards = keep_generated(ctx, base + '/exchange')
+        channels = shards and keep_generated(ctx, base + '/channel')
+        if channels:
+            ctx['summary']['exchange_shards'] = shards + channels
+            return
+    try:
+        catalog = load_catalog(os.path.join(ctx['src_root'], conf['catalog']))
+    except ValueError as e:
+        raise ValueError(f"{conf['catalog']}: {e}") from None
+    for exchange in catalog:
+        emit_file(ctx, f'{base}/exchange/{exchange.id}.json', _dump(exchange.as_dict()))
+    for channel, exchanges in catalog.by_channel.items():
+        emit_file(ctx, f'{base}/channel/{channel}.json',
+                  _dump([exchange.as_dict(channels=False) for exchange in exchanges]))
+    ctx['summary']['exchange_shards'] = len(catalog) + len(catalog.by_channel)
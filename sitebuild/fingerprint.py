@@ -0,0 +1,178 @@
+"""Content-hashed copies of unversioned assets.
+
+The Next.js and Docusaurus bundles and rustdoc's static.files already carry
+content hashes in their names, but the hand-placed images (hero2.png,
+mid-gradient.svg, product_icons/, docs/img/, ...) do not, so they have to be
+revalidated on every visit.  This module gives each of them a copy named
+``<name>.<hash>.<ext>``:
+
+* a pre stage hashes the assets before any file is processed;
+* transform stages point the references in HTML attributes, inline style
+  elements and stylesheets at the copies, and record the assets they used
+  as dependencies, so a page is rebuilt when an asset it refers to changes;
+* a post stage writes the copies and marks them immutable in vercel.json.
+
+The original files are kept: scripts build some asset URLs at run time, and
+the bundles cannot be rewritten without changing their own hashed names.
+"""
+
+import os
+import posixpath
+import re
+from urllib.parse import quote, unquote
+
+from .htmlscan import SRCSET_ATTRIBUTES, page_index, srcset_urls
+from .pipeline import (
+    emit_file, file_type, is_excluded, register_post_stage, register_pre_stage,
+    register_stage,
+)
+from .routes import IMMUTABLE, cache_rule
+
+# A name that already contains a content hash ('main.1cd42d85.js',
+# 'inter-853e0197....ttf', '55c55f0601d81cf3.woff2').
+_HASHED_NAME = re.compile(r'(?:^|[.-])[0-9a-f]{8,}(?=[.-]|$)')
+CSS_URL = re.compile(rb'url\(\s*(["\']?)([^"\')\s]+)\1\s*\)')
+_SCHEME = re.compile(r'[A-Za-z][A-Za-z0-9+.-]*:')
+
+
+def is_hashed(relpath):
+    """Return True if the file name already carries a content hash."""
+    stem = os.path.splitext(posixpath.basename(relpath))[0]
+    return _HASHED_NAME.search(stem) is not None
+
+
+def fingerprinted_path(relpath, digest, length):
+    """Return the path of the hashed copy of relpath ('a/b.png' -> 'a/b.<hash>.png')."""
+    stem, ext = posixpath.splitext(relpath)
+    return f'{stem}.{digest[:length]}{ext}'
+
+
+@register_pre_stage('fingerprint')
+def hash_assets(ctx):
+    """Return {asset relpath: [hashed copy relpath, source hash]}."""
+    conf = ctx['options']['fingerprint']
+    if not conf:
+        return {}
+    assets = {}
+    for relpath in ctx['paths']:
+        if (file_type(relpath, ctx['options']) not in conf['types'] or is_hashed(relpath)
+                or is_excluded(relpath, posixpath.basename(relpath), conf['exclude'])):
+            continue
+        digest = ctx['source_hash'](relpath)
+        if digest is not None:
+            assets[relpath] = [fingerprinted_path(relpath, digest, conf['length']), digest]
+    return assets
+
+
+def resolve(base, url):
+    """Return the root-relative path a URL in file base points at, or None.
+
+    Only local paths are resolved; URLs with a scheme, protocol-relative URLs
+    and bare fragments give None.
+    """
+    path = url.split('#', 1)[0].split('?', 1)[0]
+    if not path or path.startswith('//') or _SCHEME.match(path):
+        return None
+    path = unquote(path)
+    if path.startswith('/'):
+        path = path[1:]
+    else:
+        path = posixpath.join(posixpath.dirname(base), path)
+    path = posixpath.normpath(path)
+    if path.startswith('../') or path in ('.', '..'):
+        return None
+    return path
+
+
+def with_name(url, name):
+    """Return url (text) with its file name replaced by name, keeping the rest."""
+    cut = len(url.split('#', 1)[0].split('?', 1)[0])
+    head = url[:cut].rpartition('/')[0]
+    return (head + '/' if head or url.startswith('/') else '') + quote(name) + url[cut:]
+
+
+def _rewrite(base, url, assets, deps):
+    """Return url pointed at the hashed copy of its target, or None."""
+    try:
+        text = url.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    target = resolve(base, text)
+    if target not in assets:
+        return None
+    copy, digest = assets[target]
+    deps[target] = digest
+    # Keep the URL's own form (relative or absolute, query, fragment) and
+    # only swap the file name.
+    return with_name(text, posixpath.basename(copy)).encode('utf-8')
+
+
+def _css_edits(data, start, end, base, assets, deps):
+    edits = []
+    for match in CSS_URL.finditer(data, start, end):
+        replacement = _rewrite(base, match.group(2), assets, deps)
+        if replacement is not None:
+            edits.append((match.start(2), match.end(2), replacement))
+    return edits
+
+
+def apply_edits(data, edits):
+    """Return data with the (start, end, replacement) edits applied."""
+    out = []
+    pos = 0
+    for start, end, replacement in sorted(edits):
+        out.append(data[pos:start])
+        out.append(replacement)
+        pos = end
+    out.append(data[pos:])
+    return b''.join(out)
+
+
+@register_stage('fingerprint', ('.html', '.htm'), order=50)
+def fingerprint_html(data, ctx):
+    assets = ctx['shared'].get('fingerprint')
+    if not assets:
+        return data
+    index = page_index(data, ctx)
+    base = ctx['path']
+    edits = []
+    for _, attribute, start, end in index.urls:
+        if attribute in SRCSET_ATTRIBUTES:
+            candidates = srcset_urls(data[start:end], start)
+        else:
+            candidates = [(data[start:end], start, end)]
+        for url, url_start, url_end in candidates:
+            replacement = _rewrite(base, bytes(url), assets, ctx['deps'])
+            if replacement is not None:
+                edits.append((url_start, url_end, replacement))
+    for name, start, end in index.raw:
+        if name == b'style':
+            edits += _css_edits(data, start, end, base, assets, ctx['deps'])
+    # Unchanged data keeps the cached index valid for the later stages.
+    return apply_edits(data, edits) if edits else data
+
+
+@register_stage('fingerprint', ('.css',))
+def fingerprint_css(data, ctx):
+    assets = ctx['shared'].get('fingerprint')
+    if not assets:
+        return data
+    edits = _css_edits(data, 0, len(data), ctx['path'], assets, ctx['deps'])
+    return apply_edits(data, edits) if edits else data
+
+
+@register_post_stage('fingerprint', order=30)
+def write_copies(ctx):
+    """Write the hashed copies and cache them as immutable."""
+    assets = ctx['shared'].get('fingerprint')
+    if not assets:
+        return
+    for relpath, (copy, _) in sorted(assets.items()):
+        if relpath not in ctx['files']:
+            continue  # failed to build
+        # A duplicate the dedup stage dropped is read from the file it aliases.
+        source = ctx['files'][relpath].get('alias') or relpath
+        with open(os.path.join(ctx['out_dir'], source), 'rb') as f:
+            emit_file(ctx, copy, f.read())
+        ctx['headers'].append(cache_rule('/' + quote(copy), IMMUTABLE))
+    ctx['summary']['fingerprinted'] = len(assets)
@@ -0,0 +1,366 @@
+"""Font subsetting.
+
+The rustdoc fonts (Fira, SourceSerif4, SourceCodePro, NanumBarunGothic),
+Docusaurus' Inter and the Next.js fonts cover far more of Unicode than the
+site ever shows; NanumBarunGothic alone is 390 KB of Hangul for a site with
+no Korean text.  Every font gets a copy cut down to the characters the site
+uses:
+
+* a pre stage collects the characters every page, stylesheet and script can
+  show (non-ASCII text, character references and escapes), remembering them
+  per source file between builds, and plans one subset per font;
+* transform stages point the references at the subsets: url()s in
+  stylesheets and style elements, preload links, rustdoc's preload script
+  and the font hints in Next's flight data.  They look for the font file
+  extensions rather than scanning the page, and run first, so the page
+  scan the later stages share is made once, of the rewritten page;
+* a post stage writes the subsets and marks them immutable in vercel.json.
+
+One character set is used for the whole site rather than one per family:
+fonts reach text through fallbacks and through script-rendered content
+(rustdoc's search results), and a single set is what makes the subsets of
+the identical fonts in docs/core-latest and docs/core-nightly the same file.
+The set is rounded up to whole Unicode blocks (Basic Latin, Latin-1,
+Latin Extended-A, ...; the big CJK and Hangul blocks and everything past the
+BMP in pages of 256 code points), so it only changes when the site first
+uses a block.  Subsets live in one directory, named after the font and a
+hash of the font and the blocks, so both versions share a single URL.  A
+block new to the site changes every subset and rebuilds the files referring
+to them; characters missing from a subset fall back to the next font in the
+family list.  Subsets are cut on a process pool.
+
+Subsets need the optional fontTools package, and woff2 fonts also brotli;
+without them fonts are left whole.
+"""
+
+import bisect
+import html.entities
+import io
+import logging
+import os
+import posixpath
+import re
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import quote
+
+from .cache import hash_bytes, load_state, save_state
+from .fingerprint import apply_edits, resolve
+from .pipeline import (
+    emit_file, file_type, is_excluded, register_post_stage, register_pre_stage,
+    register_stage,
+)
+from .routes import IMMUTABLE, cache_rule
+
+try:
+    from fontTools import subset as ft_subset
+    from fontTools.ttLib import TTFont
+except ImportError:  # optional dependency
+    ft_subset = None
+else:
+    # Subsetting reports every table it drops and every quirk of the fonts.
+    logging.getLogger('fontTools').setLevel(logging.ERROR)
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+# Prefix of the keys under which the subsets appear in ctx['digests'].
+DIGEST_PREFIX = 'fonts:'
+
+_NON_ASCII = re.compile(rb'[\x80-\xff]+')
+_CHAR_REF = re.compile(rb'&#(?:[xX]([0-9a-fA-F]{1,6})|([0-9]{1,7}))')
+_NAMED_REF = re.compile(rb'&([A-Za-z][A-Za-z0-9]{1,31};?)')
+# \u2014 and \u{1f600} in scripts, \2014 in stylesheets.
+_ESCAPE = re.compile(rb'\\u\{([0-9a-fA-F]{1,6})\}|\\u([0-9a-fA-F]{4})|\\([0-9a-fA-F]{1,6})')
+_RANGE = re.compile(r'[Uu]\+([0-9a-fA-F]{1,6})(?:-([0-9a-fA-F]{1,6}))?$')
+
+# Where the Unicode blocks of the BMP start (see Blocks.txt); code points
+# between two starts round up to the whole span.
+_BLOCK_STARTS = (
+    0x0000, 0x0080, 0x0100, 0x0180, 0x0250, 0x02B0, 0x0300, 0x0370, 0x0400, 0x0500,
+    0x0530, 0x0590, 0x0600, 0x0700, 0x0750, 0x0780, 0x07C0, 0x0800, 0x0840, 0x0860,
+    0x0870, 0x08A0, 0x0900, 0x0980, 0x0A00, 0x0A80, 0x0B00, 0x0B80, 0x0C00, 0x0C80,
+    0x0D00, 0x0D80, 0x0E00, 0x0E80, 0x0F00, 0x1000, 0x10A0, 0x1100, 0x1200, 0x1380,
+    0x13A0, 0x1400, 0x1680, 0x16A0, 0x1700, 0x1720, 0x1740, 0x1760, 0x1780, 0x1800,
+    0x18B0, 0x1900, 0x1950, 0x1980, 0x19E0, 0x1A00, 0x1A20, 0x1AB0, 0x1B00, 0x1B80,
+    0x1BC0, 0x1C00, 0x1C50, 0x1C80, 0x1C90, 0x1CC0, 0x1CD0, 0x1D00, 0x1D80, 0x1DC0,
+    0x1E00, 0x1F00, 0x2000, 0x2070, 0x20A0, 0x20D0, 0x2100, 0x2150, 0x2190, 0x2200,
+    0x2300, 0x2400, 0x2440, 0x2460, 0x2500, 0x2580, 0x25A0, 0x2600, 0x2700, 0x27C0,
+    0x27F0, 0x2800, 0x2900, 0x2980, 0x2A00, 0x2B00, 0x2C00, 0x2C60, 0x2C80, 0x2D00,
+    0x2D30, 0x2D80, 0x2DE0, 0x2E00, 0x2E80, 0x2F00, 0x2FF0, 0x3000, 0x3040, 0x30A0,
+    0x3100, 0x3130, 0x3190, 0x31A0, 0x31C0, 0x31F0, 0x3200, 0x3300, 0x3400, 0x4DC0,
+    0x4E00, 0xA000, 0xA490, 0xA4D0, 0xA500, 0xA640, 0xA6A0, 0xA700, 0xA720, 0xA800,
+    0xA830, 0xA840, 0xA880, 0xA8E0, 0xA900, 0xA930, 0xA960, 0xA980, 0xA9E0, 0xAA00,
+    0xAA60, 0xAA80, 0xAAE0, 0xAB00, 0xAB30, 0xAB70, 0xABC0, 0xAC00, 0xD7B0, 0xD800,
+    0xE000, 0xF900, 0xFB00, 0xFB50, 0xFE00, 0xFE10, 0xFE20, 0xFE30, 0xFE50, 0xFE70,
+    0xFF00, 0xFFF0, 0x10000,
+)
+# Blocks bigger than this (CJK, Hangul syllables, private use) and the planes
+# past the BMP are rounded to pages of this many code points instead.
+_PAGE = 256
+
+# The end of a font URL: in attributes, url()s, and strings in scripts
+# (Next's ':HL[\\"/_next/...woff2\\",\\"font\\"]').
+_FONT_EXT = re.compile(rb'\.(?:woff2?|ttf|otf)(?=[?#"\'()\s<>,;&\\`]|$)')
+# Bytes that cannot be part of such a URL; they mark where it starts.
+_URL_START = frozenset(b'"\'()\t\n\r\f <>,;=&\\`')
+# rustdoc's preload script: "a.woff2,b.woff2".split(",").map(f=>`<link ... href="../static.files/${f}">`)
+_RUSTDOC_PRELOAD = re.compile(rb'"([^"]*)"\.split\(","\)\.map\(f=>`[^`$]*href="([^"`$]*)\$\{f\}')
+
+
+def subset_types(requested):
+    """Return the requested font types this interpreter can subset."""
+    if ft_subset is None:
+        return []
+    return [ext for ext in requested if ext != '.woff2' or brotli is not None]
+
+
+def parse_ranges(ranges):
+    """Return the code points of CSS unicode-range style ranges ('U+0020-007E')."""
+    points = set()
+    for text in ranges:
+        match = _RANGE.match(text.strip())
+        if match is None:
+            raise ValueError(f"bad unicode range {text!r}")
+        first = int(match.group(1), 16)
+        last = int(match.group(2), 16) if match.group(2) else first
+        points.update(range(first, last + 1))
+    return points
+
+
+def _valid(point):
+    return 0x80 <= point <= 0x10ffff and not 0xd800 <= point <= 0xdfff
+
+
+def block_of(point):
+    """Return the (first, last) code points of the block point is rounded up to."""
+    i = bisect.bisect_right(_BLOCK_STARTS, point) - 1
+    if i + 1 < len(_BLOCK_STARTS):
+        first, end = _BLOCK_STARTS[i], _BLOCK_STARTS[i + 1]
+        if end - first <= _PAGE:
+            return first, end - 1
+    first = point - point % _PAGE
+    return first, min(first + _PAGE, 0x110000) - 1
+
+
+def round_to_blocks(points):
+    """Return the blocks (sorted (first, last) pairs) covering points."""
+    return sorted({block_of(point) for point in points})
+
+
+def characters(data):
+    """Return the non-ASCII code points a file can put on screen.
+
+    Deliberately generous: markup, code and comments count as well, and a
+    stray escape adds a character nothing shows.  ASCII is left to the
+    'always' option.
+    """
+    points = {ord(char) for char in b''.join(_NON_ASCII.findall(data)).decode('utf-8', 'ignore')}
+    for hex_digits, digits in _CHAR_REF.findall(data):
+        points.add(int(hex_digits, 16) if hex_digits else int(digits))
+    if b'&' in data:
+        for name in set(_NAMED_REF.findall(data)):
+            text = html.entities.html5.get(name.decode('ascii'))
+            if text is not None:
+                points.update(map(ord, text))
+    for groups in _ESCAPE.findall(data):
+        points.add(int(next(group for group in groups if group), 16))
+    return {point for point in points if _valid(point)}
+
+
+def site_characters(ctx, types):
+    """Return the code points used by the source files of the given types.
+
+    What was found in each file is kept in the output directory with the
+    file's hash, so only new and changed files are read again.
+    """
+    state = (load_state(ctx['out_dir'], 'fonts') if ctx['out_dir'] else None) or {}
+    found = set()
+    scanned = {}
+    for relpath in ctx['paths']:
+        if file_type(relpath, ctx['options']) not in types:
+            continue
+        digest = ctx['source_hash'](relpath)
+        if digest is None:
+            continue
+        entry = state.get(relpath)
+        if entry is None or entry[0] != digest:
+            with open(os.path.join(ctx['src_root'], relpath), 'rb') as f:
+                entry = [digest, ''.join(map(chr, sorted(characters(f.read()))))]
+        scanned[relpath] = entry
+        found.update(map(ord, entry[1]))
+    if ctx['out_dir']:
+        save_state(ctx['out_dir'], 'fonts', scanned)
+    return found
+
+
+def subset_path(directory, relpath, digest):
+    """Return the path of a font's subset ('a/Fira.woff2' -> '<dir>/Fira.<hash>.woff2')."""
+    stem, ext = posixpath.splitext(posixpath.basename(relpath))
+    return f'{directory}/{stem}.{digest[:10]}{ext}'
+
+
+@register_pre_stage('fonts')
+def plan_subsets(ctx):
+    """Return {'unicodes': [code point], 'subsets': {font relpath: subset relpath}}."""
+    conf = ctx['options']['fonts']
+    types = subset_types(conf['types']) if conf else []
+    if not types:
+        return {}
+    fonts = [relpath for relpath in ctx['paths']
+             if file_type(relpath, ctx['options']) in types
+             and not is_excluded(relpath, posixpath.basename(relpath), conf['exclude'])]
+    if not fonts:
+        return {}
+    blocks = round_to_blocks(parse_ranges(conf['always']) | site_characters(ctx, conf['scan']))
+    unicodes = [point for first, last in blocks for point in range(first, last + 1)
+                if _valid(point) or point < 0x80]
+    # Only the blocks name the subsets, so a new character in a block the
+    # site already uses renames (and rebuilds) nothing.
+    charset = hash_bytes(','.join(f'{first:x}-{last:x}' for first, last in blocks)
+                         .encode('ascii'))
+    subsets = {}
+    for relpath in fonts:
+        digest = ctx['source_hash'](relpath)
+        if digest is None:
+            continue
+        subsets[relpath] = subset_path(conf['dir'].strip('/'), relpath,
+                                       hash_bytes((digest + charset).encode('ascii')))
+        ctx['digests'][DIGEST_PREFIX + relpath] = subsets[relpath]
+    return {'unicodes': unicodes, 'subsets': subsets}
+
+
+def _subset_url(target, url, plan, deps):
+    """Return url (text) pointed at the subset of target, or None."""
+    subsets = plan['subsets']
+    if target not in subsets:
+        return None
+    deps[DIGEST_PREFIX + target] = subsets[target]
+    # The subsets share one directory, so the URL becomes root-relative.
+    cut = len(url.split('#', 1)[0].split('?', 1)[0])
+    return '/' + quote(subsets[target]) + url[cut:]
+
+
+def _rewrite(base, url, plan, deps):
+    try:
+        text = url.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    replacement = _subset_url(resolve(base, text), text, plan, deps)
+    return replacement.encode('utf-8') if replacement is not None else None
+
+
+def _font_urls(data, start, end):
+    """Yield the (start, end) spans of font URLs in data[start:end]."""
+    for match in _FONT_EXT.finditer(data, start, end):
+        begin = match.start()
+        while begin > start and data[begin - 1] not in _URL_START:
+            begin -= 1
+        if begin < match.start():
+            yield begin, match.end()
+
+
+def font_edits(data, base, plan, deps):
+    """Return the edits pointing the font URLs in data at their subsets."""
+    edits = []
+    lists = []
+    for match in _RUSTDOC_PRELOAD.finditer(data):
+        lists.append((match.start(1), match.end(1)))
+        prefix = match.group(2).decode('utf-8', 'replace')
+        originals = [prefix + name for name in match.group(1).decode('utf-8', 'replace').split(',')]
+        urls = [_subset_url(resolve(base, url), url, plan, deps) or url for url in originals]
+        if urls != originals:
+            # The list now holds whole URLs, so the template loses its prefix.
+            edits.append((match.start(1), match.end(1), ','.join(urls).encode('utf-8')))
+            edits.append((match.start(2), match.end(2), b''))
+    for start, end in _font_urls(data, 0, len(data)):
+        if any(first <= start < last for first, last in lists):
+            continue
+        replacement = _rewrite(base, bytes(data[start:end]), plan, deps)
+        if replacement is not None:
+            edits.append((start, end, replacement))
+    return edits
+
+
+@register_stage('fonts', ('.html', '.htm', '.css'), order=5)
+def subset_fonts(data, ctx):
+    plan = ctx['shared'].get('fonts')
+    if not plan:
+        return data
+    edits = font_edits(data, ctx['path'], plan, ctx['deps'])
+    return apply_edits(data, edits) if edits else data
+
+
+def _subset_task(task):
+    try:
+        return subset_font(*task)
+    except Exception as e:
+        return e
+
+
+def _run_tasks(tasks, jobs):
+    # Subsetting is pure CPU work, minutes for the big CJK fonts, so it runs
+    # on a pool of its own rather than one font after the other.
+    if len(tasks) <= 1 or jobs == 1:
+        return [_subset_task(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=jobs or None) as pool:
+        return list(pool.map(_subset_task, tasks))
+
+
+def subset_font(path, unicodes):
+    """Return the font at path cut down to unicodes, in its own format."""
+    font = TTFont(path)
+    options = ft_subset.Options()
+    options.flavor = font.flavor
+    # Keep every OpenType feature (kerning, ligatures, tabular figures) and
+    # the name table, only drop glyphs.
+    options.layout_features = ['*']
+    options.name_IDs = ['*']
+    options.name_languages = ['*']
+    options.notdef_outline = True
+    subsetter = ft_subset.Subsetter(options)
+    subsetter.populate(unicodes=unicodes)
+    subsetter.subset(font)
+    buf = io.BytesIO()
+    ft_subset.save_font(font, buf, options)
+    return buf.getvalue()
+
+
+@register_post_stage('fonts', order=35)
+def write_subsets(ctx):
+    """Write the planned subsets and cache them as immutable."""
+    plan = ctx['shared'].get('fonts')
+    if not plan:
+        return
+    seen = set()
+    todo = {}
+    for relpath, path in sorted(plan['subsets'].items()):
+        if path in seen:
+            continue  # the same font elsewhere in the tree
+        seen.add(path)
+        previous = ctx['previous'].get(path)
+        if (previous is not None and previous.get('generated')
+                and os.path.exists(os.path.join(ctx['out_dir'], path))):
+            # The name encodes the font and the character blocks.
+            ctx['files'][path] = previous
+        else:
+            todo[path] = relpath
+    tasks = [(os.path.join(ctx['src_root'], relpath), plan['unicodes'])
+             for relpath in todo.values()]
+    for path, data in zip(todo, _run_tasks(tasks, ctx['options']['jobs'])):
+        if isinstance(data, Exception):
+            # The references already point here; serve the whole font.
+            print(f"    Warning: Cannot subset font {todo[path]}: {data}")
+            with open(os.path.join(ctx['src_root'], todo[path]), 'rb') as f:
+                data = f.read()
+        emit_file(ctx, path, data)
+    written = {}
+    for relpath, path in sorted(plan['subsets'].items()):
+        if path in written:
+            continue
+        ctx['headers'].append(cache_rule('/' + quote(path), IMMUTABLE))
+        written[path] = (os.path.getsize(os.path.join(ctx['src_root'], relpath))
+                         - ctx['files'][path]['out_size'])
+    ctx['summary']['fonts_subset'] = len(written)
+    ctx['summary']['fonts_saved'] = sum(written.values())
@@ -0,0 +1,261 @@
+"""Preload and prefetch hints.
+
+The Next.js pages preload nothing they actually render first (their image
+preloads point at the /_next/image optimizer, which the static site does
+not have) and give the browser no idea where a visitor goes next.  For the
+pages matching the 'pages' option:
+
+* a pre stage reads the <a href> links of every such page into a link
+  graph and ranks the pages each one links to by how many pages link to
+  them (then by how often and how early the page itself links to them);
+  the top 'prefetch' become the page's prefetch list;
+* a transform stage, running after critical CSS, adds to the head
+  - a preload for the hero image: the largest of the first few <img>
+    elements that is not lazy-loaded, with its srcset, or the best format
+    of its <picture>;
+  - a preload for the web fonts covering Latin text among the @font-face
+    rules the critical CSS inlined;
+  - a preload for the first script bundle, when it is not in the head
+    already (the Next.js chunks are);
+  - a prefetch for every page on the prefetch list.
+
+Nothing is added that the page already preloads or links as a stylesheet.
+Each page's prefetch list has a digest, so a page is rebuilt when the rest
+of the site changes its list.
+"""
+
+import os
+import posixpath
+import re
+
+from .cache import hash_bytes
+from .fingerprint import apply_edits, resolve
+from .htmlscan import attributes, page_index
+from .links import INDEX_PAGES
+from .pipeline import (
+    file_type, is_excluded, register_post_stage, register_pre_stage, register_stage,
+)
+from .search import page_url
+
+# Prefix of the keys under which the prefetch lists appear in ctx['digests'].
+DIGEST_PREFIX = 'hints:'
+
+PAGE_TYPES = ('.html', '.htm')
+
+_FONT_FACE = re.compile(rb'@font-face\s*\{([^}]*)\}', re.IGNORECASE)
+_FONT_SRC = re.compile(rb'url\(\s*(["\']?)([^"\')\s]+\.woff2)\1\s*\)')
+_UNICODE_RANGE = re.compile(rb'unicode-range\s*:\s*([^;}]+)', re.IGNORECASE)
+_RANGE = re.compile(rb'u\+([0-9a-f?]{1,6})(?:-([0-9a-f]{1,6}))?', re.IGNORECASE)
+# The character a font must cover to count as the one for Latin text.
+_LATIN = ord('A')
+
+
+def in_scope(relpath, conf):
+    name = posixpath.basename(relpath)
+    return (is_excluded(relpath, name, conf['pages'])
+            and not is_excluded(relpath, name, conf['exclude']))
+
+
+def _page_of(target, pages):
+    """Return the page target (a link resolved with fingerprint.resolve) is, or None."""
+    if target in pages:
+        return target
+    head, _, name = target.rpartition('/')
+    # Links to the index page of a directory, under either name, or to
+    # the directory itself.
+    if name in INDEX_PAGES:
+        candidates = [posixpath.join(head, index) for index in INDEX_PAGES]
+    else:
+        candidates = [posixpath.join(target, index) for index in INDEX_PAGES]
+    for candidate in candidates:
+        if candidate in pages:
+            return candidate
+    return None
+
+
+def anchor_links(data, relpath, pages):
+    """Return {page: (times linked, position of the first link)} for a page's <a> links."""
+    links = {}
+    for tag, attribute, start, end in page_index(data).urls:
+        if tag.name != b'a' or attribute != b'href':
+            continue
+        try:
+            target = resolve(relpath, bytes(data[start:end]).decode('utf-8'))
+        except UnicodeDecodeError:
+            continue
+        page = _page_of(target, pages) if target is not None else None
+        if page is None or page == relpath:
+            continue
+        count, first = links.get(page, (0, start))
+        links[page] = (count + 1, first)
+    return links
+
+
+def rank_links(graph, limit):
+    """Return {page: [the limit pages it is most likely left for]}."""
+    inbound = {}
+    for links in graph.values():
+        for target in links:
+            inbound[target] = inbound.get(target, 0) + 1
+    return {page: sorted(links, key=lambda target: (-inbound[target], -links[target][0],
+                                                    links[target][1]))[:limit]
+            for page, links in graph.items()}
+
+
+@register_pre_stage('hints')
+def plan_prefetch(ctx):
+    """Return {page: [page it prefetches]} and publish a digest of each list."""
+    conf = ctx['options']['hints']
+    if not conf or not conf['prefetch']:
+        return {}
+    pages = {relpath for relpath in ctx['paths']
+             if file_type(relpath, ctx['options']) in PAGE_TYPES and in_scope(relpath, conf)}
+    graph = {}
+    for relpath in sorted(pages):
+        try:
+            with open(os.path.join(ctx['src_root'], relpath), 'rb') as f:
+                graph[relpath] = anchor_links(f.read(), relpath, pages)
+        except OSError as e:
+            print(f"    Warning: Cannot read {relpath} for prefetch hints: {e}")
+    plan = rank_links(graph, conf['prefetch'])
+    for relpath, targets in plan.items():
+        ctx['digests'][DIGEST_PREFIX + relpath] = hash_bytes('\n'.join(targets).encode('utf-8'))
+    return plan
+
+
+def _area(attrs):
+    try:
+        return int(attrs.get(b'width', b'0')) * int(attrs.get(b'height', b'0'))
+    except ValueError:
+        return 0
+
+
+def hero_image(data, index, conf):
+    """Return the attributes of the hero image's preload, or None."""
+    body = index.first(b'body')
+    pictures = index.elements(b'picture')
+    best = None
+    candidates = [tag for tag in index.find_all(b'img')
+                  if body is None or tag.start > body.start][:conf['hero_candidates']]
+    for tag in candidates:
+        attrs = attributes(data, tag)
+        if attrs.get(b'loading', b'').lower() == b'lazy' or not attrs.get(b'src'):
+            continue
+        area = _area(attrs)
+        if area >= conf['hero_min_area'] and (best is None or area > best[0]):
+            best = (area, tag, attrs)
+    if best is None:
+        return None
+    _, tag, attrs = best
+    hint = [(b'as', b'image'), (b'href', attrs[b'src'])]
+    for picture, content_end, _ in pictures:
+        if picture.start < tag.start < content_end:
+            sources = [source for source in index.find_all(b'source')
+                       if picture.start < source.start < tag.start]
+            if sources:
+                # The first source is the format the browser picks when it
+                # supports it; one that does not skips a typed preload.
+                source = attributes(data, sources[0])
+                hint = [(b'as', b'image'), (b'imagesrcset', source.get(b'srcset', b''))]
+                attrs = source
+                if source.get(b'type'):
+                    hint.append((b'type', source[b'type']))
+            break
+    else:
+        if attrs.get(b'srcset'):
+            hint.append((b'imagesrcset', attrs[b'srcset']))
+    if attrs.get(b'sizes'):
+        hint.append((b'imagesizes', attrs[b'sizes']))
+    return hint
+
+
+def _covers(ranges, point):
+    for match in _RANGE.finditer(ranges):
+        first = match.group(1)
+        if b'?' in first:
+            low, high = int(first.replace(b'?', b'0'), 16), int(first.replace(b'?', b'f'), 16)
+        else:
+            low = int(first, 16)
+            high = int(match.group(2), 16) if match.group(2) else low
+        if low <= point <= high:
+            return True
+    return False
+
+
+def latin_fonts(data, index, head_end):
+    """Return the woff2 URLs of the inlined @font-face rules that cover Latin text."""
+    urls = []
+    for name, start, end in index.raw:
+        if name != b'style' or start > head_end:
+            continue
+        for face in _FONT_FACE.finditer(data, start, end):
+            block = face.group(1)
+            src = _FONT_SRC.search(block)
+            ranges = _UNICODE_RANGE.search(block)
+            if src and (ranges is None or _covers(ranges.group(1), _LATIN)):
+                urls.append(src.group(2))
+    return urls
+
+
+def _link(rel, attrs):
+    parts = [b'<link rel="' + rel + b'"']
+    for name, value in attrs:
+        parts.append(b' ' + name if value is None else b' ' + name + b'="' + value + b'"')
+    return b''.join(parts) + b'>'
+
+
+@register_stage('hints', PAGE_TYPES, order=97)
+def add_hints(data, ctx):
+    conf = ctx['options']['hints']
+    if not conf or not in_scope(ctx['path'], conf):
+        return data
+    index = page_index(data, ctx)
+    head_end = index.head_end
+    if head_end is None:
+        return data
+    # What the head already loads, by URL.
+    present = set()
+    for tag in index.find_all(b'link'):
+        if tag.start < head_end:
+            attrs = attributes(data, tag)
+            present.update(attrs.get(name) for name in (b'href', b'imagesrcset'))
+
+    hints = []
+    hero = hero_image(data, index, conf) if conf['hero_candidates'] else None
+    if hero is not None and not present.intersection(
+            value for name, value in hero if name in (b'href', b'imagesrcset')):
+        hints.append(_link(b'preload', hero))
+    for url in latin_fonts(data, index, head_end)[:conf['fonts']]:
+        if url not in present:
+            hints.append(_link(b'preload', [(b'as', b'font'), (b'type', b'font/woff2'),
+                                            (b'href', url), (b'crossorigin', None)]))
+    if conf['script']:
+        first = next((tag for tag in index.scripts if b'src' in attributes(data, tag)), None)
+        # A script in the head is found as early as a preload would be.
+        if first is not None and first.start > head_end:
+            src = attributes(data, first)[b'src']
+            if src not in present:
+                hints.append(_link(b'preload', [(b'as', b'script'), (b'href', src)]))
+    preloads = len(hints)
+    targets = ctx['shared'].get('hints', {}).get(ctx['path'])
+    if targets is not None:
+        key = DIGEST_PREFIX + ctx['path']
+        ctx['deps'][key] = hash_bytes('\n'.join(targets).encode('utf-8'))
+        for target in targets:
+            url = page_url(target).encode('utf-8')
+            if url not in present:
+                hints.append(_link(b'prefetch', [(b'href', url)]))
+    if not hints:
+        return data
+    ctx['facts']['hints'] = [preloads, len(hints) - preloads]
+    return apply_edits(data, [(head_end, head_end, b''.join(hints))])
+
+
+@register_post_stage('hints', order=55)
+def count_hints(ctx):
+    facts = ctx['facts'].get('hints', {})
+    pages = [fact for path, fact in facts.items() if path in ctx['files']]
+    if pages:
+        ctx['summary']['hint_pages'] = len(pages)
+        ctx['summary']['hint_preloads'] = sum(fact[0] for fact in pages)
+        ctx['summary']['hint_prefetches'] = sum(fact[1] for fact in pages)
@@ -0,0 +1,262 @@
+"""Single-pass HTML tokenizer.
+
+scan() walks a page once and records where its comments, raw-text element
+contents, and the start and end tags of the elements the build cares about
+are.  The transform stages (minification, search extraction, asset rewriting,
+link checking) work from this index instead of rescanning the page for each
+thing they look for, so the work per page stays linear in its size.
+
+Only the elements in START_TAGS and END_TAGS are indexed; other tags are
+consumed inside the regular expression engine, which keeps the scan fast on
+rustdoc pages with tens of thousands of spans.  End tags are only indexed for
+elements whose extent is needed (see PageIndex.elements).
+
+Pages are handled as bytes and every position is a byte offset into the
+scanned data.  page_index() caches the index on the stage ctx for as long as
+stages pass the same data object along, so consecutive stages that do not
+modify the page share one scan.
+"""
+
+import re
+
+# Elements whose contents are text, not markup.
+RAW_TEXT = (b'script', b'style', b'textarea', b'title')
+
+# Elements whose extent is tracked, so both their start and end tags are indexed.
+END_TAGS = (
+    b'article', b'audio', b'body', b'button', b'footer', b'form', b'h1', b'h2', b'h3',
+    b'head', b'html', b'main', b'nav', b'noscript', b'object', b'picture', b'pre', b'svg',
+    b'video',
+) + RAW_TEXT
+
+# Elements whose start tags are indexed: the above, plus those that refer to
+# other files.
+START_TAGS = END_TAGS + (
+    b'a', b'area', b'base', b'embed', b'iframe', b'image', b'img', b'input', b'link',
+    b'meta', b'source', b'track', b'use',
+)
+
+# Attributes holding URLs; srcset-style ones hold a list of candidates.
+URL_ATTRIBUTES = frozenset((
+    b'href', b'src', b'srcset', b'imagesrcset', b'poster', b'data', b'action',
+    b'formaction', b'xlink:href',
+))
+SRCSET_ATTRIBUTES = frozenset((b'srcset', b'imagesrcset'))
+
+# Quotes only delimit attribute values after '='; a stray quote elsewhere in
+# a tag is an ordinary character, as it is to browsers.
+_ATTR_TEXT = rb'(?:[^>=]++|=\s*+(?:"[^"]*+"|\'[^\']*+\')?)*+'
+_ATTRS = b'(' + _ATTR_TEXT + b')'
+# One match per indexed token.  Text and tags that are not indexed are
+# consumed by the possessive prefix, so they never reach Python.
+_TOKEN = re.compile(
+    rb'(?:[^<]++|<(?!!--|(?:' + b'|'.join(START_TAGS) + rb')[\s/>]'
+    rb'|/(?:' + b'|'.join(END_TAGS) + rb')[\s>])'
+    rb'(?:/?[A-Za-z]' + _ATTR_TEXT + rb'>?|[!?][^>]*+>?)?)*+'
+    rb'(?:(<!--).*?(?:-->|\Z)'                                        # 1: comment
+    rb'|<(' + b'|'.join(RAW_TEXT) + rb')(?=[\s/>])' + _ATTRS           # 2: name, 3: attrs
+    + rb'>(.*?)(</\2\s*>|\Z)'                                          # 4: text, 5: end tag
+    rb'|<(/?)(' + b'|'.join(START_TAGS) + rb')(?=[\s/>])' + _ATTRS + rb'>'  # 6, 7, 8
+    rb'|\Z)',
+    re.DOTALL | re.IGNORECASE)
+_ATTR = re.compile(
+    rb'([^\s"\'<>/=]+)(?:\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'=<>`]+)))?')
+# Cheap pre-check so tags without URL attributes are not parsed.
+_URL_HINT = re.compile(rb'(?:href|src|srcset|poster|data|action)\s*=', re.IGNORECASE)
+_END_TAGS = frozenset(END_TAGS)
+
+
+class Tag:
+    """A start tag: name (lowercase bytes), byte span and attribute span."""
+
+    __slots__ = ('name', 'start', 'end', 'attrs_start', 'attrs_end')
+
+    def __init__(self, name, start, end, attrs_start, attrs_end):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.attrs_start = attrs_start
+        self.attrs_end = attrs_end
+
+    def __repr__(self):
+        return f'<Tag {self.name.decode()} {self.start}:{self.end}>'
+
+
+class PageIndex:
+    """Structural index of one HTML page.
+
+    tags      indexed start tags, in document order
+    closes    (name, start, end) for indexed end tags
+    comments  (start, end) for every comment
+    raw       (name, start, end) content spans of script/style/textarea/title
+    """
+
+    __slots__ = ('data', 'size', 'tags', 'closes', 'comments', 'raw', '_urls')
+
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data)
+        self.tags = []
+        self.closes = []
+        self.comments = []
+        self.raw = []
+        self._urls = None
+
+    def first(self, name):
+        """Return the first start tag called name, or None."""
+        for tag in self.tags:
+            if tag.name == name:
+                return tag
+        return None
+
+    def find_all(self, name):
+        return [tag for tag in self.tags if tag.name == name]
+
+    def first_close(self, name):
+        """Return the start offset of the first end tag called name, or None."""
+        for close_name, start, _ in self.closes:
+            if close_name == name:
+                return start
+        return None
+
+    def last_close(self, name):
+        """Return the start offset of the last end tag called name, or None."""
+        for close_name, start, _ in reversed(self.closes):
+            if close_name == name:
+                return start
+        return None
+
+    def elements(self, *names):
+        """Return (start tag, content end, element end) for elements called names.
+
+        names must be in END_TAGS.  Start and end tags are matched per name
+        with a stack; elements that are never closed run to the end of the page.
+        """
+        wanted = set(names)
+        events = [(tag.start, tag) for tag in self.tags if tag.name in wanted]
+        events += [(close[1], close) for close in self.closes if close[0] in wanted]
+        events.sort(key=lambda event: event[0])
+        stacks = {}
+        spans = []
+        for _, item in events:
+            if isinstance(item, Tag):
+                stacks.setdefault(item.name, []).append(item)
+            elif stacks.get(item[0]):
+                spans.append((stacks[item[0]].pop(), item[1], item[2]))
+        for stack in stacks.values():
+            spans.extend((tag, self.size, self.size) for tag in stack)
+        spans.sort(key=lambda span: span[0].start)
+        return spans
+
+    @property
+    def urls(self):
+        """(tag, attribute, start, end) value spans of URL attributes.
+
+        Parsed on first use; most stages never need them.
+        """
+        if self._urls is None:
+            self._urls = []
+            for tag in self.tags:
+                if _URL_HINT.search(self.data, tag.attrs_start, tag.attrs_end):
+                    for name, start, end in _attribute_spans(self.data, tag):
+                        if name in URL_ATTRIBUTES:
+                            self._urls.append((tag, name, start, end))
+        return self._urls
+
+    @property
+    def title(self):
+        """Content span of the <title> element, or None."""
+        for name, start, end in self.raw:
+            if name == b'title':
+                return start, end
+        return None
+
+    @property
+    def head_end(self):
+        """Offset of </head> (where head content can be inserted), or None."""
+        return self.first_close(b'head')
+
+    @property
+    def body_end(self):
+        """Offset of the last </body>, or None."""
+        return self.last_close(b'body')
+
+    @property
+    def scripts(self):
+        return self.find_all(b'script')
+
+    @property
+    def stylesheets(self):
+        """<link rel="stylesheet"> tags."""
+        return [tag for tag in self.find_all(b'link')
+                if b'stylesheet' in attributes(self.data, tag).get(b'rel', b'').lower().split()]
+
+    @property
+    def navs(self):
+        return self.find_all(b'nav')
+
+
+def _attribute_spans(data, tag):
+    """Yield (lowercase name, value start, value end) for a tag's attributes."""
+    for match in _ATTR.finditer(data, tag.attrs_start, tag.attrs_end):
+        for group in (2, 3, 4):
+            if match.group(group) is not None:
+                yield match.group(1).lower(), match.start(group), match.end(group)
+                break
+        else:
+            yield match.group(1).lower(), match.end(), match.end()
+
+
+def attributes(data, tag):
+    """Return the attributes of a start tag as a dict of lowercase name -> value."""
+    attrs = {}
+    for name, start, end in _attribute_spans(data, tag):
+        attrs.setdefault(name, bytes(data[start:end]))
+    return attrs
+
+
+def srcset_urls(value, offset=0):
+    """Yield (url, start, end) for the candidates of a srcset value."""
+    for match in re.finditer(rb'\s*([^\s,]+)(?:\s+[^,]*)?(?:,|$)', value):
+        yield match.group(1), offset + match.start(1), offset + match.end(1)
+
+
+def scan(data):
+    """Tokenize an HTML page in one pass and return its PageIndex."""
+    index = PageIndex(data)
+    tags = index.tags
+    closes = index.closes
+    for match in _TOKEN.finditer(data):
+        name = match.group(7)
+        if name is not None:
+            name = name.lower()
+            start = match.start(6) - 1
+            if match.group(6):
+                if name in _END_TAGS:
+                    closes.append((name, start, match.end()))
+                continue
+            tags.append(Tag(name, start, match.end(), match.start(8), match.end(8)))
+            continue
+        name = match.group(2)
+        if name is not None:
+            name = name.lower()
+            tags.append(Tag(name, match.start(2) - 1, match.end(3) + 1,
+                            match.start(3), match.end(3)))
+            index.raw.append((name, match.start(4), match.end(4)))
+            if match.end(5) > match.start(5):
+                closes.append((name, match.start(5), match.end(5)))
+        elif match.group(1) is not None:
+            index.comments.append((match.start(1), match.end()))
+    return index
+
+
+def page_index(data, ctx=None):
+    """Return the PageIndex for data, reusing the one cached on ctx if current."""
+    if ctx is not None:
+        cached = ctx.get('html_index')
+        if cached is not None and cached.data is data:
+            return cached
+    index = scan(data)
+    if ctx is not None:
+        ctx['html_index'] = index
+    return index
@@ -0,0 +1,273 @@
+"""Image checks and responsive image variants.
+
+Every image the build writes has its real format sniffed from its first
+bytes.  After the build, images whose content does not match their extension
+(favicon.ico, docs/img/shell.ico and docs/img/nt-white-large.webp are all
+PNG files) are reported and served with their real Content-Type, and
+byte-identical images (shell.ico and nt-white-large.webp) are reported so
+they can be merged.
+
+Large PNG and JPEG files additionally get resized WebP/AVIF variants:
+
+* a pre stage plans the variants (widths up to the image's own width);
+* transform stages wrap <img> elements in <picture> with a <source> per
+  format, and add an image-set() fallback chain after CSS declarations
+  that use the image;
+* a post stage encodes the variants and marks them immutable.
+
+Variants need the optional Pillow package; without it only the checks run.
+"""
+
+import io
+import os
+import posixpath
+from urllib.parse import quote
+
+from .fingerprint import CSS_URL, apply_edits, resolve, with_name
+from .htmlscan import attributes, page_index
+from .pipeline import (
+    emit_file, file_type, register_output_stage, register_post_stage, register_pre_stage,
+    register_stage,
+)
+from .routes import IMMUTABLE, cache_rule
+
+try:
+    from PIL import Image, features
+except ImportError:  # optional dependency
+    Image = None
+
+SNIFF_BYTES = 32
+
+MIME_TYPES = {
+    '.png': 'image/png', '.jpg': 'image/jpeg', '.gif': 'image/gif', '.webp': 'image/webp',
+    '.avif': 'image/avif', '.ico': 'image/x-icon', '.bmp': 'image/bmp',
+}
+# Extensions that name the same format.
+_ALIASES = {'.jpeg': '.jpg'}
+
+# Formats variants can be written in, best first.
+FORMATS = ('avif', 'webp')
+
+
+def sniff(head):
+    """Return the extension matching an image's leading bytes, or None."""
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return '.png'
+    if head.startswith(b'\xff\xd8\xff'):
+        return '.jpg'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return '.gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return '.webp'
+    if head[4:8] == b'ftyp' and head[8:12] in (b'avif', b'avis'):
+        return '.avif'
+    if head[:4] == b'\x00\x00\x01\x00':
+        return '.ico'
+    if head[:2] == b'BM':
+        return '.bmp'
+    return None
+
+
+def available_formats(requested):
+    """Return the requested variant formats this interpreter can encode."""
+    if Image is None:
+        return []
+    return [fmt for fmt in requested if fmt in FORMATS and features.check(fmt)]
+
+
+@register_output_stage('image-format')
+def record_format(dest, data, ctx):
+    conf = ctx['options']['images']
+    if not conf or ctx['type'] not in conf['types']:
+        return {}
+    if data is not None:
+        head = bytes(data[:SNIFF_BYTES])
+    else:
+        with open(dest, 'rb') as f:
+            head = f.read(SNIFF_BYTES)
+    return {'format': sniff(head) or 'unknown'}
+
+
+def variant_path(relpath, digest, width, fmt):
+    """Return the path of a variant ('a/b.png' -> 'a/b.<hash>-640w.webp')."""
+    stem = posixpath.splitext(relpath)[0]
+    return f'{stem}.{digest[:10]}-{width}w.{fmt}'
+
+
+@register_pre_stage('images')
+def plan_variants(ctx):
+    """Return {image relpath: {'digest', 'width', 'variants': [[path, width, format]]}}."""
+    conf = ctx['options']['images']
+    formats = available_formats(conf['formats']) if conf else []
+    if not formats:
+        return {}
+    plan = {}
+    for relpath in ctx['paths']:
+        if file_type(relpath, ctx['options']) not in conf['sources']:
+            continue
+        path = os.path.join(ctx['src_root'], relpath)
+        if os.path.getsize(path) < conf['min_size']:
+            continue
+        try:
+            with Image.open(path) as image:
+                width = image.width
+        except OSError as e:
+            print(f"    Warning: Cannot read image {relpath}: {e}")
+            continue
+        digest = ctx['source_hash'](relpath)
+        widths = [w for w in conf['widths'] if w < width] + [width]
+        plan[relpath] = {
+            'digest': digest,
+            'width': width,
+            'variants': [[variant_path(relpath, digest, w, fmt), w, fmt]
+                         for fmt in formats for w in widths],
+        }
+    return plan
+
+
+def _target(base, url, plan, deps):
+    try:
+        url = url.decode('utf-8')
+    except UnicodeDecodeError:
+        return None, None
+    target = resolve(base, url)
+    if target not in plan:
+        return None, None
+    deps[target] = plan[target]['digest']
+    return url, plan[target]
+
+
+def _picture(tag_bytes, url, image, attrs):
+    sizes = attrs.get(b'sizes')
+    sources = []
+    for fmt in FORMATS:
+        srcset = ', '.join(f'{with_name(url, posixpath.basename(path))} {width}w'
+                           for path, width, variant_fmt in image['variants'] if variant_fmt == fmt)
+        if srcset:
+            source = f'<source type="image/{fmt}" srcset="{srcset}"'.encode('utf-8')
+            if sizes:
+                source += b' sizes="' + sizes + b'"'
+            sources.append(source + b'>')
+    return b'<picture>' + b''.join(sources) + tag_bytes + b'</picture>'
+
+
+def _image_set(url, image):
+    """Return the image-set() for a CSS url, best format first."""
+    full = [path for path, width, _ in image['variants'] if width == image['width']]
+    items = [f'url("{with_name(url, posixpath.basename(path))}") type("image/{path.rsplit(".", 1)[1]}")'
+             for path in full]
+    ext = posixpath.splitext(url.split('#', 1)[0].split('?', 1)[0])[1].lower()
+    items.append(f'url("{url}") type("{MIME_TYPES.get(_ALIASES.get(ext, ext), "image/png")}")')
+    return 'image-set(' + ', '.join(items) + ')'
+
+
+def _css_edits(data, start, end, base, plan, deps):
+    """Add an image-set() declaration after each single-image declaration."""
+    edits = []
+    for match in CSS_URL.finditer(data, start, end):
+        url, image = _target(base, match.group(2), plan, deps)
+        if image is None:
+            continue
+        decl_start = max(data.rfind(b'{', start, match.start()),
+                         data.rfind(b';', start, match.start())) + 1
+        prop, colon, before = bytes(data[decl_start:match.start()]).partition(b':')
+        decl_end = match.end()
+        while decl_end < end and data[decl_end:decl_end + 1] not in (b';', b'}'):
+            decl_end += 1
+        rest = bytes(data[match.end():decl_end]).strip()
+        if not colon or before.strip() or rest not in (b'', b'!important'):
+            continue  # part of a longer value, e.g. a layered background
+        declaration = f';{prop.decode("utf-8").strip()}:{_image_set(url, image)}'
+        edits.append((decl_end, decl_end, declaration.encode('utf-8')))
+    return edits
+
+
+@register_stage('images', ('.html', '.htm'), order=40)
+def responsive_html(data, ctx):
+    plan = ctx['shared'].get('images')
+    if not plan:
+        return data
+    index = page_index(data, ctx)
+    base = ctx['path']
+    pictures = [(tag.end, content_end) for tag, content_end, _ in index.elements(b'picture')]
+    edits = []
+    for tag in index.find_all(b'img'):
+        if any(start <= tag.start < end for start, end in pictures):
+            continue
+        attrs = attributes(data, tag)
+        url, image = _target(base, attrs.get(b'src', b''), plan, ctx['deps'])
+        if image is not None:
+            edits.append((tag.start, tag.end,
+                          _picture(bytes(data[tag.start:tag.end]), url, image, attrs)))
+    for name, start, end in index.raw:
+        if name == b'style':
+            edits += _css_edits(data, start, end, base, plan, ctx['deps'])
+    return apply_edits(data, edits) if edits else data
+
+
+@register_stage('images', ('.css',), order=40)
+def responsive_css(data, ctx):
+    plan = ctx['shared'].get('images')
+    if not plan:
+        return data
+    edits = _css_edits(data, 0, len(data), ctx['path'], plan, ctx['deps'])
+    return apply_edits(data, edits) if edits else data
+
+
+def _encode(path, width, fmt, quality):
+    with Image.open(path) as image:
+        if width < image.width:
+            height = round(image.height * width / image.width)
+            image = image.resize((width, height), Image.LANCZOS)
+        buf = io.BytesIO()
+        image.save(buf, format=fmt.upper(), quality=quality)
+    return buf.getvalue()
+
+
+@register_post_stage('images', order=25)
+def check_images(ctx):
+    """Report misnamed and duplicate images and write the planned variants."""
+    conf = ctx['options']['images']
+    if not conf:
+        return
+    by_hash = {}
+    misnamed = 0
+    for relpath, entry in sorted(ctx['files'].items()):
+        fmt = entry.get('format')
+        if fmt is None:
+            continue
+        ext = posixpath.splitext(relpath)[1].lower()
+        if fmt != _ALIASES.get(ext, ext):
+            if fmt in MIME_TYPES:
+                ctx['headers'].append({'source': '/' + quote(relpath), 'headers': [
+                    {'key': 'Content-Type', 'value': MIME_TYPES[fmt]}]})
+            if not entry.get('generated'):
+                # Hashed copies inherit the name of the file already reported.
+                misnamed += 1
+                print(f"    Warning: {relpath} is a {fmt.lstrip('.')} image, not {ext}")
+        if not entry.get('generated'):
+            by_hash.setdefault(entry['out'], []).append(relpath)
+    # Copies inside the dedup roots are already stored once.
+    roots = tuple(root + '/' for root in (ctx['options']['dedup'] or {}).get('roots', ()))
+    duplicates = [paths for paths in by_hash.values()
+                  if len(paths) > 1 and not all(path.startswith(roots) for path in paths)]
+    for paths in duplicates:
+        print(f"    Warning: Identical images: {', '.join(paths)}")
+    ctx['summary']['images_misnamed'] = misnamed
+    ctx['summary']['images_duplicated'] = sum(len(paths) - 1 for paths in duplicates)
+
+    for relpath, image in sorted(ctx['shared'].get('images', {}).items()):
+        if relpath not in ctx['files']:
+            continue
+        # A duplicate the dedup stage dropped is read from the file it aliases.
+        source = os.path.join(ctx['out_dir'], ctx['files'][relpath].get('alias') or relpath)
+        for path, width, fmt in image['variants']:
+            previous = ctx['previous'].get(path)
+            if (previous is not None and previous.get('generated')
+                    and os.path.exists(os.path.join(ctx['out_dir'], path))):
+                # The name encodes the source hash, width and format.
+                ctx['files'][path] = previous
+            else:
+                data = _encode(source, width, fmt, conf['quality'])
+                emit_file(ctx, path, data)
+            ctx['headers'].append(cache_rule('/' + quote(path), IMMUTABLE))
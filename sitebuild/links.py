@@ -0,0 +1,182 @@
+"""Dead-link and orphan-page checks.
+
+While a page is built, a transform stage resolves the local URLs in its
+href/src/srcset/... attributes (from the page's htmlscan index, so no extra
+pass over the page) and records them as the page's 'links' fact.  After the
+build a post stage checks every recorded target against the output and the
+vercel.json rewrites, and walks the link graph from the entry pages:
+
+* a dead link points at a path that is neither a file, a directory with an
+  index page, nor the source of a rewrite;
+* an orphan is a page no entry page leads to by following links.
+
+Because the facts survive incremental builds, only changed pages are
+re-read, and the check itself is a set lookup per link.  ``python main.py
+check-links`` runs the same check straight from the source tree, parsing
+the pages on a process pool.
+"""
+
+import os
+import posixpath
+from concurrent.futures import ProcessPoolExecutor
+
+from .fingerprint import resolve
+from .htmlscan import SRCSET_ATTRIBUTES, page_index, srcset_urls
+from .minify import strip_generator_lines
+from .pipeline import file_type, is_excluded, register_post_stage, register_stage, walk_site
+from .routes import CATCH_ALL, generated_rewrites
+from .vercel import CONFIG_NAME, load_config
+
+PAGE_TYPES = ('.html', '.htm')
+INDEX_PAGES = ('index.html', 'index.htm')
+
+
+def page_links(data, base, index=None):
+    """Return the sorted root-relative paths the local URLs in a page point at."""
+    if index is None:
+        index = page_index(data)
+    targets = set()
+    for _, attribute, start, end in index.urls:
+        if attribute in SRCSET_ATTRIBUTES:
+            candidates = srcset_urls(data[start:end], start)
+        else:
+            candidates = [(data[start:end], start, end)]
+        for url, _, _ in candidates:
+            try:
+                target = resolve(base, bytes(url).decode('utf-8'))
+            except UnicodeDecodeError:
+                continue
+            if target is not None:
+                targets.add(target)
+    return sorted(targets)
+
+
+@register_stage('links', PAGE_TYPES, order=10)
+def record_links(data, ctx):
+    if ctx['options']['links']:
+        ctx['facts']['links'] = page_links(data, ctx['path'], page_index(data, ctx))
+    return data
+
+
+def rewrite_paths(rules):
+    """Return the paths that literal rewrite sources match.
+
+    Sources with patterns other than a trailing '{/}?' match no path here.
+    """
+    paths = set()
+    for rule in rules:
+        source = rule.get('source', '')
+        if source.endswith('{/}?'):
+            source = source[:-4]
+        if len(source) > 1 and source[0] == '/' and not any(char in source for char in '(:*{'):
+            paths.add(posixpath.normpath(source[1:]))
+    return paths
+
+
+def _page_of(target, pages):
+    """Return the page a target path is served by, or None."""
+    if target in pages:
+        return target
+    for name in INDEX_PAGES:
+        page = f'{target}/{name}'
+        if page in pages:
+            return page
+    return None
+
+
+def check_links(links, paths, rewrites, conf):
+    """Return (dead, orphans) for the links of each page.
+
+    links maps a page to its targets, paths is the set of output paths and
+    rewrites the vercel.json rewrite rules.  dead maps each missing target
+    to the pages linking to it; orphans lists the pages not reachable from
+    the entry pages.
+    """
+    ignore = conf['ignore']
+    served = rewrite_paths(rewrites)
+    dead = {}
+    for page, targets in links.items():
+        for target in targets:
+            if (target in paths or target in served or _page_of(target, paths) is not None
+                    or is_excluded(target, posixpath.basename(target), ignore)):
+                continue
+            dead.setdefault(target, []).append(page)
+
+    seen = {page for page in conf['entries'] if page in links}
+    todo = list(seen)
+    while todo:
+        for target in links[todo.pop()]:
+            page = _page_of(target, links)
+            if page is not None and page not in seen:
+                seen.add(page)
+                todo.append(page)
+    orphans = sorted(page for page in links if page not in seen
+                     and not is_excluded(page, posixpath.basename(page), ignore))
+    return dead, orphans
+
+
+def report(dead, orphans, limit):
+    """Print warnings for up to limit dead targets and orphans each."""
+    for target, pages in sorted(dead.items(), key=lambda item: (-len(item[1]), item[0]))[:limit]:
+        more = f" and {len(pages) - 1} more" if len(pages) > 1 else ''
+        print(f"    Warning: Dead link to /{target} from {min(pages)}{more}")
+    if len(dead) > limit:
+        print(f"    Warning: ... and {len(dead) - limit} more dead link targets")
+    for page in orphans[:limit]:
+        print(f"    Warning: Orphan page {page}")
+    if len(orphans) > limit:
+        print(f"    Warning: ... and {len(orphans) - limit} more orphan pages")
+
+
+def _config_rewrites(src_root, replaced):
+    config = load_config(os.path.join(src_root, CONFIG_NAME))
+    return [rule for rule in config.get('rewrites', []) if rule.get('source') not in replaced]
+
+
+@register_post_stage('links', order=95)
+def report_links(ctx):
+    """Report dead links and orphan pages across the built site."""
+    conf = ctx['options']['links']
+    if not conf:
+        return
+    facts = ctx['facts'].get('links', {})
+    links = {page: targets for page, targets in facts.items() if page in ctx['files']}
+    rewrites = ctx['rewrites'] + _config_rewrites(ctx['src_root'], set(ctx['replaced_rewrites']))
+    dead, orphans = check_links(links, set(ctx['files']), rewrites, conf)
+    report(dead, orphans, conf['report'])
+    ctx['summary']['dead_links'] = sum(len(pages) for pages in dead.values())
+    ctx['summary']['orphans'] = len(orphans)
+
+
+def _read_links(task):
+    src_root, relpath = task
+    with open(os.path.join(src_root, relpath), 'rb') as f:
+        data = strip_generator_lines(f.read())
+    return relpath, page_links(data, relpath)
+
+
+def check_site(src_root, options, skip_dirs=()):
+    """Check the links of the source tree without building it.
+
+    Returns (dead, orphans, number of pages).  Pages are parsed on a
+    process pool of options['jobs'] workers.
+    """
+    conf = options['links']
+    paths = set(walk_site(src_root, options, skip_dirs))
+    tasks = [(src_root, relpath) for relpath in sorted(paths)
+             if file_type(relpath, options) in PAGE_TYPES]
+    jobs = options['jobs'] or os.cpu_count() or 1
+    if jobs == 1:
+        links = dict(map(_read_links, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            links = dict(pool.map(_read_links, tasks, chunksize=64))
+    rewrites = []
+    replaced = set()
+    if options['routes']:
+        # What the build would generate, in place of the catch-all.
+        rewrites = generated_rewrites(paths, options['routes'])
+        replaced.add(CATCH_ALL)
+    rewrites += _config_rewrites(src_root, replaced)
+    dead, orphans = check_links(links, paths, rewrites, conf)
+    return dead, orphans, len(tasks)
@@ -0,0 +1,107 @@
+"""Build metrics written as JSON lines.
+
+When the 'metrics' option is set, the workers time every file and every
+stage run on it (wall clock and CPU time of the worker process), and build()
+hands the results to a BuildMetrics, which writes one JSON object per line:
+
+    {"event": "pre_stage", "name": ..., "wall": ..., "cpu": ...}
+    {"event": "file", "path": ..., "type": ..., "status": ..., "bytes_in": ...,
+     "bytes_out": ..., "wall": ..., "cpu": ..., "stages": {name: [wall, cpu]}}
+    {"event": "post_stage", "name": ..., "wall": ..., "cpu": ...}
+    {"event": "stage", "type": ..., "name": ..., "files": ..., "wall": ..., "cpu": ...}
+    {"event": "slowest", "rank": ..., "path": ..., "wall": ..., "cpu": ...}
+    {"event": "build", "started": ..., <the build summary>, "cache_hit_ratio": ...}
+
+File records come in completion order and failed files carry an "error";
+output stages are listed in "stages" as 'output:<name>'.  The stage records
+add up the file records per file type and stage.  Files an incremental build
+skipped without reading them have no file record but count as cache hits.
+"""
+
+import heapq
+import json
+import time
+
+
+def clock():
+    """Return the current (wall clock, CPU) times."""
+    return time.perf_counter(), time.process_time()
+
+
+def add_time(timings, key, started):
+    """Add the time since started (from clock()) to timings[key]."""
+    wall, cpu = clock()
+    entry = timings.setdefault(key, [0.0, 0.0])
+    entry[0] += wall - started[0]
+    entry[1] += cpu - started[1]
+
+
+def _seconds(value):
+    return round(value, 6)
+
+
+class BuildMetrics:
+    """Writes the metrics of one build to conf['path'] as they arrive."""
+
+    def __init__(self, conf):
+        self.slowest = conf['slowest']
+        self.started = time.time()
+        self.stages = {}
+        self.heap = []
+        self.out = open(conf['path'], 'w', encoding='utf-8')
+
+    def _write(self, record):
+        self.out.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def stage(self, kind, name, started):
+        """Record a pre or post stage that ran from started (from clock()) until now."""
+        wall, cpu = clock()
+        self._write({'event': kind, 'name': name,
+                     'wall': _seconds(wall - started[0]), 'cpu': _seconds(cpu - started[1])})
+
+    def file(self, result):
+        """Record the result of process_file() for one file."""
+        record = {'event': 'file'}
+        record.update((key, result[key]) for key in ('path', 'type', 'status', 'bytes_in',
+                                                     'bytes_out', 'error') if key in result)
+        record['wall'] = _seconds(result.get('wall', 0.0))
+        record['cpu'] = _seconds(result.get('cpu', 0.0))
+        stages = result.get('stages', {})
+        record['stages'] = {name: [_seconds(wall), _seconds(cpu)]
+                            for name, (wall, cpu) in stages.items()}
+        self._write(record)
+
+        for name, (wall, cpu) in stages.items():
+            total = self.stages.setdefault((result.get('type', ''), name), [0, 0.0, 0.0])
+            total[0] += 1
+            total[1] += wall
+            total[2] += cpu
+        if self.slowest:
+            item = (record['wall'], record['cpu'], result['path'])
+            if len(self.heap) < self.slowest:
+                heapq.heappush(self.heap, item)
+            else:
+                heapq.heappushpop(self.heap, item)
+
+    def finish(self, summary):
+        """Write the per-stage totals, the slowest files and the summary, and close."""
+        try:
+            for (file_type, name), (files, wall, cpu) in sorted(
+                    self.stages.items(), key=lambda item: -item[1][1]):
+                self._write({'event': 'stage', 'type': file_type, 'name': name, 'files': files,
+                             'wall': _seconds(wall), 'cpu': _seconds(cpu)})
+            for rank, (wall, cpu, path) in enumerate(sorted(self.heap, reverse=True), 1):
+                self._write({'event': 'slowest', 'rank': rank, 'path': path,
+                             'wall': wall, 'cpu': cpu})
+            record = {'event': 'build', 'started': round(self.started, 3)}
+            record.update(summary)
+            record['seconds'] = _seconds(summary.get('seconds', 0.0))
+            files = summary['files']
+            record['cache_hit_ratio'] = round(summary['cached'] / files, 4) if files else 0.0
+            self._write(record)
+        finally:
+            self.close()
+
+    def close(self):
+        """Flush and close the output; finish() does so too."""
+        self.out.close()
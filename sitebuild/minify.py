@@ -0,0 +1,215 @@
+"""Minifying stages for HTML, CSS and JSON.
+
+These strip comments and redundant whitespace, including the comment residue
+the commit-history generator in main.py left in served pages, stylesheets and
+JSON configs.  They are deliberately conservative:
+
+* HTML comments are dropped unless they are conditional comments or contain
+  no letters or digits, which keeps React's hydration markers (``<!-- -->``,
+  ``<!--$-->``, ``<!--/$-->``) intact.  Whitespace runs are collapsed to a
+  single newline or space rather than removed, and the contents of script,
+  pre and textarea elements are left untouched.  Inline style elements go
+  through the CSS minifier.  Comments and those elements are located with
+  the page's htmlscan index, shared with the other HTML stages.
+* CSS comments are dropped except ``/*! ... */`` license comments, and
+  whitespace is removed only next to punctuation where it never matters.
+* JSON has whole-line ``//`` comments removed, must then parse, and is
+  re-serialised compactly.
+* JavaScript is only cleaned of the generator's residue lines.
+"""
+
+import json
+import re
+
+from .htmlscan import page_index
+from .pipeline import register_stage
+
+BOM = b'\xef\xbb\xbf'
+
+# main.py's generator inserted its comments as whole lines, in whatever
+# syntax it guessed for the file: inside start tags, inside CSS strings and
+# as '#' lines in JavaScript, where they are not comments at all.  These are
+# removed wherever they appear, before any other processing.
+_GENERATOR_LINE = re.compile(
+    rb'^[ \t]*(?:<!--|/\*|//|#) Poseitrader Website:[^\n]*(?:\n|\Z)', re.MULTILINE)
+_ALNUM = re.compile(rb'[A-Za-z0-9]')
+# A start tag, or a whitespace run in text.
+_MARKUP_TOKEN = re.compile(
+    rb'(<[A-Za-z](?:"[^"]*"|\'[^\']*\'|[^\'">])*>)|[ \t\r\n\f]+')
+_TAG_SPACE = re.compile(rb'("[^"]*"|\'[^\']*\')|[ \t\r\n\f]+(>)?')
+
+_CSS_TOKEN = re.compile(
+    rb'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')'  # 1: string
+    rb'|(/\*!.*?\*/)'                             # 2: license comment
+    rb'|(/\*.*?\*/)'                              # 3: comment
+    rb'|(\s+)',                                   # 4: whitespace
+    re.DOTALL)
+# Whitespace next to these characters never matters in CSS.
+_CSS_TIGHT = frozenset(b'{};,>: ')
+_CSS_LAST_SEMICOLON = re.compile(rb'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')|;+(?=\})')
+
+
+def _strip_bom(data):
+    while data.startswith(BOM):
+        data = data[len(BOM):]
+    return data
+
+
+def _keep_comment(body):
+    return body.startswith(b'[if') or body.startswith(b'<![endif]') or not _ALNUM.search(body)
+
+
+def _collapse_tag_space(match):
+    quoted, end = match.groups()
+    if quoted:
+        return quoted
+    return end or b' '
+
+
+def _collapse_markup(match):
+    tag = match.group(1)
+    if tag:
+        return _TAG_SPACE.sub(_collapse_tag_space, tag)
+    return b'\n' if b'\n' in match.group(0) else b' '
+
+
+def _minify_markup(data):
+    return _MARKUP_TOKEN.sub(_collapse_markup, data)
+
+
+def _protected_blocks(index):
+    """Return (start, end, kind) for the parts of a page not minified as markup.
+
+    kind is None for comments, otherwise the name of the element whose
+    contents the span covers.
+    """
+    blocks = [(start, end, None) for start, end in index.comments]
+    blocks += [(start, end, name) for name, start, end in index.raw if name != b'title']
+    blocks += [(tag.end, content_end, b'pre') for tag, content_end, _ in index.elements(b'pre')]
+    blocks.sort(key=lambda block: block[0])
+    return blocks
+
+
+def minify_html_bytes(data, index=None):
+    """Return minified HTML.
+
+    index is the page's htmlscan index; when given, data must already be
+    free of generator residue (see clean_html).
+    """
+    if index is None:
+        data = _strip_bom(strip_generator_lines(data))
+        index = page_index(data)
+    out = []
+    # Markup between kept blocks; dropped comments leave no seam in it, so
+    # the whitespace on either side collapses together.
+    pending = []
+    pos = 0
+    for start, end, kind in _protected_blocks(index):
+        if start < pos:
+            # Nested in a block already handled, e.g. a comment inside <pre>.
+            continue
+        pending.append(data[pos:start])
+        pos = end
+        body = data[start:end]
+        if kind is None and not _keep_comment(body[4:-3]):
+            continue
+        out.append(_minify_markup(b''.join(pending)))
+        pending = []
+        if kind == b'style':
+            body = minify_css_bytes(body)
+        out.append(body)
+    pending.append(data[pos:])
+    out.append(_minify_markup(b''.join(pending)))
+    return b''.join(out).strip() + b'\n'
+
+
+def strip_generator_lines(data):
+    """Remove the comment lines main.py's generator added to a file.
+
+    Accepts any bytes-like object and always returns bytes.
+    """
+    return _GENERATOR_LINE.sub(b'', data)
+
+
+def minify_css_bytes(data):
+    """Return minified CSS."""
+    data = strip_generator_lines(data)
+    out = []
+    last = None
+    pos = 0
+    for match in _CSS_TOKEN.finditer(data):
+        text = data[pos:match.start()]
+        if text:
+            out.append(text)
+            last = text[-1]
+        pos = match.end()
+        string, license, comment, space = match.groups()
+        if string or license:
+            out.append(match.group(0))
+            last = match.group(0)[-1]
+        elif space:
+            nxt = data[pos:pos + 1]
+            # Spaces before ':' are kept: they separate descendant selectors.
+            if last is not None and last not in _CSS_TIGHT and nxt and nxt not in b'{};,>':
+                out.append(b' ')
+                last = 32
+    out.append(data[pos:])
+    data = b''.join(out).strip()
+    return _CSS_LAST_SEMICOLON.sub(lambda match: match.group(1) or b'', data)
+
+
+def parse_json_bytes(data):
+    """Parse JSON with generator residue and whole-line ``//`` comments removed.
+
+    Raises ValueError if what is left does not parse.
+    """
+    data = _strip_bom(strip_generator_lines(data))
+    lines = [line for line in data.split(b'\n') if not line.lstrip().startswith(b'//')]
+    return json.loads(b'\n'.join(lines))
+
+
+def minify_json_bytes(data):
+    """Return compact JSON; raises ValueError if the input does not parse."""
+    value = parse_json_bytes(data)
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+@register_stage('clean', ('.html', '.htm'), order=0)
+def clean_html(data, ctx):
+    # Residue sits inside start tags, so it goes before anything scans the page.
+    if not ctx['options']['minify']:
+        return data
+    return _strip_bom(strip_generator_lines(data))
+
+
+@register_stage('minify', ('.html', '.htm'), order=90)
+def minify_html(data, ctx):
+    if not ctx['options']['minify']:
+        return data
+    return minify_html_bytes(data, page_index(data, ctx))
+
+
+@register_stage('minify', ('.css',))
+def minify_css(data, ctx):
+    if not ctx['options']['minify']:
+        return data
+    return minify_css_bytes(data)
+
+
+@register_stage('minify', ('.json',))
+def minify_json(data, ctx):
+    if not ctx['options']['minify']:
+        return data
+    return minify_json_bytes(data)
+
+
+@register_stage('minify', ('.js',), streaming=True)
+def strip_js(data, ctx):
+    # Scripts are not minified, but '#' residue lines are syntax errors.
+    if not ctx['options']['minify']:
+        return data
+    if ctx.get('continued'):
+        # The chunk starts in the middle of a line, which cannot be residue.
+        head, newline, rest = data.partition(b'\n')
+        return head + newline + strip_generator_lines(rest)
+    return strip_generator_lines(data)
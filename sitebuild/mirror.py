@@ -0,0 +1,471 @@
+"""Refreshing the site tree from its origin (``python main.py import``).
+
+The tree was first copied with a desktop web-copy tool (webcopy-origin.txt
+is its log).  import_site() refreshes it from an origin that serves the
+site under its own paths: a local directory, or an HTTP server such as a
+local stand-in of the production site.
+
+* Files are crawled from the entry pages, following the local links of
+  pages and the url()s of stylesheets.  The crawl is also seeded with every
+  file the last import saw (the tree itself on the first run), so files that
+  only scripts load stay current too.  A directory origin is listed instead.
+* Requests run on a pool of keep-alive connections, at most `connections`
+  at a time and no more than `rate` a second.  Connection errors, 429 and 5xx
+  answers are retried with backoff.
+* Every request is conditional.  The ETag and Last-Modified of the last
+  fetch are sent back, and a 304 leaves the file alone; a directory origin
+  compares size and mtime instead.  Only pages that did change are parsed
+  for links.
+* The validators, and the paths found but not yet fetched, are kept in
+  STATE_NAME in the destination.  The state is saved every SAVE_INTERVAL
+  files, so an interrupted import resumes where it stopped: what it already
+  refreshed answers 304.
+
+Files are written atomically, and only when their content changed.  Paths
+that leave the tree, and paths in or under anything matching the build's
+exclude patterns (the tooling), are never written or deleted.
+Files an earlier import wrote that the origin no longer has are reported
+and, with prune, deleted; other paths the origin lacks are dead links and
+only counted.
+"""
+
+import asyncio
+import json
+import os
+import posixpath
+import ssl
+import time
+from urllib.parse import quote, unquote, urljoin, urlsplit
+
+from .cache import hash_bytes
+from .fingerprint import CSS_URL, resolve
+from .links import page_links
+from .pipeline import (
+    DEFAULT_OUTPUT_DIR, file_type, is_publishable, make_options, walk_site, write_atomic,
+)
+
+STATE_NAME = '.import-state.json'
+FORMAT_VERSION = 1
+
+CONNECTIONS = 8
+RATE = 50  # requests per second to an HTTP origin; 0 means no limit
+RETRIES = 3
+BACKOFF = 0.5  # seconds before the first retry, doubled for each further one
+TIMEOUT = 30
+SAVE_INTERVAL = 500
+MAX_HEADER_BYTES = 64 * 1024
+
+REDIRECTS = (301, 302, 303, 307, 308)
+
+
+class Response:
+    """What an origin answered.
+
+    validators are sent back with the next request for the path; location
+    is the path a redirect points at, if it stays on the origin.
+    """
+
+    __slots__ = ('status', 'body', 'validators', 'location', 'retry_after')
+
+    def __init__(self, status, body=b'', validators=None, location=None, retry_after=0):
+        self.status = status
+        self.body = body
+        self.validators = validators or {}
+        self.location = location
+        self.retry_after = retry_after
+
+
+class DirectoryOrigin:
+    """An origin that is a local copy of the site."""
+
+    remote = False
+
+    def __init__(self, root):
+        self.root = root
+        self.name = os.path.abspath(root)
+
+    def listing(self, options):
+        return list(walk_site(self.root, options,
+                              skip_dirs=[os.path.join(self.root, DEFAULT_OUTPUT_DIR)]))
+
+    def _fetch(self, relpath, validators):
+        path = os.path.join(self.root, relpath)
+        if os.path.isdir(path):
+            return Response(301, location=relpath + '/')
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return Response(404)
+        current = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+        if current == validators:
+            return Response(304, validators=current)
+        with open(path, 'rb') as f:
+            return Response(200, f.read(), current)
+
+    async def fetch(self, relpath, validators):
+        return await asyncio.to_thread(self._fetch, relpath, validators)
+
+    async def close(self):
+        pass
+
+
+class HttpOrigin:
+    """An HTTP(S) origin, fetched over a pool of keep-alive connections."""
+
+    remote = True
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError(f"Unsupported origin {url!r}; give a directory or an http(s) URL")
+        self.name = url
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.netloc = parts.netloc
+        self.base = parts.path.rstrip('/') + '/'
+        self.idle = []
+
+    def listing(self, options):
+        return None  # HTTP has no listing; the crawl finds the files
+
+    async def _connect(self):
+        context = ssl.create_default_context() if self.scheme == 'https' else None
+        return await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=context, limit=MAX_HEADER_BYTES),
+            TIMEOUT)
+
+    def _request(self, relpath, validators):
+        lines = [f'GET {self.base}{quote(relpath)} HTTP/1.1', f'Host: {self.netloc}',
+                 'User-Agent: sitebuild-import', 'Accept-Encoding: identity']
+        if validators.get('etag'):
+            lines.append(f"If-None-Match: {validators['etag']}")
+        if validators.get('modified'):
+            lines.append(f"If-Modified-Since: {validators['modified']}")
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    async def fetch(self, relpath, validators):
+        # A kept-alive connection the server has since closed fails on first
+        # use; that is not the request's fault, so it gets a fresh one.
+        reused = bool(self.idle)
+        connection = self.idle.pop() if reused else await self._connect()
+        try:
+            reader, writer = connection
+            writer.write(self._request(relpath, validators))
+            await writer.drain()
+            status, headers, body, keep = await asyncio.wait_for(read_response(reader), TIMEOUT)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            connection[1].close()
+            if reused:
+                return await self.fetch(relpath, validators)
+            raise
+        except BaseException:
+            connection[1].close()
+            raise
+        if keep:
+            self.idle.append(connection)
+        else:
+            connection[1].close()
+        found = {}
+        if headers.get('etag'):
+            found['etag'] = headers['etag']
+        if headers.get('last-modified'):
+            found['modified'] = headers['last-modified']
+        location = None
+        if status in REDIRECTS and headers.get('location'):
+            target = urlsplit(urljoin(f'{self.scheme}://{self.netloc}{self.base}{quote(relpath)}',
+                                      headers['location']))
+            if target.netloc == self.netloc and target.path.startswith(self.base):
+                location = unquote(target.path[len(self.base):])
+        retry_after = headers.get('retry-after', '')
+        return Response(status, body, found, location,
+                        int(retry_after) if retry_after.isdigit() else 0)
+
+    async def close(self):
+        for _, writer in self.idle:
+            writer.close()
+        self.idle = []
+
+
+async def read_response(reader):
+    """Read one HTTP/1.1 response; returns (status, headers, body, keep-alive)."""
+    head = await reader.readuntil(b'\r\n\r\n')
+    status_line, *header_lines = head.decode('latin-1').split('\r\n')
+    try:
+        version, status = status_line.split(' ', 2)[:2]
+        status = int(status)
+    except ValueError:
+        raise ConnectionError(f"bad status line {status_line!r}") from None
+    headers = {}
+    for line in header_lines:
+        key, sep, value = line.partition(':')
+        if sep:
+            headers[key.strip().lower()] = value.strip()
+    connection = headers.get('connection', '').lower()
+    keep = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+    if status in (204, 304) or 100 <= status < 200:
+        body = b''
+    elif 'chunked' in headers.get('transfer-encoding', '').lower():
+        chunks = []
+        while True:
+            size = int((await reader.readuntil(b'\r\n')).split(b';', 1)[0], 16)
+            if size == 0:
+                # Trailers, if any, end with an empty line.
+                while await reader.readuntil(b'\r\n') != b'\r\n':
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b''.join(chunks)
+    elif 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    else:
+        body = await reader.read()
+        keep = False
+    return status, headers, body, keep
+
+
+def open_origin(origin):
+    """Return the origin object for a directory path or an http(s) URL."""
+    if os.path.isdir(origin):
+        return DirectoryOrigin(origin)
+    return HttpOrigin(origin)
+
+
+class RateLimit:
+    """Spaces requests at least 1/rate seconds apart."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next = 0.0
+
+    async def wait(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        slot = max(now, self.next)
+        self.next = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+def load_import_state(dest, origin):
+    """Return (files, pending) from the state in dest.
+
+    files maps a path to the validators of its last fetch; validators from
+    another origin are dropped, as they mean nothing to this one.
+    """
+    try:
+        with open(os.path.join(dest, STATE_NAME), 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None, []
+    except (OSError, ValueError) as e:
+        print(f"    Warning: Ignoring unreadable import state: {e}")
+        return None, []
+    if state.get('version') != FORMAT_VERSION:
+        return None, []
+    files = state['files']
+    if state.get('origin') != origin:
+        files = {path: {} for path in files}
+    return files, state.get('pending', [])
+
+
+def save_import_state(dest, origin, files, pending):
+    write_atomic(os.path.join(dest, STATE_NAME),
+                 json.dumps({'version': FORMAT_VERSION, 'origin': origin, 'files': files,
+                             'pending': sorted(pending)},
+                            separators=(',', ':'), sort_keys=True).encode('utf-8'))
+
+
+def _links(relpath, data, options):
+    kind = file_type(relpath, options)
+    if kind in ('.html', '.htm'):
+        return page_links(data, relpath)
+    if kind == '.css':
+        targets = set()
+        for match in CSS_URL.finditer(data):
+            try:
+                target = resolve(relpath, match.group(2).decode('utf-8'))
+            except UnicodeDecodeError:
+                continue
+            if target is not None:
+                targets.add(target)
+        return targets
+    return ()
+
+
+def tree_path(relpath):
+    """Return relpath normalised, or None if it does not name a file in the tree."""
+    if not relpath or relpath.startswith('/') or '\\' in relpath or '\0' in relpath:
+        return None
+    relpath = posixpath.normpath(relpath)
+    if relpath in ('.', '..') or relpath.startswith('../'):
+        return None
+    return relpath
+
+
+class Importer:
+    """One run of import_site()."""
+
+    def __init__(self, origin, dest, options, rate, prune):
+        self.origin = origin
+        self.dest = dest
+        self.options = options
+        self.limit = RateLimit(rate if origin.remote else 0)
+        self.prune = prune
+        self.files, pending = load_import_state(dest, origin.name)
+        self.imported = set(self.files or ())
+        self.seen = set()
+        self.finished = set()
+        self.crawl = True
+        self.queue = asyncio.Queue()
+        self.done = 0
+        self.summary = {'requests': 0, 'added': 0, 'changed': 0, 'unchanged': 0,
+                        'missing': 0, 'gone': [], 'pruned': 0, 'errors': 0, 'bytes': 0}
+        for relpath in pending:
+            self.add(relpath)
+
+    def add(self, relpath):
+        relpath = tree_path(relpath)
+        if (relpath is None or relpath in self.seen
+                or not is_publishable(relpath, self.options['exclude'])):
+            return
+        self.seen.add(relpath)
+        self.queue.put_nowait(relpath)
+
+    async def request(self, relpath, validators):
+        for attempt in range(RETRIES + 1):
+            await self.limit.wait()
+            self.summary['requests'] += 1
+            try:
+                response = await self.origin.fetch(relpath, validators)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                if attempt == RETRIES:
+                    raise
+                print(f"    Warning: Retrying {relpath}: {e or type(e).__name__}")
+                await asyncio.sleep(BACKOFF * 2 ** attempt)
+                continue
+            if (response.status == 429 or response.status >= 500) and attempt < RETRIES:
+                await asyncio.sleep(max(BACKOFF * 2 ** attempt, response.retry_after))
+                continue
+            return response
+
+    async def visit(self, relpath):
+        """Fetch one path; returns False if it has to be tried again."""
+        if os.path.isdir(os.path.join(self.dest, relpath)):
+            self.add(relpath + '/index.html')  # a link to a directory
+            return True
+        response = await self.request(relpath, self.files.get(relpath, {}))
+        status = response.status
+        if status == 304:
+            self.summary['unchanged'] += 1
+            return True
+        if status in REDIRECTS:
+            if response.location is not None:
+                target = response.location
+                # A directory: its page is the index.
+                self.add(target + 'index.html' if target.endswith('/') else target)
+            return True
+        if status in (404, 410):
+            if relpath not in self.imported:
+                self.summary['missing'] += 1  # a dead link
+                return True
+            self.summary['gone'].append(relpath)
+            if self.prune:
+                self.files.pop(relpath, None)
+                try:
+                    os.unlink(os.path.join(self.dest, relpath))
+                    self.summary['pruned'] += 1
+                except FileNotFoundError:
+                    pass
+            return True
+        if status != 200:
+            print(f"    Warning: {relpath}: HTTP {status}")
+            self.summary['errors'] += 1
+            return False
+        data = response.body
+        path = os.path.join(self.dest, relpath)
+        try:
+            with open(path, 'rb') as f:
+                same = hash_bytes(f.read()) == hash_bytes(data)
+            existed = True
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            same = existed = False
+        if same:
+            self.summary['unchanged'] += 1
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_atomic(path, data)
+            self.summary['changed' if existed else 'added'] += 1
+            self.summary['bytes'] += len(data)
+        self.files[relpath] = response.validators
+        if self.crawl:
+            for target in _links(relpath, data, self.options):
+                self.add(target)
+        return True
+
+    async def worker(self):
+        while True:
+            relpath = await self.queue.get()
+            try:
+                if await self.visit(relpath):
+                    self.finished.add(relpath)
+            except Exception as e:
+                print(f"    Warning: Cannot import {relpath}: {e or type(e).__name__}")
+                self.summary['errors'] += 1
+            finally:
+                self.done += 1
+                self.queue.task_done()
+            if self.done % SAVE_INTERVAL == 0:
+                self.save()
+
+    def save(self):
+        pending = self.seen - self.finished
+        save_import_state(self.dest, self.origin.name, self.files, pending)
+
+    async def run(self, entries, connections):
+        first = self.files is None
+        if first:
+            self.files = {}
+        for relpath in entries:
+            self.add(relpath)
+        seeds = self.origin.listing(self.options)
+        # An origin that lists its files needs no crawl.
+        self.crawl = seeds is None
+        if seeds is None and first:
+            seeds = walk_site(self.dest, self.options,
+                              skip_dirs=[os.path.join(self.dest, DEFAULT_OUTPUT_DIR)])
+        for relpath in list(self.files) + list(seeds or ()):
+            self.add(relpath)
+        workers = [asyncio.create_task(self.worker()) for _ in range(max(1, connections))]
+        try:
+            await self.queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await self.origin.close()
+            self.save()
+
+
+def import_site(origin, dest='.', options=None, entries=('index.html',),
+                connections=CONNECTIONS, rate=RATE, prune=False):
+    """Refresh dest from origin (a directory or an http(s) URL).
+
+    Returns a summary: request count, added/changed/unchanged file counts,
+    dead links ('missing'), the imported paths the origin no longer has
+    ('gone'), pruned files, errors and the bytes written.
+    """
+    options = options or make_options()
+    started = time.perf_counter()
+    source = open_origin(origin)
+    if not source.remote and os.path.abspath(dest) == source.name:
+        raise ValueError(f"Cannot import {origin} into itself")
+    os.makedirs(dest, exist_ok=True)
+    importer = Importer(source, dest, options, rate, prune)
+    asyncio.run(importer.run(entries, connections))
+    summary = importer.summary
+    summary['gone'] = sorted(summary['gone'])
+    summary['seconds'] = time.perf_counter() - started
+    return summary
@@ -0,0 +1,206 @@
+"""Deploy artifacts holding only what changed since the last deploy.
+
+The build manifest already knows the output hash of every file, so a deploy
+does not have to upload the whole tree.  pack_site() compares it with the
+manifest of what is deployed (written by the previous pack) and puts only
+the added and changed files, with their precompressed sidecars, into tar
+shards:
+
+    <dest>/shards/<hash>.tar.gz   the changed files, up to SHARD_SIZE each
+    <dest>/delta.json             added/changed/removed paths and the shards
+    <dest>/manifest.json          what is deployed once the delta is applied
+
+Shards are content-addressed: the name hashes the paths and output hashes of
+their members, and the archives are written reproducibly, so a shard that
+exists from an earlier pack is not written again.  They are written on a
+process pool.  Files that are hardlinked in the output (see the dedup stage)
+are stored once per shard.  After a successful upload, manifest.json
+becomes the base of the next pack.
+"""
+
+import gzip
+import json
+import os
+import posixpath
+import tarfile
+from concurrent.futures import ProcessPoolExecutor
+
+from .cache import hash_bytes, load_manifest
+from .pipeline import DEFAULT_OPTIONS, is_publishable, write_atomic
+
+FORMAT_VERSION = 1
+
+# Uncompressed bytes per shard; a single larger file gets a shard of its own.
+SHARD_SIZE = 64 * 1024 * 1024
+COMPRESS_LEVEL = 6
+
+SHARDS_DIR = 'shards'
+DELTA_NAME = 'delta.json'
+DEPLOYED_NAME = 'manifest.json'
+
+
+def deployed_files(out_dir):
+    """Return {relpath: output hash} for every file a deploy of out_dir uploads.
+
+    Sidecars count as files of their own; their hash is derived from the
+    output they encode.
+    """
+    files = {}
+    for relpath, entry in load_manifest(out_dir, recall=False)['files'].items():
+        if entry.get('alias'):
+            continue  # served through a rewrite; there is no file
+        files[relpath] = entry['out']
+        for encoding in entry.get('encodings', ()):
+            files[f'{relpath}.{encoding}'] = f"{entry['out']}.{encoding}"
+    return files
+
+
+def load_deployed(path):
+    """Load the deployed manifest at path; None means nothing is deployed yet."""
+    if path is None:
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if data.get('version') != FORMAT_VERSION:
+        raise ValueError(f"{path} is not a deployed manifest of version {FORMAT_VERSION}")
+    return data['files']
+
+
+def diff(files, deployed):
+    """Return (added, changed, removed) relpaths, each sorted."""
+    added = sorted(path for path in files if path not in deployed)
+    changed = sorted(path for path in files if path in deployed and deployed[path] != files[path])
+    removed = sorted(path for path in deployed if path not in files)
+    return added, changed, removed
+
+
+def plan_shards(paths, files, sizes, shard_size):
+    """Split paths into shards of at most shard_size bytes.
+
+    Files of one directory stay together as far as possible, so a shard
+    maps to a part of the site.  Returns a list of (name, [relpath]).
+    """
+    shards = []
+    members = []
+    size = 0
+    for path in sorted(paths, key=lambda path: (posixpath.dirname(path), path)):
+        if members and size + sizes[path] > shard_size:
+            shards.append(members)
+            members, size = [], 0
+        members.append(path)
+        size += sizes[path]
+    if members:
+        shards.append(members)
+    named = []
+    for members in shards:
+        key = '\n'.join(f'{path}\0{files[path]}' for path in members)
+        named.append((hash_bytes(key.encode('utf-8'))[:20], members))
+    return named
+
+
+def _write_shard(task):
+    """Write one shard and return its size; runs on the pool."""
+    out_dir, dest, members, level = task
+    tmp = dest + '.part'
+    # Fixed metadata and a zero gzip mtime make the archive reproducible.
+    with open(tmp, 'wb') as raw, \
+            gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=level, mtime=0) as gz, \
+            tarfile.open(fileobj=gz, mode='w', format=tarfile.PAX_FORMAT) as tar:
+        inodes = {}
+        for path in members:
+            source = os.path.join(out_dir, path)
+            st = os.stat(source)
+            info = tarfile.TarInfo(path)
+            info.mode = 0o644
+            info.mtime = 0
+            linked = inodes.get((st.st_dev, st.st_ino))
+            if linked is not None:
+                info.type = tarfile.LNKTYPE
+                info.linkname = linked
+                tar.addfile(info)
+                continue
+            inodes[(st.st_dev, st.st_ino)] = path
+            info.size = st.st_size
+            with open(source, 'rb') as f:
+                tar.addfile(info, f)
+    os.replace(tmp, dest)
+    return os.path.getsize(dest)
+
+
+def _run_tasks(tasks, jobs):
+    if len(tasks) <= 1 or jobs == 1:
+        return [_write_shard(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=jobs or None) as pool:
+        return list(pool.map(_write_shard, tasks))
+
+
+def check_dest(dest, src_root, exclude):
+    """Raise ValueError if dest is a directory the build of src_root would publish."""
+    relpath = os.path.relpath(os.path.abspath(dest), os.path.abspath(src_root))
+    if relpath == os.curdir:
+        raise ValueError(f"Cannot pack into the site source root {src_root}")
+    relpath = relpath.replace(os.sep, '/')
+    if not relpath.startswith('../') and relpath != os.pardir and is_publishable(relpath, exclude):
+        raise ValueError(f"Cannot pack into {dest}: it is inside the site source {src_root} "
+                         f"and not excluded from the build")
+
+
+def pack_site(out_dir, dest, base=None, jobs=None, shard_size=SHARD_SIZE,
+              level=COMPRESS_LEVEL, src_root=None, exclude=DEFAULT_OPTIONS['exclude']):
+    """Pack the changes of out_dir against the deployed manifest at base.
+
+    dest must not be a directory the build of src_root publishes (matching
+    none of the exclude patterns).  Returns the delta report that is also
+    written to dest/delta.json.
+    """
+    if src_root is not None:
+        check_dest(dest, src_root, exclude)
+    files = deployed_files(out_dir)
+    if not files:
+        raise ValueError(f"No build manifest in {out_dir}; build the site first")
+    deployed = load_deployed(base)
+    added, changed, removed = diff(files, deployed)
+    upload = added + changed
+    sizes = {}
+    for path in upload:
+        try:
+            sizes[path] = os.path.getsize(os.path.join(out_dir, path))
+        except FileNotFoundError:
+            raise ValueError(f"{path} is in the build manifest but missing from {out_dir}; "
+                             f"build the site again") from None
+
+    shards_dir = os.path.join(dest, SHARDS_DIR)
+    os.makedirs(shards_dir, exist_ok=True)
+    shards = plan_shards(upload, files, sizes, shard_size)
+    tasks = []
+    reused = 0
+    for name, members in shards:
+        path = os.path.join(shards_dir, name + '.tar.gz')
+        if os.path.exists(path):
+            reused += 1  # the same members with the same content
+        else:
+            tasks.append((out_dir, path, members, level))
+    _run_tasks(tasks, jobs)
+
+    report = {
+        'version': FORMAT_VERSION,
+        # Identifies the deployed state the delta applies to.
+        'base': hash_bytes(json.dumps(deployed, sort_keys=True).encode('utf-8')),
+        'files': len(files),
+        'unchanged': len(files) - len(upload),
+        'added': added,
+        'changed': changed,
+        'removed': removed,
+        'bytes': sum(sizes.values()),
+        'shards': [{'name': f'{SHARDS_DIR}/{name}.tar.gz', 'files': len(members),
+                    'bytes': sum(sizes[path] for path in members),
+                    'archive_bytes': os.path.getsize(os.path.join(shards_dir, name + '.tar.gz'))}
+                   for name, members in shards],
+        'reused_shards': reused,
+    }
+    write_atomic(os.path.join(dest, DELTA_NAME),
+                 (json.dumps(report, indent=2) + '\n').encode('utf-8'))
+    write_atomic(os.path.join(dest, DEPLOYED_NAME),
+                 json.dumps({'version': FORMAT_VERSION, 'files': files},
+                            separators=(',', ':'), sort_keys=True).encode('utf-8'))
+    return report
@@ -0,0 +1,897 @@
+"""Static-site build pipeline.
+
+The site tree is walked once and every file is sent through the transform
+stages registered for its type.  Files are processed on a process pool and the
+results are written to a separate output directory; the source tree is never
+modified.
+"""
+
+import fnmatch
+import functools
+import hashlib
+import mmap
+import os
+import re
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from .cache import (
+    config_digest, hash_bytes, hash_file, is_fresh, load_facts, load_manifest, save_facts,
+    save_manifest,
+)
+from .metrics import BuildMetrics, add_time, clock
+
+DEFAULT_OUTPUT_DIR = 'dist'
+
+DEFAULT_OPTIONS = {
+    # Worker processes; 0 or None means one per CPU.
+    'jobs': 0,
+    # Glob patterns for files that belong to the repository tooling rather
+    # than the published site.  Patterns starting with '/' are matched against
+    # the path relative to the site root, all others against the file name.
+    'exclude': [
+        '.git', '.gitignore', '.DS_Store', '__pycache__', '*.pyc', '*.tmp', '*.lnk',
+        '/main.py', '/sitebuild', '/tests', '.pytest_cache', '/requests.jsonl',
+        '/webcopy-origin.txt',
+        '/bench-baseline.json', '/.import-state.json', '/deploy',
+    ],
+    # Files whose type cannot be derived from their extension.
+    'type_overrides': {
+        'v1/exchanges': '.json',
+    },
+    # Strip comments and redundant whitespace from HTML, CSS and JSON.
+    'minify': True,
+    # Version trees whose identical files are stored once.  mode is
+    # 'hardlink', 'rewrite' (drop the copy and add a vercel.json rewrite) or
+    # None to disable.
+    'dedup': {
+        'roots': ['docs/core-latest', 'docs/core-nightly'],
+        'mode': 'hardlink',
+    },
+    # Full-text search index built for the pages under each root.
+    'search': {
+        'roots': ['docs/latest', 'docs/nightly'],
+        'prefix': 2,
+        'max_postings': 100,
+    },
+    # Search for the rustdoc trees under roots: per-crate item shards and
+    # the search script; descriptions are cut to description_length.
+    'rustdoc': {
+        'roots': ['docs/core-latest', 'docs/core-nightly'],
+        'description_length': 100,
+    },
+    # Precompressed sidecars (dest.br, dest.gz) for these file types.  A
+    # sidecar is only kept when it is smaller than the file itself.
+    'compress': {
+        'encodings': ['br', 'gz'],
+        'types': ['.html', '.htm', '.css', '.js', '.json', '.svg', '.xml',
+                  '.txt', '.ico', '.ttf', '.map', '.webmanifest'],
+    },
+    # Generated vercel.json route table: paths of the Next.js app without an
+    # exported page are sent to fallback, and directories ending in one of
+    # immutable hold content-hashed files that are cached forever.
+    'routes': {
+        'fallback': '/index.html',
+        'immutable': ['_next/static', 'static.files'],
+    },
+    # Assets of these types whose names carry no content hash get a hashed
+    # copy (name.<hash>.ext, hash truncated to length) that HTML and CSS
+    # references are pointed at.
+    'fingerprint': {
+        'types': ['.svg', '.png', '.jpg', '.jpeg', '.gif', '.webp', '.avif', '.ico',
+                  '.woff', '.woff2', '.ttf', '.otf'],
+        'exclude': ['/favicon.ico'],
+        'length': 10,
+    },
+    # Images of these types are checked for a mismatched extension and for
+    # duplicates.  sources files of at least min_size bytes get variants in
+    # formats at widths (never wider than the original); needs Pillow.
+    'images': {
+        'types': ['.png', '.jpg', '.jpeg', '.gif', '.webp', '.avif', '.ico', '.bmp'],
+        'sources': ['.png', '.jpg', '.jpeg'],
+        'min_size': 100 * 1024,
+        'formats': ['avif', 'webp'],
+        'widths': [640, 1280, 1920],
+        'quality': 75,
+    },
+    # The exchanges catalog, validated on every build and split into
+    # shards/exchange/<id>.json and shards/channel/<channel>.json.
+    'exchanges': {
+        'catalog': 'v1/exchanges',
+        'shards': 'v1',
+    },
+    # Critical CSS: pages using one of these stylesheets (exclude-style
+    # patterns) get the rules their markup can match inlined, and load the
+    # stylesheet itself without blocking rendering.  keep lists selectors
+    # scripts make match on every page; subsets larger than max_size bytes
+    # (about what the first round trip delivers) are not inlined.  The
+    # rustdoc stylesheets are left out: thousands of pages share them from
+    # the cache, so inlining would only make every page bigger.
+    'critical': {
+        'stylesheets': ['/_next/static/css/*.css'],
+        'keep': ['[data-theme]'],
+        'max_size': 14 * 1024,
+    },
+    # Fonts of these types (except those matching exclude) are cut down to
+    # the characters found in the files of the scan types plus the always
+    # ranges, and written to dir; needs fontTools (and brotli for woff2).
+    'fonts': {
+        'types': ['.woff2', '.woff', '.ttf', '.otf'],
+        'exclude': [],
+        'scan': ['.html', '.htm', '.css', '.js', '.json'],
+        'always': ['U+0020-007E', 'U+00A0-00FF'],
+        'dir': 'static/fonts',
+    },
+    # Resource hints for the pages matching pages but not exclude
+    # (exclude-style patterns): preloads for the hero image (the largest of
+    # the first hero_candidates images of at least hero_min_area square
+    # pixels), for up to fonts Latin web fonts and, if script is set, for the
+    # first script; prefetches for the prefetch pages each page most likely
+    # leads to.
+    'hints': {
+        'pages': ['*.html', '*.htm'],
+        'exclude': ['/docs/*', '/_next/*'],
+        'hero_candidates': 8,
+        'hero_min_area': 200 * 200,
+        'fonts': 1,
+        'script': True,
+        'prefetch': 3,
+    },
+    # Next.js chunk analysis: the scripts under <root>/static/chunks that no
+    # file of the scan types references, directly or through other chunks,
+    # are dead; with prune they are left out of the build.
+    'chunks': {
+        'root': '_next',
+        'scan': ['.html', '.htm', '.js', '.txt', '.json'],
+        'prune': True,
+    },
+    # The address the site is served at, for the absolute URLs of the
+    # sitemaps and the feed; None leaves both out.
+    'site_url': 'https://poseitrader.io',
+    # Sitemaps of the pages matching pages but not exclude (exclude-style
+    # patterns), urls to a gzipped shard, and with robots a robots.txt
+    # naming them when the tree has none.
+    'sitemap': {
+        'pages': ['*.html', '*.htm'],
+        'exclude': ['/_next/*', '/docs/nightly/*', '/docs/core-nightly/*', '/docs/*/src/*'],
+        'urls': 50000,
+        'robots': True,
+    },
+    # Atom feed at path of the latest entries articles the blog page index
+    # lists, with summaries of at most summary_length characters.
+    'feed': {
+        'index': 'blog/index.html',
+        'path': 'blog/feed.xml',
+        'title': 'PoseiTrader Blog',
+        'author': 'PoseiTrader',
+        'entries': 20,
+        'summary_length': 300,
+    },
+    # Per-file and per-stage timings written as JSON lines (see metrics.py):
+    # {'path': file, 'slowest': number of slowest files listed}, or None.
+    'metrics': None,
+    # Link checking: dead links anywhere, and pages the entries do not lead
+    # to.  Targets and pages matching ignore (exclude-style patterns) are
+    # not reported; at most report of each kind are listed.
+    'links': {
+        'entries': ['index.html'],
+        'ignore': ['/_next/image'],
+        'report': 10,
+    },
+}
+
+# Options that change how a build runs but not what it produces.
+RUNTIME_OPTIONS = ('jobs', 'metrics')
+
+# Below this many stale files the pool start-up costs more than it saves.
+INLINE_THRESHOLD = 16
+
+# Inputs at least this large are memory-mapped instead of read.
+MMAP_THRESHOLD = 1024 * 1024
+# Read size for streaming stages, and the longest line held back whole.
+STREAM_CHUNK_SIZE = 256 * 1024
+MAX_STREAM_CARRY = 4 * STREAM_CHUNK_SIZE
+
+# file type (extension) -> list of (name, func), in run order
+STAGES = {}
+
+# (name, func) run on every file written to the output
+OUTPUT_STAGES = []
+
+# (order, name, func) run once after all files have been processed
+POST_STAGES = []
+
+# (order, name, func) run once before any file is processed
+PRE_STAGES = []
+
+
+def register_stage(name, file_types, func=None, streaming=False, order=50):
+    """Register a transform stage for the given file types.
+
+    A stage is called as ``func(data, ctx)`` with the current file contents as
+    a bytes-like object (bytes, or an mmap for large files) and returns the
+    transformed bytes.  ``ctx`` is a dict holding the relative path, the
+    resolved file type, the build options and a 'facts' dict: whatever a
+    stage stores under ``ctx['facts'][name]`` is kept for the file across
+    incremental builds and handed to the post stages.  The results of the
+    pre stages are under 'shared', with a 'deps' dict for recording which of
+    them the output depends on (see register_pre_stage).
+
+    A streaming stage only looks at whole lines and can be fed a file in
+    chunks that end at a newline; when every stage for a file is streaming,
+    the file never has to be held in memory at once.
+
+    Stages for a file type run in ascending order, then in registration
+    order.  Stages that only read a page should run before the ones that
+    rewrite it, so they can share its htmlscan index.  Can be used as a
+    decorator.
+    """
+    def decorator(func):
+        func.streaming = streaming
+        func.order = order
+        for file_type in file_types:
+            entries = STAGES.setdefault(file_type, [])
+            entries.append((name, func))
+            entries.sort(key=lambda entry: entry[1].order)
+        return func
+
+    if func is not None:
+        return decorator(func)
+    return decorator
+
+
+def register_output_stage(name, func=None):
+    """Register a stage that runs on every file after it is written.
+
+    An output stage is called as ``func(dest, data, ctx)`` with the absolute
+    output path, the bytes just written (None for files that were copied
+    unchanged) and the same ``ctx`` as transform stages.  It may return a
+    dict of fields to record in the file's manifest entry.  Can be used as a
+    decorator.
+    """
+    def decorator(func):
+        OUTPUT_STAGES.append((name, func))
+        return func
+
+    if func is not None:
+        return decorator(func)
+    return decorator
+
+
+def register_pre_stage(name, func=None, order=50):
+    """Register a stage that runs once before the files are processed.
+
+    A pre stage is called as ``func(ctx)`` where ``ctx`` holds the source
+    root, the options, the relative paths of all source files and
+    'source_hash', a function returning the current content hash of a source
+    file (None if it does not exist).  Whatever it returns is handed to the
+    transform stages as ``ctx['shared'][name]``.  A transform stage that uses
+    another file's content this way records it in ``ctx['deps']`` (relative
+    path -> the source_hash it saw), and the file is rebuilt when that hash
+    changes.  A result that depends on more than one file can be given a
+    digest of its own in ``ctx['digests']`` (key -> digest), which transform
+    stages record in ``ctx['deps']`` the same way.  ctx also holds the
+    output directory ('out_dir', None outside a build), where a stage can
+    keep state between builds with cache.save_state(), and a 'skip' set: a
+    source file added to it is left out of the build as if it did not
+    exist.  Stages run in ascending order.  Can be used as a decorator.
+    """
+    def decorator(func):
+        PRE_STAGES.append((order, name, func))
+        PRE_STAGES.sort(key=lambda stage: stage[0])
+        return func
+
+    if func is not None:
+        return decorator(func)
+    return decorator
+
+
+def register_post_stage(name, func=None, order=50):
+    """Register a stage that runs once over the whole output after a build.
+
+    A post stage is called as ``func(ctx)`` where ``ctx`` holds the source
+    root, output directory, options, the manifest entries of all built files
+    (relative path -> entry, which the stage may annotate) and of the previous
+    build ('previous'), the set of files whose output was rebuilt, failed or
+    removed in this run ('changed'), the facts the transform stages recorded
+    (name -> relative path -> value), the pre stage results ('shared'), the
+    summary
+    and the 'rewrites' and 'headers' lists collected for vercel.json (plus
+    'replaced_rewrites', sources of hand-written rewrites that generated ones
+    make obsolete).  New files are written with emit_file().  Stages run in
+    ascending order.  Can be used as a decorator.
+    """
+    def decorator(func):
+        POST_STAGES.append((order, name, func))
+        POST_STAGES.sort(key=lambda stage: stage[0])
+        return func
+
+    if func is not None:
+        return decorator(func)
+    return decorator
+
+
+def stages_for(file_type):
+    """Return the registered (name, func) stages for a file type."""
+    return STAGES.get(file_type, [])
+
+
+def file_type(relpath, options):
+    """Resolve the file type used to pick the transform stages for a path."""
+    override = options['type_overrides'].get(relpath)
+    if override:
+        return override
+    return os.path.splitext(relpath)[1].lower()
+
+
+def make_options(**overrides):
+    """Return a copy of DEFAULT_OPTIONS updated with the given overrides."""
+    options = {key: (value.copy() if isinstance(value, (list, dict)) else value)
+               for key, value in DEFAULT_OPTIONS.items()}
+    for key, value in overrides.items():
+        if value is not None:
+            options[key] = value
+    return options
+
+
+@functools.lru_cache(maxsize=64)
+def _exclude_matchers(patterns):
+    """Return (path regex, name regex) matching any of the patterns."""
+    rooted = [fnmatch.translate(os.path.normcase(p[1:])) for p in patterns if p.startswith('/')]
+    named = [fnmatch.translate(os.path.normcase(p)) for p in patterns if not p.startswith('/')]
+    return (re.compile('|'.join(rooted) or '(?!)').match,
+            re.compile('|'.join(named) or '(?!)').match)
+
+
+def is_excluded(relpath, name, patterns):
+    """Return True if a path matches one of the exclude patterns."""
+    match_path, match_name = _exclude_matchers(tuple(patterns))
+    return (match_path(os.path.normcase(relpath)) is not None
+            or match_name(os.path.normcase(name)) is not None)
+
+
+def root_of(relpath, roots):
+    """Return the root (a directory relpath) of roots that relpath is under, or None."""
+    for root in roots:
+        if relpath.startswith(root + '/'):
+            return root
+    return None
+
+
+def is_publishable(relpath, patterns):
+    """Return True if neither a path nor any directory above it is excluded."""
+    parts = relpath.split('/')
+    return not any(is_excluded('/'.join(parts[:i]), parts[i - 1], patterns)
+                   for i in range(1, len(parts) + 1))
+
+
+def walk_site(src_root, options, skip_dirs=()):
+    """Yield the relative paths of all publishable files, in sorted order."""
+    patterns = options['exclude']
+    skip_dirs = {os.path.abspath(path) for path in skip_dirs}
+    stack = ['']
+    while stack:
+        reldir = stack.pop()
+        absdir = os.path.join(src_root, reldir)
+        try:
+            entries = sorted(os.scandir(absdir), key=lambda entry: entry.name)
+        except OSError as e:
+            print(f"    Warning: Cannot read directory {absdir}: {e}")
+            continue
+        subdirs = []
+        for entry in entries:
+            relpath = entry.name if not reldir else reldir + '/' + entry.name
+            if is_excluded(relpath, entry.name, patterns):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if os.path.abspath(entry.path) not in skip_dirs:
+                    subdirs.append(relpath)
+            elif entry.is_file():
+                yield relpath
+        stack.extend(reversed(subdirs))
+
+
+def write_atomic(dest, data):
+    """Write bytes to dest through a temporary file in the same directory."""
+    tmp = dest + '.part'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, dest)
+
+
+# Per-process state, set up once by _init_worker instead of being pickled
+# with every task.
+_worker = {}
+
+# out_dir -> (config digest, pre stage results, manifest files) of the last
+# build of out_dir in this process, for preview_files().
+_last_build = {}
+
+
+def _init_worker(src_root, out_dir, options, shared=None):
+    _worker['src_root'] = src_root
+    _worker['out_dir'] = out_dir
+    _worker['options'] = options
+    _worker['shared'] = shared or {}
+    _worker['made_dirs'] = set()
+
+
+def _ensure_parent(dest):
+    parent = os.path.dirname(dest)
+    made_dirs = _worker['made_dirs']
+    if parent not in made_dirs:
+        os.makedirs(parent, exist_ok=True)
+        made_dirs.add(parent)
+
+
+def read_input(path, size):
+    """Return the contents of path for the transform stages.
+
+    Files of MMAP_THRESHOLD bytes or more are memory-mapped rather than read,
+    so the pages stay in the page cache instead of on the worker's heap.
+    Stages must treat their input as a bytes-like object.
+    """
+    if size < MMAP_THRESHOLD:
+        with open(path, 'rb') as f:
+            return f.read()
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def file_context(relpath, options, shared=None):
+    """Return the ctx the transform stages for relpath are called with."""
+    return {'path': relpath, 'type': file_type(relpath, options), 'options': options,
+            'facts': {}, 'shared': shared or {}, 'deps': {}}
+
+
+def run_stages(stages, data, ctx):
+    """Run transform stages over data and return the result.
+
+    If ctx has a 'timings' dict, the time spent in each stage is added to it.
+    """
+    timings = ctx.get('timings')
+    for name, func in stages:
+        started = clock() if timings is not None else None
+        try:
+            data = func(data, ctx)
+        except Exception as e:
+            raise RuntimeError(f"stage '{name}' failed: {e}") from e
+        if timings is not None:
+            add_time(timings, name, started)
+    return data
+
+
+def _stream_stages(src, tmp, stages, ctx):
+    """Run streaming stages over src in bounded chunks, writing to tmp.
+
+    Chunks are cut after their last newline.  A line longer than
+    MAX_STREAM_CARRY is passed on in pieces, and ctx['continued'] is set for
+    every piece that does not start at the beginning of a line.  Returns the
+    output hash and size.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    carry = b''
+    at_line_start = True
+    with open(src, 'rb') as fin, open(tmp, 'wb') as fout:
+        while True:
+            chunk = fin.read(STREAM_CHUNK_SIZE)
+            data = carry + chunk
+            if not data:
+                break
+            carry = b''
+            if chunk:
+                cut = data.rfind(b'\n') + 1
+                if cut == 0:
+                    if len(data) < MAX_STREAM_CARRY:
+                        carry = data
+                        continue
+                    cut = len(data)
+                data, carry = data[:cut], data[cut:]
+            ctx['continued'] = not at_line_start
+            at_line_start = data.endswith(b'\n')
+            data = run_stages(stages, data, ctx)
+            fout.write(data)
+            digest.update(data)
+            size += len(data)
+    ctx.pop('continued', None)
+    return digest.hexdigest(), size
+
+
+def process_file(task):
+    """Run the stages for one file and write the result to the output tree.
+
+    task is (relpath, previous source hash or None).  When the source hash is
+    unchanged and the output still exists the stages are not run again.
+    Files are hashed and copied in bounded chunks; when every stage for a
+    file type can stream, transformed files are processed in chunks too, and
+    otherwise large inputs are memory-mapped (see read_input).
+
+    With the 'metrics' option set, the result also holds the file's type,
+    its wall clock and CPU time and the time spent in each stage.
+    """
+    if not _worker['options']['metrics']:
+        return _process_file(task, None)
+    timings = {}
+    started = clock()
+    result = _process_file(task, timings)
+    wall, cpu = clock()
+    result['wall'] = wall - started[0]
+    result['cpu'] = cpu - started[1]
+    result['stages'] = timings
+    return result
+
+
+def _process_file(task, timings):
+    relpath, prev_hash = task
+    src = os.path.join(_worker['src_root'], relpath)
+    dest = os.path.join(_worker['out_dir'], relpath)
+    options = _worker['options']
+    ctx = file_context(relpath, options, _worker['shared'])
+    if timings is not None:
+        ctx['timings'] = timings
+    stages = stages_for(ctx['type'])
+    result = {'path': relpath, 'type': ctx['type'], 'status': 'copied', 'bytes_in': 0,
+              'bytes_out': 0}
+    data = None
+    try:
+        st = os.stat(src)
+        result['size'] = result['bytes_in'] = st.st_size
+        result['mtime_ns'] = st.st_mtime_ns
+        streaming = all(getattr(func, 'streaming', False) for _, func in stages)
+        if not stages or streaming:
+            result['src'] = hash_file(src)
+            if result['src'] == prev_hash and os.path.exists(dest):
+                result['status'] = 'cached'
+                return result
+            _ensure_parent(dest)
+            # Write through a temporary name so that an output hardlinked by
+            # the dedup stage is replaced rather than written through.
+            if not stages:
+                shutil.copyfile(src, dest + '.part')
+                result['out'], result['out_size'] = result['src'], st.st_size
+            else:
+                result['out'], result['out_size'] = _stream_stages(src, dest + '.part', stages, ctx)
+                result['status'] = 'built'
+            os.replace(dest + '.part', dest)
+            result['bytes_out'] = result['out_size']
+            _run_output_stages(dest, None, ctx, result)
+            result['facts'] = ctx['facts']
+            result['deps'] = ctx['deps']
+            return result
+
+        data = read_input(src, st.st_size)
+        result['src'] = hash_bytes(data)
+        if result['src'] == prev_hash and os.path.exists(dest):
+            result['status'] = 'cached'
+            return result
+        out = run_stages(stages, data, ctx)
+        _ensure_parent(dest)
+        write_atomic(dest, out)
+        result['status'] = 'built'
+        result['out'] = hash_bytes(out)
+        result['out_size'] = result['bytes_out'] = len(out)
+        _run_output_stages(dest, out, ctx, result)
+        result['facts'] = ctx['facts']
+        result['deps'] = ctx['deps']
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = str(e)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+    return result
+
+
+def _run_output_stages(dest, data, ctx, result):
+    timings = ctx.get('timings')
+    meta = {}
+    for name, func in OUTPUT_STAGES:
+        started = clock() if timings is not None else None
+        try:
+            meta.update(func(dest, data, ctx) or {})
+        except Exception as e:
+            raise RuntimeError(f"output stage '{name}' failed: {e}") from e
+        if timings is not None:
+            add_time(timings, 'output:' + name, started)
+    result['meta'] = meta
+
+
+def emit_file(ctx, relpath, data):
+    """Write a file generated by a post stage and record it in the manifest.
+
+    The output stages run on it like on any other file.  If the previous build
+    generated identical content the file is left as it is.
+    """
+    dest = os.path.join(ctx['out_dir'], relpath)
+    digest = hash_bytes(data)
+    previous = ctx['previous'].get(relpath)
+    if (previous is not None and previous.get('generated') and previous['out'] == digest
+            and os.path.exists(dest)):
+        ctx['files'][relpath] = previous
+        return
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    write_atomic(dest, data)
+    file_ctx = {'path': relpath, 'type': file_type(relpath, ctx['options']),
+                'options': ctx['options']}
+    result = {}
+    _run_output_stages(dest, data, file_ctx, result)
+    entry = {'generated': True, 'out': digest, 'out_size': len(data)}
+    entry.update(result['meta'])
+    ctx['files'][relpath] = entry
+
+
+def keep_generated(ctx, base):
+    """Carry the files a post stage generated under base in the previous build over.
+
+    For post stages whose inputs are unchanged ('changed' in ctx).  Returns
+    the number of files kept: 0 if there are none or some have gone missing,
+    in which case the stage has to generate them again.
+    """
+    kept = {path: entry for path, entry in ctx['previous'].items()
+            if entry.get('generated') and path.startswith(base + '/')}
+    if not all(os.path.exists(os.path.join(ctx['out_dir'], path)) for path in kept):
+        return 0
+    ctx['files'].update(kept)
+    return len(kept)
+
+
+def _check_dirs(src_root, out_dir):
+    src_root = os.path.abspath(src_root)
+    out_dir = os.path.abspath(out_dir)
+    if out_dir == src_root or src_root.startswith(out_dir + os.sep):
+        raise ValueError(f"Output directory {out_dir} would overwrite the source tree")
+    return src_root, out_dir
+
+
+def run_files(tasks, src_root, out_dir, options, shared=None):
+    """Process tasks on a process pool and yield the per-file results."""
+    jobs = options['jobs'] or os.cpu_count() or 1
+    if jobs == 1 or len(tasks) < INLINE_THRESHOLD:
+        _init_worker(src_root, out_dir, options, shared)
+        for task in tasks:
+            yield process_file(task)
+        return
+    chunksize = max(1, min(256, len(tasks) // (jobs * 8) or 1))
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                             initargs=(src_root, out_dir, options, shared)) as pool:
+        yield from pool.map(process_file, tasks, chunksize=chunksize)
+
+
+def source_hasher(src_root, previous, dirty=None):
+    """Return a function giving the current content hash of a source file.
+
+    Files whose stat matches their previous manifest entry are not read, and
+    if dirty is given, files outside it are taken to be unchanged.
+    """
+    memo = {}
+
+    def source_hash(relpath):
+        if relpath not in memo:
+            path = os.path.join(src_root, relpath)
+            entry = previous.get(relpath)
+            if dirty is not None and relpath not in dirty and entry is not None and 'src' in entry:
+                memo[relpath] = entry['src']
+                return entry['src']
+            try:
+                st = os.stat(path)
+            except OSError:
+                memo[relpath] = None
+                return None
+            if (entry is not None and 'src' in entry and entry.get('size') == st.st_size
+                    and entry.get('mtime_ns') == st.st_mtime_ns):
+                memo[relpath] = entry['src']
+            else:
+                memo[relpath] = hash_file(path)
+        return memo[relpath]
+
+    return source_hash
+
+
+def _deps_current(entry, source_hash, digests):
+    return all((digests[path] if path in digests else source_hash(path)) == digest
+               for path, digest in entry.get('deps', {}).items())
+
+
+def run_pre_stages(src_root, options, relpaths, source_hash, metrics=None, out_dir=None,
+                   digests=None, skip=None):
+    """Run the pre stages and return their results (name -> value).
+
+    The digests the stages publish are added to digests, and the files they
+    leave out of the build to skip, if given.
+    """
+    ctx = {'src_root': src_root, 'options': options, 'paths': relpaths,
+           'source_hash': source_hash, 'out_dir': out_dir,
+           'digests': digests if digests is not None else {},
+           'skip': skip if skip is not None else set()}
+    shared = {}
+    for _, name, func in PRE_STAGES:
+        started = clock()
+        try:
+            shared[name] = func(ctx)
+        except Exception as e:
+            print(f"    Warning: Pre stage '{name}' failed: {e}")
+        if metrics is not None:
+            metrics.stage('pre_stage', name, started)
+    return shared
+
+
+def _set_facts(facts, relpath, values):
+    """Replace the facts recorded for relpath with values (name -> value)."""
+    for store in facts.values():
+        store.pop(relpath, None)
+    for name, value in values.items():
+        facts.setdefault(name, {})[relpath] = value
+
+
+def _remove_output(out_dir, relpath, entry):
+    paths = [relpath] + [relpath + '.' + encoding for encoding in entry.get('encodings', ())]
+    for path in paths:
+        try:
+            os.remove(os.path.join(out_dir, path))
+        except FileNotFoundError:
+            pass
+
+
+def _config(options):
+    return config_digest({key: value for key, value in options.items()
+                          if key not in RUNTIME_OPTIONS}, STAGES, OUTPUT_STAGES)
+
+
+def preview_files(src_root, out_dir, options, relpaths):
+    """Rebuild relpaths straight away and return their results, or None.
+
+    For watch mode, which follows up with a full build(): the files are built
+    with what the pre stages found in the last build of out_dir in this
+    process, no post stage runs and the manifest is left alone.  Only files
+    that build wrote itself are rebuilt; None means there was no such build
+    with the same options.
+    """
+    src_root, out_dir = _check_dirs(src_root, out_dir)
+    last = _last_build.get(out_dir)
+    if last is None or last[0] != _config(options):
+        return None
+    _, shared, files = last
+    tasks = [(relpath, None) for relpath in relpaths
+             if relpath in files and not files[relpath].get('alias')]
+    return list(run_files(tasks, src_root, out_dir, options, shared))
+
+
+def build(src_root='.', out_dir=DEFAULT_OUTPUT_DIR, options=None, force=False, paths=None,
+          dirty=None, on_result=None):
+    """Build the site from src_root into out_dir and return a summary dict.
+
+    Unless force is set, files recorded as unchanged in the build manifest of
+    a previous run are skipped.  Callers that track the source tree
+    themselves (watch mode) can pass paths, the list of publishable source
+    files, so the tree is not walked, and dirty, the set of files that may
+    have changed since the previous build, so only those are checked.
+    on_result, if given, is called with the result of every file as soon as
+    its worker has written it, before the post stages run.
+    """
+    options = options or make_options()
+    src_root, out_dir = _check_dirs(src_root, out_dir)
+    started = time.perf_counter()
+
+    if paths is None:
+        relpaths = list(walk_site(src_root, options, skip_dirs=[out_dir]))
+    else:
+        relpaths = list(paths)
+    os.makedirs(out_dir, exist_ok=True)
+
+    config = _config(options)
+    manifest = load_manifest(out_dir)
+    fresh_config = manifest['config'] == config and not force
+    previous = manifest['files'] if fresh_config else {}
+    facts = load_facts(out_dir) if fresh_config else {}
+    metrics = BuildMetrics(options['metrics']) if options['metrics'] else None
+    try:
+        return _build(src_root, out_dir, options, relpaths, dirty, started, config, manifest,
+                      previous, facts, metrics, on_result)
+    finally:
+        if metrics is not None:
+            metrics.close()  # a build that failed leaves what it recorded
+
+
+def _build(src_root, out_dir, options, relpaths, dirty, started, config, manifest, previous,
+           facts, metrics, on_result):
+    source_hash = source_hasher(src_root, previous, dirty)
+    digests = {}
+    skip = set()
+    shared = run_pre_stages(src_root, options, relpaths, source_hash, metrics, out_dir, digests,
+                            skip)
+    if skip:
+        relpaths = [relpath for relpath in relpaths if relpath not in skip]
+    entries = {}
+    tasks = []
+    for relpath in relpaths:
+        entry = previous.get(relpath)
+        if dirty is not None and entry is not None and relpath not in dirty:
+            fresh = True
+        else:
+            try:
+                st = os.stat(os.path.join(src_root, relpath))
+            except OSError:
+                continue
+            fresh = is_fresh(entry, st, out_dir, relpath)
+        if fresh:
+            if not _deps_current(entry, source_hash, digests):
+                # Unchanged itself, but built from a file that has changed.
+                tasks.append((relpath, None))
+                continue
+            entries[relpath] = entry
+        else:
+            tasks.append((relpath, entry['src'] if entry else None))
+
+    # An aliased output (see the dedup stage) only stays valid while the file
+    # it points at is itself unchanged.
+    for relpath, entry in list(entries.items()):
+        alias = entry.get('alias')
+        if alias and entries.get(alias, {}).get('out') != entry['out']:
+            del entries[relpath]
+            tasks.append((relpath, None))
+
+    summary = {'files': len(relpaths), 'cached': len(entries), 'copied': 0, 'built': 0,
+               'error': 0, 'removed': 0, 'bytes_in': 0, 'bytes_out': 0}
+    changed = set()
+    for result in run_files(tasks, src_root, out_dir, options, shared):
+        if metrics is not None:
+            metrics.file(result)
+        if on_result is not None:
+            on_result(result)
+        summary[result['status']] += 1
+        if result['status'] != 'cached':
+            changed.add(result['path'])
+        summary['bytes_in'] += result['bytes_in']
+        summary['bytes_out'] += result['bytes_out']
+        if result['status'] == 'error':
+            print(f"    Warning: Error building {result['path']}: {result['error']}")
+            continue
+        if result['status'] == 'cached':
+            # Only the source stat changed; the output, its facts and
+            # everything the output stages recorded for it are still valid.
+            entry = dict(previous[result['path']])
+            entry.update(size=result['size'], mtime_ns=result['mtime_ns'])
+        else:
+            entry = {key: result[key] for key in ('size', 'mtime_ns', 'src', 'out', 'out_size')}
+            entry.update(result['meta'])
+            if result.get('deps'):
+                entry['deps'] = result['deps']
+            _set_facts(facts, result['path'], result.get('facts', {}))
+        entries[result['path']] = entry
+
+    sources = set(relpaths)
+    for relpath, entry in manifest['files'].items():
+        if relpath not in sources and not entry.get('generated'):
+            _remove_output(out_dir, relpath, entry)
+            _set_facts(facts, relpath, {})
+            summary['removed'] += 1
+            changed.add(relpath)
+
+    ctx = {'src_root': src_root, 'out_dir': out_dir, 'options': options,
+           'files': entries, 'previous': previous, 'changed': changed, 'facts': facts,
+           'summary': summary, 'shared': shared, 'rewrites': [], 'headers': [],
+           'replaced_rewrites': []}
+    for _, name, func in POST_STAGES:
+        stage_started = clock()
+        try:
+            func(ctx)
+        except Exception as e:
+            summary['error'] += 1
+            print(f"    Warning: Post-build stage '{name}' failed: {e}")
+        if metrics is not None:
+            metrics.stage('post_stage', name, stage_started)
+
+    # Generated files that no post stage produced this time are stale.
+    for relpath, entry in manifest['files'].items():
+        if entry.get('generated') and relpath not in entries:
+            _remove_output(out_dir, relpath, entry)
+
+    save_facts(out_dir, facts)
+    save_manifest(out_dir, {'config': config, 'files': entries})
+    _last_build[out_dir] = (config, shared, entries)
+    summary['seconds'] = time.perf_counter() - started
+    if metrics is not None:
+        metrics.finish(summary)
+    return summary
@@ -0,0 +1,106 @@
+"""Route table and cache headers for vercel.json, generated from the output.
+
+The hand-written vercel.json sends every path to /index.html with a '/(.*)'
+catch-all.  This stage replaces it with rules derived from the files the
+build actually produced:
+
+* Directories whose index page is index.htm (the mirrored documentation) get
+  a rewrite, since the platform only serves index.html as a directory index.
+* Routes of the Next.js app (one per _next/static/chunks/app/<route>/page-*.js)
+  are rewritten to their exported page, or to the SPA shell when there is no
+  exported page.  Anything else that does not exist is a real 404.
+* HTML and other unversioned files must be revalidated; directories whose
+  files carry content hashes in their names are cached as immutable.
+"""
+
+import posixpath
+import re
+
+from .pipeline import register_post_stage
+
+REVALIDATE = 'public, max-age=0, must-revalidate'
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+APP_CHUNKS = '_next/static/chunks/app'
+CATCH_ALL = '/(.*)'
+
+_PAGE_CHUNK = re.compile(r'page-[0-9a-f]+\.js')
+
+
+def cache_rule(source, value):
+    return {'source': source, 'headers': [{'key': 'Cache-Control', 'value': value}]}
+
+
+def _route_source(directory):
+    # '{/}?' accepts the directory URL with and without its trailing slash.
+    return '/' + directory + '{/}?' if directory else '/'
+
+
+def directory_rewrites(paths):
+    """Return rewrites for directories served by index.htm rather than index.html."""
+    rules = []
+    for path in sorted(paths):
+        directory, name = posixpath.split(path)
+        if name == 'index.htm' and posixpath.join(directory, 'index.html') not in paths:
+            rules.append({'source': _route_source(directory), 'destination': '/' + path})
+    return rules
+
+
+def app_routes(paths):
+    """Return the routes of the Next.js app ('' for the root), from its page chunks."""
+    routes = set()
+    prefix = APP_CHUNKS + '/'
+    for path in paths:
+        if path.startswith(prefix):
+            directory, name = posixpath.split(path[len(prefix):])
+            if _PAGE_CHUNK.fullmatch(name):
+                routes.add(directory)
+    return sorted(routes)
+
+
+def app_rewrites(paths, fallback):
+    """Return rewrites sending every app route to its exported page or to fallback."""
+    rules = []
+    for route in app_routes(paths):
+        if not route:
+            continue  # '/' is served by the root index.html
+        page = posixpath.join(route, 'index.html')
+        destination = '/' + page if page in paths else fallback
+        rules.append({'source': _route_source(route), 'destination': destination})
+    return rules
+
+
+def immutable_dirs(paths, names):
+    """Return the output directories whose path ends with one of names."""
+    found = set()
+    for directory in {posixpath.dirname(path) for path in paths}:
+        while directory:
+            if any(directory == name or directory.endswith('/' + name) for name in names):
+                found.add(directory)
+                break
+            directory = posixpath.dirname(directory)
+    return sorted(found)
+
+
+def generated_rewrites(paths, conf):
+    """Return the rewrites generated for a set of output paths."""
+    return directory_rewrites(paths) + app_rewrites(paths, conf['fallback'])
+
+
+@register_post_stage('routes', order=90)
+def generate_routes(ctx):
+    """Add the generated rewrites and Cache-Control rules for vercel.json."""
+    conf = ctx['options']['routes']
+    if not conf:
+        return
+    paths = {path for path, entry in ctx['files'].items() if not entry.get('alias')}
+    rewrites = generated_rewrites(paths, conf)
+    ctx['rewrites'].extend(rewrites)
+    ctx['replaced_rewrites'].append(CATCH_ALL)
+
+    # Later rules override earlier ones for the same header, so the default
+    # goes first and the immutable directories after it.
+    ctx['headers'].insert(0, cache_rule(CATCH_ALL, REVALIDATE))
+    for directory in immutable_dirs(paths, conf['immutable']):
+        ctx['headers'].append(cache_rule(f'/{directory}/(.*)', IMMUTABLE))
+    ctx['summary']['routes'] = len(rewrites)
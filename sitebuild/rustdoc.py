@@ -0,0 +1,185 @@
+"""Search for the mirrored rustdoc trees.
+
+The mirror has rustdoc's pages and crates.js but neither its search index
+nor its search script, so the search box does nothing.  This module puts
+both back, in a form that loads one crate at a time:
+
+* while an item page (struct.*.html, fn.*.html, a module's index.html, ...)
+  is built, a transform stage records its kind, name and summary (the meta
+  description) and those of its inherent methods, variants and fields as
+  the page's 'rustdoc' fact;
+* after the build a post stage writes, for every root::
+
+    <root>/search-index/<crate>.json   the items of one crate
+    <root>/search-index.js             the crates and their shards
+    <root>/static.files/<search-js>    the search script the pages ask for
+
+main.js loads search-index.js and the script when the search box gets
+focus.  The script searches the current crate first, fetching only its
+shard, and the other crates' shards only when asked to search all of them
+(or on the crates' root page).  The script is sitebuild/rustdoc_search.js;
+it is only written where the tree has no search script of its own.
+
+A shard is {"paths": [module path], "items": [[kind, name, path, desc,
+parent]]}: kind indexes KINDS, path indexes paths, and parent is the index
+of the item a method, variant or field belongs to (-1 for items).
+"""
+
+import html
+import json
+import os
+import re
+
+from .pipeline import emit_file, register_post_stage, register_stage, root_of
+
+INDEX_DIR = 'search-index'
+FORMAT_VERSION = 1
+
+# Item kinds in the order of their codes in a shard; the first ones have a
+# page of their own (<kind>.<name>.html, modules index.html), the others are
+# anchors on their parent's page.
+KINDS = ('mod', 'struct', 'enum', 'fn', 'trait', 'type', 'constant', 'static', 'macro',
+         'union', 'derive', 'attr', 'primitive', 'keyword', 'traitalias',
+         'method', 'tymethod', 'variant', 'structfield')
+SUB_KINDS = ('method', 'tymethod', 'variant', 'structfield')
+
+SCRIPT_NAME = 'rustdoc_search.js'
+
+# Directories of a rustdoc tree that hold no crate.
+_NOT_CRATES = ('src', 'static.files', 'trait.impl', 'type.impl', INDEX_DIR)
+
+_ITEM_FILE = re.compile(r'(' + '|'.join(KINDS[1:15]) + r')\.([^./]+)\.html')
+_VARS = re.compile(rb'<meta name="rustdoc-vars"[^>]*?data-search-js="([^"]+)"')
+_DESCRIPTION = re.compile(rb'<meta name="description" content="([^"]*)"')
+_SUB_ITEM = re.compile(rb'id="(' + b'|'.join(k.encode() for k in SUB_KINDS) + rb')\.(\w+)"')
+# Where a page's own members end and the trait and auto-trait impls begin.
+_MEMBERS_END = re.compile(rb'id="(?:trait-implementations|synthetic-implementations|'
+                          rb'blanket-implementations|implementors|deref-methods)')
+_DOCBLOCK = re.compile(rb'<div class="docblock[^"]*"><p>(.*?)</p>', re.DOTALL)
+_TAG = re.compile(r'<[^>]*>')
+_SPACE = re.compile(r'\s+')
+
+
+def item_of(relpath, root):
+    """Return (crate, module path, kind, name) for an item page, or None."""
+    parts = relpath[len(root) + 1:].split('/')
+    if len(parts) < 2 or parts[0] in _NOT_CRATES:
+        return None
+    if parts[-1] == 'index.html':
+        return parts[0], '::'.join(parts[:-2]), 'mod', parts[-2]
+    match = _ITEM_FILE.fullmatch(parts[-1])
+    if match is None:
+        return None
+    return parts[0], '::'.join(parts[:-1]), match.group(1), match.group(2)
+
+
+def summary(text, length):
+    """Return text without markup, cut to length characters."""
+    text = _SPACE.sub(' ', html.unescape(_TAG.sub('', text))).strip()
+    return text if len(text) <= length else text[:length - 1].rstrip() + '…'
+
+
+def extract(data, length):
+    """Return the 'rustdoc' fact of an item page: [search-js, desc, [[kind, name, desc]]]."""
+    match = _VARS.search(data, 0, 4096)
+    if match is None:
+        return None
+    description = _DESCRIPTION.search(data, 0, 4096)
+    desc = summary(description.group(1).decode('utf-8', 'replace'), length) if description else ''
+    end = _MEMBERS_END.search(data)
+    end = end.start() if end else len(data)
+    found = list(_SUB_ITEM.finditer(data, 0, end))
+    members = []
+    seen = set()
+    for i, sub in enumerate(found):
+        key = (sub.group(1), sub.group(2))
+        if key in seen:
+            continue
+        seen.add(key)
+        # The member's docs come before the next member, if it has any.
+        stop = found[i + 1].start() if i + 1 < len(found) else end
+        doc = _DOCBLOCK.search(data, sub.end(), stop)
+        members.append([sub.group(1).decode('ascii'), sub.group(2).decode('ascii'),
+                        summary(doc.group(1).decode('utf-8', 'replace'), length) if doc else ''])
+    return [match.group(1).decode('utf-8', 'replace'), desc, members]
+
+
+@register_stage('rustdoc', ('.html',), order=10)
+def record_items(data, ctx):
+    conf = ctx['options']['rustdoc']
+    root = conf and root_of(ctx['path'], conf['roots'])
+    if root and item_of(ctx['path'], root):
+        fact = extract(data, conf['description_length'])
+        if fact is not None:
+            ctx['facts']['rustdoc'] = fact
+    return data
+
+
+def build_shard(pages):
+    """Return the shard of one crate from {(module path, kind, name): fact}."""
+    paths = sorted({path for path, _, _ in pages})
+    path_ids = {path: i for i, path in enumerate(paths)}
+    items = []
+    # Parents first, so a member's parent index is known.
+    for (path, kind, name), (_, desc, members) in sorted(pages.items()):
+        parent = len(items)
+        items.append([KINDS.index(kind), name, path_ids[path], desc, -1])
+        for member_kind, member_name, member_desc in members:
+            items.append([KINDS.index(member_kind), member_name, path_ids[path], member_desc,
+                          parent])
+    return {'paths': paths, 'items': items}
+
+
+def _dump(value):
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def _script():
+    with open(os.path.join(os.path.dirname(__file__), SCRIPT_NAME), 'rb') as f:
+        return f.read()
+
+
+@register_post_stage('rustdoc-search', order=40)
+def write_search(ctx):
+    """Write the per-crate shards, their manifest and the search script."""
+    conf = ctx['options']['rustdoc']
+    if not conf:
+        return
+    facts = ctx['facts'].get('rustdoc', {})
+    for root in conf['roots']:
+        crates = {}
+        search_js = set()
+        for relpath, fact in facts.items():
+            if relpath not in ctx['files'] or not relpath.startswith(root + '/'):
+                continue
+            crate, path, kind, name = item_of(relpath, root)
+            crates.setdefault(crate, {})[(path, kind, name)] = fact
+            search_js.add(fact[0])
+        if not crates:
+            continue
+        changed = {item_of(path, root)[0] for path in ctx['changed']
+                   if path.startswith(root + '/') and item_of(path, root)}
+        manifest = {}
+        for crate, pages in sorted(crates.items()):
+            shard = f'{root}/{INDEX_DIR}/{crate}.json'
+            previous = ctx['previous'].get(shard)
+            if (crate not in changed and previous is not None and previous.get('generated')
+                    and os.path.exists(os.path.join(ctx['out_dir'], shard))):
+                ctx['files'][shard] = previous
+            else:
+                emit_file(ctx, shard, _dump(build_shard(pages)))
+            manifest[crate] = sum(1 + len(fact[2]) for fact in pages.values())
+        index = {'version': FORMAT_VERSION, 'kinds': KINDS, 'sub_kinds': SUB_KINDS,
+                 'dir': INDEX_DIR, 'crates': manifest}
+        emit_file(ctx, f'{root}/search-index.js',
+                  b'window.searchIndex=' + _dump(index)
+                  + b';if(window.initSearch)window.initSearch(window.searchIndex);\n')
+        script = None
+        for name in sorted(search_js):
+            relpath = f'{root}/static.files/{name}'
+            if relpath in ctx['files'] and not ctx['files'][relpath].get('generated'):
+                continue  # the tree brings its own
+            script = script or _script()
+            emit_file(ctx, relpath, script)
+        ctx['summary']['rustdoc_items'] = (ctx['summary'].get('rustdoc_items', 0)
+                                           + sum(manifest.values()))
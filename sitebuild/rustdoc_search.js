@@ -0,0 +1,170 @@
+// Search for the rustdoc pages, over the per-crate shards written by
+// sitebuild/rustdoc.py.  main.js loads this script and search-index.js
+// (the manifest) when the search box is first used; whichever comes second
+// starts the search.
+"use strict";
+
+(function() {
+    const MAX_RESULTS = 200;
+    const vars = document.querySelector("meta[name=\"rustdoc-vars\"]").dataset;
+    const rootPath = vars.rootPath;
+    const shards = new Map();  // crate -> Promise of its items
+    let manifest = null;
+    let allCrates = false;
+    let pending = null;
+
+    function loadCrate(crate) {
+        if (!shards.has(crate)) {
+            const url = rootPath + manifest.dir + "/" + crate + ".json";
+            shards.set(crate, fetch(url)
+                .then(response => response.ok ? response.json() : {paths: [], items: []})
+                .then(shard => prepare(crate, shard)));
+        }
+        return shards.get(crate);
+    }
+
+    function prepare(crate, shard) {
+        return shard.items.map(([kind, name, path, desc, parent]) => {
+            const item = {
+                crate, kind: manifest.kinds[kind], name, lower: name.toLowerCase(),
+                path: shard.paths[path], desc, parent,
+            };
+            if (parent >= 0) {
+                const owner = shard.items[parent];
+                item.path = item.path ? item.path + "::" + owner[1] : owner[1];
+                item.href = itemHref(shard.paths[owner[2]], manifest.kinds[owner[0]], owner[1])
+                    + "#" + item.kind + "." + name;
+            } else {
+                item.href = itemHref(item.path, item.kind, name);
+            }
+            return item;
+        });
+    }
+
+    function itemHref(path, kind, name) {
+        const dir = path ? path.split("::").join("/") + "/" : "";
+        return rootPath + dir + (kind === "mod" ? name + "/index.html" : kind + "." + name + ".html");
+    }
+
+    function escape(text) {
+        return text.replace(/[&<>"]/g, c => ({"&": "&amp;", "<": "&lt;", ">": "&gt;", "\"": "&quot;"})[c]);
+    }
+
+    function score(item, name, pathTerms) {
+        let rank;
+        if (item.lower === name) {
+            rank = 0;
+        } else if (item.lower.startsWith(name)) {
+            rank = 1;
+        } else if (item.lower.includes(name)) {
+            rank = 2;
+        } else {
+            return -1;
+        }
+        if (pathTerms.length) {
+            const path = item.path.toLowerCase();
+            if (!pathTerms.every(term => path.includes(term))) {
+                return -1;
+            }
+        }
+        // Items before their members, then shorter names and paths.
+        return rank * 1e6 + (item.parent >= 0 ? 5e5 : 0) + item.name.length * 1e3
+            + Math.min(item.path.length, 999);
+    }
+
+    function scopeCrates() {
+        const current = vars.currentCrate;
+        if (allCrates || !current || !(current in manifest.crates)) {
+            return Object.keys(manifest.crates);
+        }
+        return [current];
+    }
+
+    function render(query, results, crates) {
+        const total = Object.keys(manifest.crates).length;
+        let scope = crates.length === 1 ? " in <code>" + escape(crates[0]) + "</code>" : "";
+        if (crates.length < total) {
+            scope += " <a href=\"#\" class=\"search-all-crates\">Search all " + total + " crates</a>";
+        }
+        let out = "<div class=\"main-heading\"><h1 class=\"search-results-title\">Results"
+            + scope + "</h1></div><div class=\"search-results active\">";
+        if (!results.length) {
+            out += "<div class=\"search-failed active\">No results for <code>"
+                + escape(query) + "</code>.</div>";
+        }
+        for (const item of results) {
+            out += "<a class=\"result-" + item.kind + "\" href=\"" + escape(item.href) + "\">"
+                + "<span class=\"result-name\"><span class=\"typename\">" + item.kind + "</span> "
+                + "<div class=\"path\">" + (item.path ? escape(item.path) + "::" : "")
+                + "<span class=\"" + item.kind + "\">" + escape(item.name) + "</span></div></span>"
+                + "<div class=\"desc\"><span>" + escape(item.desc) + "</span></div></a>";
+        }
+        const output = window.searchState.outputElement();
+        output.innerHTML = out + "</div>";
+        const all = output.querySelector(".search-all-crates");
+        if (all) {
+            all.addEventListener("click", event => {
+                event.preventDefault();
+                allCrates = true;
+                search(query);
+            });
+        }
+        window.searchState.showResults(output);
+    }
+
+    function search(query) {
+        const terms = query.trim().toLowerCase().split("::").map(term => term.trim());
+        const name = terms.pop();
+        if (!name) {
+            window.searchState.hideResults();
+            return;
+        }
+        const crates = scopeCrates();
+        const run = pending = Promise.all(crates.map(loadCrate)).then(loaded => {
+            if (run !== pending) {
+                return;  // a newer query is on its way
+            }
+            const found = [];
+            for (const items of loaded) {
+                for (const item of items) {
+                    const rank = score(item, name, terms);
+                    if (rank >= 0) {
+                        found.push([rank, item]);
+                    }
+                }
+            }
+            found.sort((a, b) => a[0] - b[0]);
+            render(query, found.slice(0, MAX_RESULTS).map(hit => hit[1]), crates);
+            const url = new URL(window.location.href);
+            url.searchParams.set("search", query);
+            history.replaceState(null, "", url);
+        });
+    }
+
+    window.initSearch = function(index) {
+        if (manifest !== null || index.version !== 1) {
+            return;
+        }
+        manifest = index;
+        const params = window.searchState.getQueryStringParams();
+        const input = window.searchState.input;
+        input.addEventListener("input", () => {
+            window.searchState.clearInputTimeout();
+            window.searchState.timeout = setTimeout(() => search(input.value), 100);
+        });
+        document.getElementsByClassName("search-form")[0].addEventListener("submit", event => {
+            event.preventDefault();
+            search(input.value);
+        });
+        if (params.search) {
+            input.value = params.search;
+        }
+        if (input.value) {
+            search(input.value);
+        }
+    };
+
+    if (window.searchIndex) {
+        window.initSearch(window.searchIndex);
+    }
+})();
@@ -0,0 +1,186 @@
+"""Build-time full-text search index for the documentation trees.
+
+While a page under one of the configured roots is built, a transform stage
+extracts its title, headings and article text and records weighted term
+counts as the page's 'search' fact.  After the build a post stage turns the
+facts into an inverted index written next to the pages::
+
+    <root>/search-index/manifest.json   shard keys, document count, format
+    <root>/search-index/docs.json       [url, title, excerpt] per document id
+    <root>/search-index/shard-<key>.json  {term: [[doc id, score], ...]}
+
+Terms are sharded by their first ``prefix`` characters (terms that do not
+start with that many ASCII letters or digits go to shard '_'), so a browser
+only fetches the shard for the term being typed.  Because the facts survive
+incremental builds, re-indexing after a one-page edit only re-reads that page.
+"""
+
+import html
+import json
+import math
+import re
+
+from .htmlscan import page_index
+from .pipeline import emit_file, keep_generated, register_post_stage, register_stage, root_of
+
+INDEX_DIR = 'search-index'
+FORMAT_VERSION = 1
+
+TITLE_WEIGHT = 10
+HEADING_WEIGHT = 3
+EXCERPT_LENGTH = 160
+MAX_TERM_LENGTH = 32
+
+STOPWORDS = frozenset(
+    'a an and are as at be by for from has have in is it its of on or that the this '
+    'to was were will with you your can not but if then than so we our'.split())
+
+# Elements whose text is not part of a page's content.
+NOISE = (b'script', b'style', b'nav', b'svg', b'noscript', b'button', b'footer')
+HEADINGS = (b'h1', b'h2', b'h3')
+
+_TAG = re.compile(rb'<[^>]*>')
+_WORD = re.compile(r'[^\W_][\w]*')
+_SPACE = re.compile(r'\s+')
+_SHARD_KEY = re.compile(r'[a-z0-9]+')
+
+
+def _text(fragment):
+    text = _TAG.sub(b' ', fragment).decode('utf-8', 'replace')
+    return _SPACE.sub(' ', html.unescape(text)).strip()
+
+
+def tokenize(text):
+    """Return the index terms in text, lowercased and without stopwords.
+
+    Numbers and very long tokens (hashes, encoded data) are not indexed.
+    """
+    return [word for word in _WORD.findall(text.lower())
+            if 1 < len(word) <= MAX_TERM_LENGTH and word not in STOPWORDS
+            and not word.isdigit()]
+
+
+def _outside(spans, start, end):
+    """Return the (start, end) pieces of start..end not covered by spans."""
+    pieces = []
+    for span_start, span_end in spans:
+        if span_end <= start or span_start >= end:
+            continue
+        if span_start > start:
+            pieces.append((start, span_start))
+        start = max(start, span_end)
+    if start < end:
+        pieces.append((start, end))
+    return pieces
+
+
+def extract(data, index=None):
+    """Return the search fact for an HTML page, or None if it has no text."""
+    if index is None:
+        index = page_index(data)
+    span = index.title
+    title = _text(data[span[0]:span[1]]) if span else ''
+    content = index.elements(b'article', b'main')
+    if content:
+        tag, content_end, _ = content[0]
+        start, end = tag.end, content_end
+    else:
+        start, end = 0, len(data)
+    noise = [(tag.start, element_end) for tag, _, element_end in index.elements(*NOISE)]
+    pieces = _outside(noise, start, end)
+    text = _text(b' '.join(data[a:b] for a, b in pieces))
+    if not text and not title:
+        return None
+
+    terms = {}
+    for term in tokenize(text):
+        terms[term] = terms.get(term, 0) + 1
+    for tag, content_end, _ in index.elements(*HEADINGS):
+        if start <= tag.start < end:
+            heading = b' '.join(data[a:b] for a, b in _outside(noise, tag.end, content_end))
+            for term in tokenize(_text(heading)):
+                terms[term] = terms.get(term, 0) + HEADING_WEIGHT
+    for term in tokenize(title):
+        terms[term] = terms.get(term, 0) + TITLE_WEIGHT
+    return {'title': title, 'excerpt': text[:EXCERPT_LENGTH], 'terms': terms}
+
+
+@register_stage('search', ('.html', '.htm'), order=10)
+def record_search_fact(data, ctx):
+    conf = ctx['options']['search']
+    if conf and root_of(ctx['path'], conf['roots']):
+        fact = extract(data, page_index(data, ctx))
+        if fact is not None:
+            ctx['facts']['search'] = fact
+    return data
+
+
+def page_url(relpath):
+    """Return the URL a page is served at ('a/index.htm' -> '/a/')."""
+    head, _, name = relpath.rpartition('/')
+    if name in ('index.html', 'index.htm'):
+        return '/' + head + '/' if head else '/'
+    return '/' + relpath
+
+
+def shard_key(term, prefix):
+    """Return the shard a term is stored in."""
+    key = term[:prefix]
+    return key if len(key) == prefix and _SHARD_KEY.fullmatch(key) else '_'
+
+
+def build_index(pages, prefix, max_postings):
+    """Build the index for pages ({relpath: fact}).
+
+    Returns (docs, shards) where docs is a list of [url, title, excerpt] and
+    shards maps a shard key to {term: [[doc id, score], ...]} with postings
+    ordered by descending score.
+    """
+    paths = sorted(pages)
+    docs = [[page_url(path), pages[path]['title'], pages[path]['excerpt']] for path in paths]
+    postings = {}
+    for doc_id, path in enumerate(paths):
+        for term, weight in pages[path]['terms'].items():
+            postings.setdefault(term, []).append((doc_id, weight))
+
+    count = len(paths)
+    shards = {}
+    for term, hits in postings.items():
+        idf = math.log(1 + count / len(hits))
+        scored = sorted(((doc_id, round((1 + math.log(weight)) * idf * 100))
+                         for doc_id, weight in hits), key=lambda hit: (-hit[1], hit[0]))
+        shard = shards.setdefault(shard_key(term, prefix), {})
+        shard[term] = [list(hit) for hit in scored[:max_postings]]
+    return docs, shards
+
+
+def _dump(value):
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False,
+                      sort_keys=True).encode('utf-8')
+
+
+@register_post_stage('search-index', order=40)
+def write_search_index(ctx):
+    """Write the sharded inverted index for every configured root."""
+    conf = ctx['options']['search']
+    if not conf:
+        return
+    facts = ctx['facts'].get('search', {})
+    for root in conf['roots']:
+        base = f'{root}/{INDEX_DIR}'
+        if not any(root_of(path, [root]) for path in ctx['changed']) and keep_generated(ctx, base):
+            continue  # no page under root changed
+        pages = {path: fact for path, fact in facts.items()
+                 if path in ctx['files'] and root_of(path, [root])}
+        if not pages:
+            continue
+        docs, shards = build_index(pages, conf['prefix'], conf['max_postings'])
+        for key, terms in shards.items():
+            emit_file(ctx, f'{base}/shard-{key}.json', _dump(terms))
+        emit_file(ctx, f'{base}/docs.json', _dump(docs))
+        emit_file(ctx, f'{base}/manifest.json', _dump({
+            'version': FORMAT_VERSION,
+            'prefix': conf['prefix'],
+            'documents': len(docs),
+            'shards': sorted(shards),
+        }))
@@ -0,0 +1,472 @@
+"""Local preview server for the build output.
+
+Serves an output directory the way the production platform does, so pages
+can be checked and load-tested locally:
+
+* files are looked up in the build manifest, which is held in memory (and
+  reloaded when a build rewrites it); directories are served by their
+  index.html;
+* paths that are not files go through the rewrites of the generated
+  vercel.json, and its headers (Cache-Control, Content-Type) are applied;
+* a .br or .gz sidecar is sent when the client accepts that encoding;
+* every response has an ETag derived from the output hash, and conditional
+  requests get 304; single byte ranges get 206;
+* small files are kept in memory, larger ones are sent with sendfile();
+* a file rebuilt since the manifest was written (by a build that is still
+  running, as in watch mode) is served as it is on disk, not from memory;
+* with a LiveReload (watch mode), HTML pages are sent uncompressed with a
+  script that listens on RELOAD_PATH, an event stream that tells them to
+  reload when the watcher has rewritten a file.
+
+Only the subset of the platform's path patterns the build writes is
+understood: literal paths, '(.*)' groups, ':name' and ':name*' parameters
+and an optional trailing '{/}?'.
+"""
+
+import asyncio
+import mimetypes
+import os
+import posixpath
+import re
+import time
+from urllib.parse import unquote, urlsplit
+
+from .cache import MANIFEST_NAME, load_manifest
+from .pipeline import file_type
+from .vercel import CONFIG_NAME, load_config
+
+# Files up to this size are cached in memory, up to CACHE_LIMIT in total.
+MEMORY_FILE_LIMIT = 256 * 1024
+CACHE_LIMIT = 64 * 1024 * 1024
+MAX_HEADER_BYTES = 64 * 1024
+
+# Accept-Encoding token -> sidecar suffix, in order of preference.
+ENCODINGS = (('br', 'br'), ('gzip', 'gz'))
+
+TEXT_TYPES = ('text/', 'application/json', 'application/javascript', 'image/svg+xml',
+              'application/xml')
+
+REASONS = {200: 'OK', 206: 'Partial Content', 304: 'Not Modified', 400: 'Bad Request',
+           404: 'Not Found', 405: 'Method Not Allowed', 416: 'Range Not Satisfiable'}
+
+RELOAD_PATH = '/__sitebuild/reload'
+RELOAD_SCRIPT = (f'<script>new EventSource("{RELOAD_PATH}").onmessage='
+                 f'function(){{location.reload()}}</script>').encode('ascii')
+_BODY_END = re.compile(rb'</body\s*>', re.IGNORECASE)
+
+_PATTERN_TOKEN = re.compile(r'\{/\}\?$|\((?:[^()\\]|\\.)*\)|:(\w+)(\*)?')
+_RANGE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+def compile_source(source):
+    """Return a regular expression for a vercel.json source pattern."""
+    pattern = []
+    pos = 0
+    for match in _PATTERN_TOKEN.finditer(source):
+        pattern.append(re.escape(source[pos:match.start()]))
+        token = match.group(0)
+        if token == '{/}?':
+            pattern.append('/?')
+        elif match.group(1):
+            pattern.append(f"(?P<{match.group(1)}>{'.*' if match.group(2) else '[^/]+'})")
+        else:
+            pattern.append(token)
+        pos = match.end()
+    pattern.append(re.escape(source[pos:]))
+    return re.compile(''.join(pattern) + '$')
+
+
+def _destination(destination, match):
+    """Fill the $n and :name references of a rewrite destination."""
+    destination = re.sub(r'\$(\d+)', lambda ref: match.group(int(ref.group(1))) or '',
+                         destination)
+    names = match.groupdict()
+    return re.sub(r':(\w+)\*?', lambda ref: names.get(ref.group(1)) or '', destination)
+
+
+class Resource:
+    """A servable output file."""
+
+    __slots__ = ('path', 'size', 'etag', 'content_type', 'encodings')
+
+    def __init__(self, path, size, etag, content_type, encodings):
+        self.path = path
+        self.size = size
+        self.etag = etag
+        self.content_type = content_type
+        self.encodings = encodings
+
+
+class Site:
+    """The in-memory index of an output directory."""
+
+    def __init__(self, out_dir, options):
+        self.out_dir = os.path.abspath(out_dir)
+        self.options = options
+        self.stamp = None
+        self.cache = {}
+        self.cached_bytes = 0
+        self.reload()
+
+    def _stamp(self):
+        try:
+            st = os.stat(os.path.join(self.out_dir, MANIFEST_NAME))
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def reload(self):
+        """Read the manifest and vercel.json again if a build has replaced them."""
+        stamp = self._stamp()
+        if stamp == self.stamp and self.stamp is not None:
+            return False
+        self.stamp = stamp
+        files = {}
+        for relpath, entry in load_manifest(self.out_dir, recall=False)['files'].items():
+            if entry.get('alias') or relpath == CONFIG_NAME:
+                continue  # dropped by the dedup stage, or not served
+            content_type = mimetypes.guess_type('x' + file_type(relpath, self.options))[0]
+            content_type = content_type or 'application/octet-stream'
+            if content_type.startswith(TEXT_TYPES):
+                content_type += '; charset=utf-8'
+            files[relpath] = Resource(relpath, entry.get('out_size'), entry.get('out', '')[:20],
+                                      content_type, entry.get('encodings', ()))
+        config = load_config(os.path.join(self.out_dir, CONFIG_NAME))
+        self.files = files
+        self.rewrites = [(compile_source(rule['source']), rule['destination'])
+                         for rule in config.get('rewrites', ())]
+        self.headers = [(compile_source(rule['source']), rule['headers'])
+                        for rule in config.get('headers', ())]
+        self.cache.clear()
+        self.cached_bytes = 0
+        return True
+
+    def _file(self, path):
+        relpath = posixpath.normpath('/' + path).lstrip('/')
+        if relpath in ('', '.'):
+            return self.files.get('index.html')
+        return self.files.get(relpath) or self.files.get(relpath + '/index.html')
+
+    def lookup(self, path):
+        """Return the Resource served for a decoded URL path, or None.
+
+        As on the platform, files take precedence over rewrites, and the
+        first rewrite whose source matches decides.
+        """
+        resource = self._file(path)
+        if resource is not None:
+            return resource
+        for pattern, destination in self.rewrites:
+            match = pattern.match(path)
+            if match is not None:
+                return self._file(_destination(destination, match))
+        return None
+
+    def headers_for(self, path):
+        """Return the vercel.json headers for a URL path; later rules win."""
+        found = {}
+        for pattern, headers in self.headers:
+            if pattern.match(path):
+                for header in headers:
+                    found[header['key']] = header['value']
+        return found
+
+    def current(self, resource):
+        """Return (size, etag, encodings) of a resource as it is on disk now.
+
+        A file written after the manifest, while a build is still running, is
+        described by its stat, and sidecars older than the file are left out.
+        Raises FileNotFoundError if the file has been removed.
+        """
+        st = os.stat(os.path.join(self.out_dir, resource.path))
+        if self.stamp is None or st.st_mtime_ns <= self.stamp[0]:
+            return resource.size, resource.etag, resource.encodings
+        encodings = []
+        for suffix in resource.encodings:
+            try:
+                sidecar = os.stat(os.path.join(self.out_dir, f'{resource.path}.{suffix}'))
+            except FileNotFoundError:
+                continue
+            if sidecar.st_mtime_ns >= st.st_mtime_ns:
+                encodings.append(suffix)
+        return st.st_size, f'{st.st_mtime_ns:x}-{st.st_size:x}', encodings
+
+    def read(self, relpath, etag):
+        """Return the bytes of a small output file, from the cache if possible."""
+        version, data = self.cache.get(relpath, (None, None))
+        if version != etag:
+            with open(os.path.join(self.out_dir, relpath), 'rb') as f:
+                data = f.read()
+            if version is not None:
+                self.cached_bytes -= len(self.cache.pop(relpath)[1])
+            if self.cached_bytes + len(data) <= CACHE_LIMIT:
+                self.cache[relpath] = (etag, data)
+                self.cached_bytes += len(data)
+        return data
+
+
+def choose_encoding(accept, available):
+    """Return (token, suffix) of the best sidecar the client accepts, or None."""
+    accepted = {}
+    for item in accept.split(','):
+        token, _, params = item.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[token.strip().lower()] = quality
+    for token, suffix in ENCODINGS:
+        if suffix in available and accepted.get(token, accepted.get('*', 0.0)) > 0:
+            return token, suffix
+    return None
+
+
+def parse_range(value, size):
+    """Return (start, end) for a single 'bytes=' range, None to ignore it, or
+    'unsatisfiable'."""
+    match = _RANGE.match(value.strip())
+    if match is None:
+        return None  # multiple or malformed ranges: send the whole file
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        length = int(last)
+        if length == 0:
+            return 'unsatisfiable'
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        return 'unsatisfiable'
+    return start, end
+
+
+def inject_reload(data):
+    """Return an HTML page with RELOAD_SCRIPT added before its last </body>."""
+    ends = list(_BODY_END.finditer(data))
+    at = ends[-1].start() if ends else len(data)
+    return data[:at] + RELOAD_SCRIPT + data[at:]
+
+
+class LiveReload:
+    """Tells the pages open in browsers to reload.
+
+    notify() and reindex() may be called from any thread; they run, in the
+    order they were called, on the server's event loop.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.site = None
+        self.clients = set()
+
+    def notify(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._push)
+
+    def reindex(self):
+        """Read a new manifest now rather than when the next request comes in."""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.site.reload)
+
+    def _push(self):
+        for queue in self.clients:
+            queue.put_nowait(None)
+
+    async def stream(self, writer):
+        """Send a reload event on every notify() until the client goes away."""
+        queue = asyncio.Queue()
+        self.clients.add(queue)
+        try:
+            while True:
+                await queue.get()
+                writer.write(b'data: reload\n\n')
+                await writer.drain()
+        finally:
+            self.clients.discard(queue)
+
+
+class PreviewServer:
+    """An asyncio HTTP/1.1 server for a Site."""
+
+    def __init__(self, site, log=True, reload=None):
+        self.site = site
+        self.log = log
+        self.reload = reload
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self._simple(writer, 400, close=True)
+                    break
+                keep_alive = await self.respond(head, writer)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _simple(self, writer, status, headers=(), close=False):
+        body = f'{status} {REASONS[status]}\n'.encode('ascii')
+        self._start(writer, status, [('Content-Type', 'text/plain; charset=utf-8'),
+                                     ('Content-Length', str(len(body)))] + list(headers), close)
+        writer.write(body)
+
+    def _start(self, writer, status, headers, close):
+        lines = [f'HTTP/1.1 {status} {REASONS[status]}']
+        lines += [f'{key}: {value}' for key, value in headers]
+        if close:
+            lines.append('Connection: close')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    async def respond(self, head, writer):
+        """Answer one request; returns whether the connection stays open."""
+        started = time.perf_counter()
+        try:
+            request_line, *header_lines = head.decode('latin-1').split('\r\n')
+            method, target, version = request_line.split(' ')
+        except ValueError:
+            await self._simple(writer, 400, close=True)
+            return False
+        request = {}
+        for line in header_lines:
+            key, sep, value = line.partition(':')
+            if sep:
+                request[key.strip().lower()] = value.strip()
+        connection = request.get('connection', '').lower()
+        keep_alive = (connection != 'close' if version == 'HTTP/1.1'
+                      else connection == 'keep-alive')
+        # Request bodies are never read, so one left on the connection would
+        # be taken for the next request.
+        if (method not in ('GET', 'HEAD') or 'transfer-encoding' in request
+                or request.get('content-length', '0') != '0'):
+            keep_alive = False
+        status, size = await self._serve(method, target, request, writer, not keep_alive)
+        if self.log:
+            elapsed = (time.perf_counter() - started) * 1000
+            print(f"{method} {target} {status} {size} {elapsed:.1f}ms")
+        return keep_alive
+
+    async def _serve(self, method, target, request, writer, close):
+        if method not in ('GET', 'HEAD'):
+            await self._simple(writer, 405, [('Allow', 'GET, HEAD')], close)
+            return 405, 0
+        self.site.reload()
+        path = unquote(urlsplit(target).path) or '/'
+        if self.reload is not None and path == RELOAD_PATH:
+            self._start(writer, 200, [('Content-Type', 'text/event-stream'),
+                                      ('Cache-Control', 'no-store')],
+                        close or method == 'GET')
+            if method == 'GET':
+                await writer.drain()
+                await self.reload.stream(writer)
+            return 200, 0
+        resource = self.site.lookup(path)
+        if resource is None:
+            not_found = self.site.files.get('404.html')
+            if not_found is None:
+                await self._simple(writer, 404, close=close)
+                return 404, 0
+            resource, status = not_found, 404
+        else:
+            status = 200
+
+        try:
+            size, etag, encodings = self.site.current(resource)
+        except FileNotFoundError:
+            await self._simple(writer, 404, close=close)
+            return 404, 0
+        headers = {'Content-Type': resource.content_type}
+        headers.update(self.site.headers_for(path))
+        relpath = resource.path
+        encoding = None
+        live = self.reload is not None and resource.content_type.startswith('text/html')
+        range_value = None if live else request.get('range')
+        if range_value and request.get('if-range', f'"{etag}"') != f'"{etag}"':
+            range_value = None
+        if live:
+            etag += '-live'
+        elif resource.encodings:
+            headers['Vary'] = 'Accept-Encoding'
+            if not range_value:
+                encoding = choose_encoding(request.get('accept-encoding', ''), encodings)
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding[0]
+            relpath += '.' + encoding[1]
+            etag += '-' + encoding[1]
+            size = os.path.getsize(os.path.join(self.site.out_dir, relpath))
+        headers['ETag'] = f'"{etag}"'
+        if not live:
+            headers['Accept-Ranges'] = 'bytes'
+
+        if status == 200 and f'"{etag}"' in request.get('if-none-match', ''):
+            del headers['Content-Type']
+            self._start(writer, 304, list(headers.items()), close)
+            return 304, 0
+
+        if live:
+            with open(os.path.join(self.site.out_dir, relpath), 'rb') as f:
+                data = inject_reload(f.read())
+            headers['Content-Length'] = str(len(data))
+            self._start(writer, status, list(headers.items()), close)
+            if method == 'HEAD':
+                return status, 0
+            writer.write(data)
+            return status, len(data)
+
+        start, end = 0, size - 1
+        if status == 200 and range_value and encoding is None:
+            span = parse_range(range_value, size)
+            if span == 'unsatisfiable':
+                await self._simple(writer, 416, [('Content-Range', f'bytes */{size}')], close)
+                return 416, 0
+            if span is not None:
+                start, end = span
+                status = 206
+                headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        length = end - start + 1
+        headers['Content-Length'] = str(length)
+        self._start(writer, status, list(headers.items()), close)
+        if method == 'HEAD' or length <= 0:
+            return status, 0
+
+        if size <= MEMORY_FILE_LIMIT:
+            writer.write(self.site.read(relpath, etag)[start:end + 1])
+        else:
+            await writer.drain()
+            with open(os.path.join(self.site.out_dir, relpath), 'rb') as f:
+                await asyncio.get_running_loop().sendfile(writer.transport, f, start, length)
+        return status, length
+
+
+async def serve_forever(out_dir, options, host, port, log=True, reload=None):
+    site = Site(out_dir, options)
+    if not site.files:
+        raise ValueError(f"No build output in {out_dir}; run 'python main.py build' first")
+    if reload is not None:
+        reload.loop = asyncio.get_running_loop()
+        reload.site = site
+    server = PreviewServer(site, log, reload)
+    listener = await asyncio.start_server(server.handle, host, port, limit=MAX_HEADER_BYTES)
+    print(f"Serving {site.out_dir} ({len(site.files)} files) on http://{host}:{port}/")
+    async with listener:
+        await listener.serve_forever()
+
+
+def run_server(out_dir, options, host='127.0.0.1', port=8000, log=True, reload=None):
+    """Serve out_dir until interrupted; reload is a LiveReload or None."""
+    try:
+        asyncio.run(serve_forever(out_dir, options, host, port, log, reload))
+    except KeyboardInterrupt:
+        pass
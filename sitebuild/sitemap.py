@@ -0,0 +1,219 @@
+"""Sitemaps and the blog feed.
+
+After the build a post stage writes, for the pages matching the 'pages'
+option of 'sitemap'::
+
+    sitemap.xml               the sitemap index, naming the shards
+    sitemap-<n>.xml.gz        up to 'urls' pages each, gzipped
+    robots.txt                naming the index, unless the tree has its own
+
+and the Atom feed of the blog ('feed' option): the articles next to its
+index page, in the order the index lists them.
+
+A page's lastmod is the time of the first build that saw its current
+content: the source hash of every page is kept in the output directory with
+the time it was first built with it, so a page keeps its date until its
+content changes, however often it is rebuilt or touched.  Crawlers reading
+the dates then only come back for the pages that changed.  The first build
+dates every page.
+"""
+
+import datetime
+import gzip
+import re
+from urllib.parse import quote
+from xml.sax.saxutils import escape
+
+from .cache import load_state, save_state
+from .pipeline import emit_file, file_type, is_excluded, register_post_stage, register_stage
+from .rustdoc import summary
+from .search import page_url
+
+PAGE_TYPES = ('.html', '.htm')
+
+INDEX_NAME = 'sitemap.xml'
+SHARD_NAME = 'sitemap-{}.xml.gz'
+ROBOTS_NAME = 'robots.txt'
+
+_SITEMAP_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+_ATOM_NS = 'http://www.w3.org/2005/Atom'
+
+# The article list of the blog index and the parts of an article: its
+# heading is the last one before the posts.
+_LISTED = re.compile(rb'<div class="post-content">\s*<a href="([^"]+)"\s*>(.*?)</a\s*>\s*'
+                     rb'<div class="date">\s*([^<]*?)\s*</div>', re.DOTALL)
+_PUBLISHED = re.compile(rb'<div class="date">\s*Published on\s*([^<]*?)\s*</div>')
+_FIRST_POST = re.compile(rb'<div class="post">(.*?)</div>', re.DOTALL)
+_HEADING = re.compile(rb'<p class="MuiTypography-root[^"]*">([^<]*)</p>')
+_POSTS = b'<div class="blog-posts">'
+_TITLE = re.compile(rb'<title>(.*?)</title>', re.DOTALL)
+
+
+def in_scope(relpath, conf):
+    name = relpath.rpartition('/')[2]
+    return (is_excluded(relpath, name, conf['pages'])
+            and not is_excluded(relpath, name, conf['exclude']))
+
+
+def page_link(site_url, relpath):
+    """Return the absolute URL of a page."""
+    return site_url.rstrip('/') + quote(page_url(relpath))
+
+
+def _text(data):
+    return summary(data.decode('utf-8', 'replace'), 1 << 16)
+
+
+def _date(text):
+    """Return an article date ('2025-07-15') as a W3C datetime, or None."""
+    try:
+        day = datetime.date.fromisoformat(text.strip())
+    except ValueError:
+        return None
+    return day.isoformat() + 'T00:00:00+00:00'
+
+
+@register_stage('feed', PAGE_TYPES, order=10)
+def record_articles(data, ctx):
+    """Record the article list of the blog index and the dates and summaries of articles."""
+    conf = ctx['options']['feed']
+    if not conf:
+        return data
+    relpath = ctx['path']
+    blog = conf['index'].rpartition('/')[0]
+    if relpath == conf['index']:
+        ctx['facts']['feed'] = [[href.decode('utf-8', 'replace'), _text(title),
+                                 _date(day.decode('ascii', 'replace'))]
+                                for href, title, day in _LISTED.findall(data)]
+    elif relpath.rpartition('/')[0] == blog:
+        posts = data.find(_POSTS)
+        if posts < 0:
+            return data
+        headings = _HEADING.findall(data, 0, posts)
+        if headings:
+            title = headings[-1]
+        else:
+            match = _TITLE.search(data, 0, 8192)
+            title = match.group(1) if match else b''
+        published = _PUBLISHED.search(data, posts)
+        first = _FIRST_POST.search(data, posts)
+        ctx['facts']['feed'] = [
+            _text(title),
+            _date(published.group(1).decode('ascii', 'replace')) if published else None,
+            summary(first.group(1).decode('utf-8', 'replace'), conf['summary_length'])
+            if first else '',
+        ]
+    return data
+
+
+def page_dates(ctx, pages):
+    """Return {page: lastmod}, the time each page was first built with its content."""
+    state = load_state(ctx['out_dir'], 'sitemap') or {}
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+    dated = {}
+    for relpath in pages:
+        entry = ctx['files'][relpath]
+        digest = entry.get('src', entry.get('out'))
+        known = state.get(relpath)
+        dated[relpath] = known if known is not None and known[0] == digest else [digest, now]
+    save_state(ctx['out_dir'], 'sitemap', dated)
+    return {relpath: entry[1] for relpath, entry in dated.items()}
+
+
+def _urlset(site_url, pages, dates):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', f'<urlset xmlns="{_SITEMAP_NS}">']
+    for relpath in pages:
+        lines.append(f'<url><loc>{escape(page_link(site_url, relpath))}</loc>'
+                     f'<lastmod>{dates[relpath]}</lastmod></url>')
+    lines.append('</urlset>\n')
+    return '\n'.join(lines).encode('utf-8')
+
+
+def write_sitemaps(ctx, conf, site_url, dates):
+    """Write the shards of the sitemap and its index; return the number of shards."""
+    pages = sorted(dates, key=lambda relpath: page_url(relpath))
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', f'<sitemapindex xmlns="{_SITEMAP_NS}">']
+    shards = [pages[start:start + conf['urls']] for start in range(0, len(pages), conf['urls'])]
+    for number, shard in enumerate(shards, 1):
+        name = SHARD_NAME.format(number)
+        # mtime=0 keeps an unchanged shard byte-identical between builds.
+        emit_file(ctx, name, gzip.compress(_urlset(site_url, shard, dates), 9, mtime=0))
+        lines.append(f'<sitemap><loc>{escape(site_url.rstrip("/") + "/" + name)}</loc>'
+                     f'<lastmod>{max(dates[relpath] for relpath in shard)}</lastmod></sitemap>')
+    lines.append('</sitemapindex>\n')
+    emit_file(ctx, INDEX_NAME, '\n'.join(lines).encode('utf-8'))
+    if conf['robots'] and (ROBOTS_NAME not in ctx['files']
+                           or ctx['files'][ROBOTS_NAME].get('generated')):
+        emit_file(ctx, ROBOTS_NAME, f'User-agent: *\nDisallow:\n\nSitemap: '
+                                    f'{site_url.rstrip("/")}/{INDEX_NAME}\n'.encode('utf-8'))
+    return len(shards)
+
+
+def write_feed(ctx, conf, site_url, dates):
+    """Write the Atom feed of the blog; return the number of entries.
+
+    Articles the index does not list are in the feed too, after the listed
+    ones of their day.
+    """
+    facts = ctx['facts'].get('feed', {})
+    blog = conf['index'].rpartition('/')[0]
+    listed = {}
+    index = facts.get(conf['index']) if conf['index'] in ctx['files'] else None
+    for href, title, published in index or []:
+        relpath = (blog + '/' if blog else '') + href.split('#', 1)[0]
+        listed.setdefault(relpath, (len(listed), title, published))
+    entries = []
+    for relpath in dates:
+        fact = facts.get(relpath)
+        if relpath.rpartition('/')[0] != blog or relpath == conf['index'] or fact is None:
+            continue
+        page_title, published, text = fact
+        position, title, listed_published = listed.get(relpath, (len(listed), page_title, None))
+        published = listed_published or published
+        updated = max(filter(None, (dates[relpath], published)))
+        entries.append((published or updated, -position, relpath, title or page_title,
+                        updated, text))
+    if not entries:
+        return 0
+    entries.sort(reverse=True)
+    entries = entries[:conf['entries']]
+    feed_url = page_link(site_url, conf['path'])
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', f'<feed xmlns="{_ATOM_NS}">',
+             f'<title>{escape(conf["title"])}</title>',
+             f'<id>{escape(page_link(site_url, conf["index"]))}</id>',
+             f'<link rel="self" href="{escape(feed_url)}"/>',
+             f'<link rel="alternate" type="text/html" '
+             f'href="{escape(page_link(site_url, conf["index"]))}"/>',
+             f'<updated>{max(entry[4] for entry in entries)}</updated>',
+             f'<author><name>{escape(conf["author"])}</name></author>']
+    for published, _, relpath, title, updated, text in entries:
+        url = escape(page_link(site_url, relpath))
+        lines.append(f'<entry><title>{escape(title)}</title><id>{url}</id>'
+                     f'<link rel="alternate" type="text/html" href="{url}"/>'
+                     f'<published>{published}</published><updated>{updated}</updated>'
+                     f'<summary>{escape(text)}</summary></entry>')
+    lines.append('</feed>\n')
+    emit_file(ctx, conf['path'], '\n'.join(lines).encode('utf-8'))
+    return len(entries)
+
+
+@register_post_stage('sitemap', order=60)
+def write_sitemap(ctx):
+    """Write the sitemaps, robots.txt and the blog feed."""
+    conf = ctx['options']['sitemap']
+    feed = ctx['options']['feed']
+    site_url = ctx['options']['site_url']
+    if not site_url or not (conf or feed):
+        return
+    pages = [relpath for relpath in ctx['files']
+             if file_type(relpath, ctx['options']) in PAGE_TYPES]
+    listed = [relpath for relpath in pages if conf and in_scope(relpath, conf)]
+    blog = feed['index'].rpartition('/')[0] if feed else None
+    articles = [relpath for relpath in pages if relpath.rpartition('/')[0] == blog]
+    dates = page_dates(ctx, sorted(set(listed) | set(articles)))
+    if conf:
+        ctx['summary']['sitemap_urls'] = len(listed)
+        ctx['summary']['sitemap_shards'] = write_sitemaps(
+            ctx, conf, site_url, {relpath: dates[relpath] for relpath in listed})
+    if feed:
+        ctx['summary']['feed_entries'] = write_feed(ctx, feed, site_url, dates)
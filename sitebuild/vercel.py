@@ -0,0 +1,52 @@
+"""Generation of the deployed vercel.json.
+
+The source vercel.json is read leniently, like the JSON files the build
+minifies (whole-line ``//`` comments and generator residue are ignored),
+the rewrites and headers collected by the other post stages are merged in,
+hand-written rewrites they replace are dropped, and the result is written
+to the output directory.
+"""
+
+import json
+import os
+
+from .cache import hash_bytes
+from .minify import parse_json_bytes
+from .pipeline import register_post_stage, write_atomic
+
+CONFIG_NAME = 'vercel.json'
+
+
+def load_config(path):
+    """Load a vercel.json file, or return an empty config if it does not exist."""
+    try:
+        with open(path, 'rb') as f:
+            return parse_json_bytes(f.read())
+    except FileNotFoundError:
+        return {}
+
+
+@register_post_stage('vercel-config', order=100)
+def write_config(ctx):
+    """Write vercel.json to the output with the collected rewrites and headers."""
+    config = load_config(os.path.join(ctx['src_root'], CONFIG_NAME))
+    replaced = set(ctx['replaced_rewrites'])
+    if replaced and config.get('rewrites'):
+        config['rewrites'] = [rule for rule in config['rewrites']
+                              if rule.get('source') not in replaced]
+    if ctx['rewrites']:
+        # Generated rules are specific, so they go ahead of the hand-written ones.
+        config['rewrites'] = ctx['rewrites'] + config.get('rewrites', [])
+    if ctx['headers']:
+        config['headers'] = ctx['headers'] + config.get('headers', [])
+
+    data = (json.dumps(config, indent=2) + '\n').encode('utf-8')
+    write_atomic(os.path.join(ctx['out_dir'], CONFIG_NAME), data)
+
+    entry = ctx['files'].get(CONFIG_NAME)
+    if entry is not None:
+        entry['out'] = hash_bytes(data)
+        entry['out_size'] = len(data)
+        # The platform reads this file; it is never served, so no sidecars.
+        for encoding in entry.pop('encodings', ()):
+            os.remove(os.path.join(ctx['out_dir'], f'{CONFIG_NAME}.{encoding}'))
@@ -0,0 +1,310 @@
+"""Watch mode: rebuild incrementally whenever the source tree changes.
+
+On Linux the tree is watched with inotify, called through ctypes so there is
+nothing to install; elsewhere it is polled.  Events are collected until the
+tree has been quiet for DEBOUNCE_SECONDS, so an editor's save or a git
+checkout triggers a single rebuild, and the changed files are passed to
+build() as its dirty set: only they are looked at, plus the outputs the
+manifest records as built from them (pages that embed a changed asset).
+The set of source files is kept up to date from the events, so the tree is
+not walked again, and the manifest and facts stay in memory between builds.
+
+With a preview server in the same process, the pages open in browsers are
+reloaded live.  Each batch of events is previewed at once, before the
+debounce: the changed files are rebuilt on their own with what the pre
+stages found in the last build (see preview_files()) and the browsers are
+told to reload.  The full incremental build follows when the burst is over;
+it rebuilds the pages that embed the changed files, runs the whole-site
+pre and post stages (link check, routes, vercel.json) and reloads the
+browsers again only if it wrote something the preview had not.
+"""
+
+import ctypes
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+from .pipeline import build, is_excluded, is_publishable, preview_files, walk_site
+
+# Quiet time that ends a burst of events, and the longest a burst may delay
+# a rebuild.
+DEBOUNCE_SECONDS = 0.05
+MAX_DELAY_SECONDS = 1.0
+# With live reloading, the quiet time also leaves the browsers this long to
+# fetch the previewed pages before the full build takes the CPU.
+RELOAD_GRACE_SECONDS = 0.3
+POLL_SECONDS = 0.5
+
+# From <sys/inotify.h>.
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+_EVENT = struct.Struct('iIII')
+
+
+def _watched_dirs(src_root, reldir, options, skip_dirs):
+    """Yield reldir and the directories below it that walk_site() descends into."""
+    patterns = options['exclude']
+    stack = [reldir]
+    while stack:
+        reldir = stack.pop()
+        yield reldir
+        try:
+            entries = list(os.scandir(os.path.join(src_root, reldir)))
+        except OSError:
+            continue
+        for entry in entries:
+            relpath = entry.name if not reldir else reldir + '/' + entry.name
+            if (entry.is_dir(follow_symlinks=False)
+                    and not is_excluded(relpath, entry.name, patterns)
+                    and os.path.abspath(entry.path) not in skip_dirs):
+                stack.append(relpath)
+
+
+class InotifyWatcher:
+    """Reports changes below src_root with Linux inotify."""
+
+    def __init__(self, src_root, options, skip_dirs=()):
+        self.src_root = src_root
+        self.options = options
+        self.skip_dirs = {os.path.abspath(path) for path in skip_dirs}
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, f"inotify_init1: {os.strerror(code)}")
+        self.dirs = {}  # watch descriptor -> relative directory
+        self.add_tree('')
+
+    def close(self):
+        os.close(self.fd)
+
+    def add_tree(self, reldir):
+        """Watch reldir and every directory below it."""
+        for path in _watched_dirs(self.src_root, reldir, self.options, self.skip_dirs):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(os.path.join(self.src_root, path)),
+                                             WATCH_MASK)
+            if wd >= 0:
+                self.dirs[wd] = path
+            elif ctypes.get_errno() == errno.ENOSPC:
+                raise OSError(errno.ENOSPC, "Too many directories to watch; raise "
+                                            "fs.inotify.max_user_watches")
+            # Otherwise the directory is already gone again.
+
+    def read(self, timeout=None):
+        """Wait up to timeout seconds (None: forever) for changes.
+
+        Returns (relative paths, rescan) or None on timeout.  rescan is set
+        when the paths are not the whole story: a directory was removed or
+        moved away, or the kernel dropped events.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return None
+        data = os.read(self.fd, 256 * 1024)
+        changed = set()
+        rescan = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + _EVENT.size:offset + _EVENT.size + length]
+                               .rstrip(b'\0'))
+            offset += _EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                rescan = True
+                continue
+            reldir = self.dirs.get(wd)
+            if reldir is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.dirs[wd]
+                continue
+            if not name:
+                continue  # the watched directory itself; its parent reports it too
+            relpath = name if not reldir else reldir + '/' + name
+            if not mask & IN_ISDIR:
+                changed.add(relpath)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                if (not is_excluded(relpath, name, self.options['exclude'])
+                        and os.path.join(self.src_root, relpath) not in self.skip_dirs):
+                    # Files may be in it before the watch is in place.
+                    self.add_tree(relpath)
+                    rescan = True
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                rescan = True
+        return changed, rescan
+
+
+class PollingWatcher:
+    """Reports changes below src_root by comparing stat snapshots."""
+
+    def __init__(self, src_root, options, skip_dirs=()):
+        self.src_root = src_root
+        self.options = options
+        self.skip_dirs = skip_dirs
+        self.snapshot = self._scan()
+
+    def close(self):
+        pass
+
+    def _scan(self):
+        snapshot = {}
+        for relpath in walk_site(self.src_root, self.options, self.skip_dirs):
+            try:
+                st = os.stat(os.path.join(self.src_root, relpath))
+            except OSError:
+                continue
+            snapshot[relpath] = (st.st_mtime_ns, st.st_size)
+        return snapshot
+
+    def read(self, timeout=None):
+        """Like InotifyWatcher.read(); checks every POLL_SECONDS."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = POLL_SECONDS if deadline is None else min(POLL_SECONDS,
+                                                            deadline - time.monotonic())
+            time.sleep(max(0.0, wait))
+            snapshot = self._scan()
+            changed = {relpath for relpath in snapshot.keys() | self.snapshot.keys()
+                       if snapshot.get(relpath) != self.snapshot.get(relpath)}
+            self.snapshot = snapshot
+            if changed:
+                return changed, False
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+
+
+def make_watcher(src_root, options, skip_dirs=()):
+    """Return an InotifyWatcher where inotify is available, else a PollingWatcher."""
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(src_root, options, skip_dirs)
+        except (OSError, AttributeError) as e:
+            print(f"    Warning: Cannot use inotify ({e}); polling for changes instead")
+    return PollingWatcher(src_root, options, skip_dirs)
+
+
+def collect(watcher, preview=None, quiet=DEBOUNCE_SECONDS):
+    """Wait for a burst of changes and return (relative paths, rescan).
+
+    The burst is over when there have been no events for quiet seconds.
+    preview, if given, is called with the paths of every batch of events as
+    it arrives, while the burst goes on.
+    """
+    changed, rescan = watcher.read()
+    if preview is not None:
+        preview(changed)
+    first = time.monotonic()
+    while time.monotonic() - first < MAX_DELAY_SECONDS:
+        more = watcher.read(quiet)
+        if more is None:
+            break
+        if preview is not None:
+            preview(more[0])
+        changed |= more[0]
+        rescan = rescan or more[1]
+    return changed, rescan
+
+
+def _report(summary, changed, elapsed):
+    rebuilt = summary['built'] + summary['copied']
+    line = (f"[{time.strftime('%H:%M:%S')}] {len(changed)} changed: {rebuilt} rebuilt, "
+            f"{summary['removed']} removed")
+    if summary['error']:
+        line += f", {summary['error']} errors"
+    print(f"{line} in {elapsed * 1000:.0f} ms")
+
+
+def watch(src_root, out_dir, options, serve=None):
+    """Build, then rebuild on every change until interrupted.
+
+    serve is None or (host, port) of a preview server to run alongside, with
+    live reloading.
+    """
+    src_root = os.path.abspath(src_root)
+    out_dir = os.path.abspath(out_dir)
+    skip_dirs = [out_dir]
+    watcher = make_watcher(src_root, options, skip_dirs)
+    paths = set(walk_site(src_root, options, skip_dirs))
+    summary = build(src_root, out_dir, options, paths=sorted(paths))
+    print(f"Built {summary['files']} files in {summary['seconds']:.2f}s; watching {src_root}")
+    reload = None
+    if serve is not None:
+        from .serve import LiveReload, run_server
+        reload = LiveReload()
+        threading.Thread(target=run_server, args=(out_dir, options) + tuple(serve),
+                         kwargs={'log': False, 'reload': reload}, daemon=True).start()
+    previewed = {}  # relpath -> output hash, for the burst in progress
+
+    def preview(changed):
+        started = time.perf_counter()
+        relpaths = sorted(relpath for relpath in changed & paths
+                          if os.path.isfile(os.path.join(src_root, relpath)))
+        results = preview_files(src_root, out_dir, options, relpaths) if relpaths else None
+        built = {result['path']: result['out'] for result in results or ()
+                 if result['status'] == 'built'}
+        if built:
+            previewed.update(built)
+            reload.notify()
+            print(f"[{time.strftime('%H:%M:%S')}] {len(built)} previewed in "
+                  f"{(time.perf_counter() - started) * 1000:.0f} ms")
+
+    def check(result):
+        # Pages that embed a changed file, or a preview that came out differently.
+        nonlocal stale
+        if result['status'] != 'cached' and previewed.get(result['path'], 0) != result.get('out'):
+            stale = True
+
+    try:
+        while True:
+            previewed.clear()
+            if reload is None:
+                changed, rescan = collect(watcher)
+            else:
+                changed, rescan = collect(watcher, preview, RELOAD_GRACE_SECONDS)
+            started = time.perf_counter()
+            if rescan:
+                paths = set(walk_site(src_root, options, skip_dirs))
+                dirty = None
+            else:
+                known = changed & paths
+                for relpath in changed:
+                    if (os.path.isfile(os.path.join(src_root, relpath))
+                            and is_publishable(relpath, options['exclude'])):
+                        paths.add(relpath)
+                    else:
+                        paths.discard(relpath)
+                # Leave out editor swap files and the like that came and went.
+                changed = known | (changed & paths)
+                if not changed:
+                    continue
+                dirty = changed
+            stale = False
+            summary = build(src_root, out_dir, options, paths=sorted(paths), dirty=dirty,
+                            on_result=check)
+            _report(summary, changed, time.perf_counter() - started)
+            if reload is not None:
+                reload.reindex()
+                if stale or summary['removed']:
+                    reload.notify()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
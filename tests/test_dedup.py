@@ -0,0 +1,45 @@
+"""Tests for the post stages that read outputs the dedup stage has aliased."""
+
+import json
+import os
+import tempfile
+import unittest
+
+from sitebuild.pipeline import build, make_options
+
+LOGO = b'<svg xmlns="http://www.w3.org/2000/svg" width="1" height="1"></svg>\n'
+PAGE = b'<!DOCTYPE html><html><head><title>x</title></head><body><img src="img/logo.svg"></body></html>\n'
+
+
+class RewriteModeTest(unittest.TestCase):
+
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        self.src = os.path.join(root.name, 'site')
+        self.out = os.path.join(root.name, 'out')
+        for tree in ('docs/core-latest', 'docs/core-nightly'):
+            os.makedirs(os.path.join(self.src, tree, 'img'))
+            with open(os.path.join(self.src, tree, 'img', 'logo.svg'), 'wb') as f:
+                f.write(LOGO)
+            with open(os.path.join(self.src, tree, 'index.html'), 'wb') as f:
+                f.write(PAGE)
+
+    def test_fingerprint_copies_of_aliased_assets(self):
+        options = make_options(jobs=1)
+        options['dedup'] = dict(options['dedup'], mode='rewrite')
+        summary = build(self.src, self.out, options)
+        self.assertEqual(summary['error'], 0)
+        with open(os.path.join(self.out, '.build-manifest.json'), encoding='utf-8') as f:
+            files = json.load(f)['files']
+        self.assertEqual(files['docs/core-nightly/img/logo.svg'].get('alias'),
+                         'docs/core-latest/img/logo.svg')
+        copies = [relpath for relpath, entry in files.items()
+                  if entry.get('generated') and relpath.startswith('docs/core-nightly/img/logo.')]
+        self.assertEqual(len(copies), 1)
+        with open(os.path.join(self.out, copies[0]), 'rb') as f:
+            self.assertEqual(f.read(), LOGO)
+
+
+if __name__ == '__main__':
+    unittest.main()
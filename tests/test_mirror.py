@@ -0,0 +1,81 @@
+"""Tests for sitebuild.mirror: an import never writes outside the tree or into the tooling."""
+
+import http.server
+import os
+import tempfile
+import threading
+import unittest
+
+from sitebuild.mirror import import_site, tree_path
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    routes = {}
+
+    def do_GET(self):
+        status, headers, body = self.routes.get(self.path, (404, {}, b''))
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ImportPathTest(unittest.TestCase):
+
+    def serve(self, routes):
+        handler = type('Handler', (_Handler,), {'routes': routes})
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return f'http://127.0.0.1:{server.server_address[1]}'
+
+    def tree(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        dest = os.path.join(root.name, 'site')
+        return root.name, dest
+
+    def test_tree_path(self):
+        self.assertEqual(tree_path('a/./b//c.html'), 'a/b/c.html')
+        self.assertEqual(tree_path('a/../b.html'), 'b.html')
+        for relpath in ('', '.', '..', '../a.html', 'a/../../b.html', '/etc/passwd', 'a\\..\\b'):
+            self.assertIsNone(tree_path(relpath), relpath)
+
+    def test_nested_tooling_is_not_written(self):
+        page = (b'<a href="sitebuild/pipeline.py">x</a><a href=".git/config">x</a>'
+                b'<a href="docs/ok.html">x</a>')
+        url = self.serve({
+            '/index.html': (200, {}, page),
+            '/sitebuild/pipeline.py': (200, {}, b'evil'),
+            '/.git/config': (200, {}, b'evil'),
+            '/docs/ok.html': (200, {}, b'ok'),
+        })
+        _, dest = self.tree()
+        summary = import_site(url, dest, connections=1, rate=0)
+        self.assertEqual(summary['errors'], 0)
+        self.assertTrue(os.path.exists(os.path.join(dest, 'docs', 'ok.html')))
+        self.assertFalse(os.path.exists(os.path.join(dest, 'sitebuild')))
+        self.assertFalse(os.path.exists(os.path.join(dest, '.git')))
+
+    def test_encoded_parent_redirect_stays_in_tree(self):
+        url = self.serve({
+            '/site/index.html': (302, {'Location': '/site/%2e%2e/escaped.html'}, b''),
+            '/escaped.html': (200, {}, b'evil'),
+        })
+        root, dest = self.tree()
+        summary = import_site(url + '/site/', dest, connections=1, rate=0)
+        self.assertEqual(summary['added'], 0)
+        self.assertFalse(os.path.exists(os.path.join(root, 'escaped.html')))
+        self.assertFalse(os.path.exists(os.path.join(dest, 'escaped.html')))
+
+
+if __name__ == '__main__':
+    unittest.main()